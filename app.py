@@ -1,36 +1,226 @@
-from flask import Flask, request, url_for, render_template, flash, redirect
+from flask import Flask, request, url_for, flash, redirect, jsonify, Response, stream_with_context
 from flask_wtf import FlaskForm, CSRFProtect
 from wtforms import StringField, TextField, SubmitField, IntegerField, RadioField 
 from wtforms.validators import DataRequired, Length, NumberRange, ValidationError
 
+import csv
+import gc
+import hashlib
+import io
+import json
+import math
 import os
-import pickle
+import time
+
+import flask
+import numpy as np
+
+from comparables import ComparableSales
+from delivery import PrecompressedPages, page_key
+from memory_report import process_memory
+from metrics import SIZE_BUCKETS, MetricsMiddleware, MetricsRegistry
+from model_registry import ModelRegistry
+from postal_codes import PostalCodeIndex
+from prediction_cache import PredictionCache
+from price_series import STATISTICS, PriceSeries
+
+
+TYPES_BIEN = ['appartement', 'maison']
+# (min, max) accepted for each numeric input, shared by the html form and the batch api
+BOUNDS = {"surface": (9, 500), "nb_pieces": (1, 50), "code_postal": (1000, 98000)}
+
+
+def range_validator(field: str) -> NumberRange:
+    low, high = BOUNDS[field]
+    return NumberRange(min=low, max=high, message=f"Doit être compris entre {low} et {high}")
+
+
+# codes postaux with at least one sale in the cleaned DVF data, loaded by create_app
+postal_index = PostalCodeIndex("data/immobilier/data_clean/postal_codes.npy")
+
+
+def unknown_postal_code_message(code_postal: int) -> str:
+    '''Error message of a code postal in range but without any sale, None if the code is known'''
+    if postal_index.is_valid(code_postal):
+        return None
+    return f"Code postal inconnu, le plus proche est {postal_index.suggest(code_postal):05d}"
+
+
+def known_postal_code(form, field) -> None:
+    # runs after the range check, a code already in error gets no second message
+    if field.errors or field.data is None:
+        return
+    message = unknown_postal_code_message(field.data)
+    if message is not None:
+        raise ValidationError(message)
 
 
 class InferenceForm(FlaskForm):
     """Inference form"""
     type_bien = RadioField(
         'Type du bien', validators=[DataRequired(message=("Choisissez un champ"))], 
-        choices=[('appartement','appartement'),('maison','maison')])
+        choices=[(type_bien, type_bien) for type_bien in TYPES_BIEN])
     surface = IntegerField(
         'Surface habitable en m2', validators=[DataRequired(message="Entrez un nombre"), 
-        NumberRange(min=9, max=500, message="Doit être compris entre 9 et 500")])
+        range_validator("surface")])
     nb_pieces = IntegerField(
         'Nombre de pièces principales', validators=[DataRequired(message="Entrez un nombre"), 
-        NumberRange(min=1, max=50, message="Doit être compris entre 1 et 50")])
+        range_validator("nb_pieces")])
     code_postal = IntegerField(
         "Code postal", validators=[DataRequired(message="Entrez un nombre"), 
-        NumberRange(min=1000, max=98000, message="Doit être compris entre 1000 et 98000")])
+        range_validator("code_postal"), known_postal_code])
     submit = SubmitField('Prédire')
 
 
+def validate_estimation_row(row: dict) -> tuple:
+    '''Apply the InferenceForm checks to one batch row,
+    return the (type_bien, surface, nb_pieces, code_postal) tuple and a dict of errors by field'''
+    errors = {}
+    type_bien = row.get("type_bien")
+    if type_bien not in TYPES_BIEN:
+        errors["type_bien"] = "Choisissez un champ"
+    numbers = []
+    for field, (low, high) in BOUNDS.items():
+        value = row.get(field)
+        try:
+            # same as IntegerField: "12", 12 and 12.0 are accepted, "12.5", true or "" are not
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                raise ValueError
+            value = int(value)
+        except (TypeError, ValueError):
+            errors[field] = "Entrez un nombre"
+            continue
+        if not low <= value <= high:
+            errors[field] = f"Doit être compris entre {low} et {high}"
+        elif field == "code_postal":
+            message = unknown_postal_code_message(value)
+            if message is not None:
+                errors[field] = message
+        numbers.append(value)
+    if errors:
+        return None, errors
+    return (type_bien, *numbers), errors
+
+
+# models are loaded by create_app and hot-reloaded when a file changes, they are the flat trees
+# exported by tree_model.py (.npy), memory mapped and predicted without importing sklearn,
+# or the pickled sklearn tree of a type not exported yet
+model_registry = ModelRegistry("ml_models", TYPES_BIEN, extension=".npy", fallback_extension=".pkl")
+# popular inputs come back often, results are kept until their model is reloaded
+prediction_cache = PredictionCache(maxsize=10000, ttl=3600)
+model_registry.add_reload_listener(prediction_cache.invalidate)
+# request metrics of every worker, exposed by /metrics (see metrics.py)
+metrics = MetricsRegistry()
+REQUEST_SECONDS = metrics.histogram("http_request_duration_seconds", "Time from the request to the last byte of the response",
+                                    ("route", "method", "status"))
+STAGE_SECONDS = metrics.histogram("http_request_stage_seconds",
+                                  "Time spent in the inference, template_render and response_write stages", ("stage",))
+RESPONSE_BYTES = metrics.histogram("http_response_size_bytes", "Size of the response bodies", ("route",), SIZE_BUCKETS)
+IN_FLIGHT = metrics.gauge("http_requests_in_flight", "Requests being answered", ("route",))
+CACHE_EVENTS = metrics.counter("prediction_cache_events", "Lookups and removals of the prediction cache",
+                               ("event",))
+CACHE_SIZE = metrics.gauge("prediction_cache_size", "Estimations held by the prediction caches")
+MODELS_LOADED = metrics.gauge("model_loaded", "Workers with the estimation model loaded", ("type_bien",))
+
+
+def render_template(template_name: str, **context) -> str:
+    with STAGE_SECONDS.time("template_render"):
+        return flask.render_template(template_name, **context)
+
+
+# spatial index of the DVF sales for the comparables api, memory mapped by create_app
+comparable_sales = ComparableSales("data/immobilier/data_clean/comparables")
+# yearly prices of every departement, commune and code postal for the map popups and the prices api,
+# memory mapped by create_app
+price_series = PriceSeries("data/immobilier/data_clean/price_series", ["departement", "commune", "code_postal"])
+
+
 # inference fonction, parameters have passed form filters before reaching this function
-# still user can input inexistant code postal (verification could be implimented from flat file or db)
+# (codes postaux without any sale are rejected by the filters)
 def make_inference(type_bien: str, surface: int, nb_pieces: int, code_postal: int):
-    with open(f"ml_models/tree_{type_bien}.pkl", "rb") as file:
-        tree = pickle.load(file)
-    prediction = tree.predict([[surface, nb_pieces, code_postal]])
-    return prediction[0]
+    # check the models files first so a reload invalidates the cache before the lookup
+    model_registry.refresh()
+    # read before the model, a result of a model reloaded meanwhile is not cached
+    generation = prediction_cache.generation
+    key = (type_bien, surface, nb_pieces, code_postal)
+    prediction = prediction_cache.get(key)
+    if prediction is None:
+        tree = model_registry.get(type_bien)
+        with STAGE_SECONDS.time("inference"):
+            prediction = tree.predict([[surface, nb_pieces, code_postal]])[0]
+        prediction_cache.put(key, prediction, generation)
+    return prediction
+
+
+def make_batch_inference(rows: list) -> np.ndarray:
+    '''rows: list of validated (type_bien, surface, nb_pieces, code_postal) tuples
+    cached rows are answered from the cache, the others get one predict call per type of property,
+    predictions keep the rows order'''
+    model_registry.refresh()
+    generation = prediction_cache.generation
+    predictions = np.array([prediction_cache.get(row) for row in rows], dtype=np.float64).reshape(len(rows))
+    missing = np.flatnonzero(np.isnan(predictions))
+    if len(missing) == 0:
+        return predictions
+    types_bien = np.array([rows[i][0] for i in missing])
+    features = np.array([rows[i][1:] for i in missing], dtype=np.float64).reshape(len(missing), 3)
+    with STAGE_SECONDS.time("inference"):
+        for type_bien in TYPES_BIEN:
+            mask = types_bien == type_bien
+            if mask.any():
+                predictions[missing[mask]] = model_registry.get(type_bien).predict(features[mask])
+    for i in missing:
+        prediction_cache.put(rows[i], predictions[i], generation)
+    return predictions
+
+
+# maximum number of rows accepted in one call of the batch api
+BATCH_MAX_ROWS = 100000
+BATCH_FIELDS = ["type_bien", "surface", "nb_pieces", "code_postal"]
+
+
+def read_batch_rows() -> list:
+    '''Rows of the current request, from a csv body (text/csv) or a json list of objects
+    (either the list itself or under a "rows" key), None if the body can't be read'''
+    if request.mimetype == "text/csv":
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get("rows")
+    if not isinstance(payload, list) or not all(isinstance(row, dict) for row in payload):
+        return None
+    return payload
+
+
+def stream_json_results(results: list):
+    yield "[\n"
+    for index, result in enumerate(results):
+        separator = ",\n" if index else ""
+        yield separator + json.dumps({"index": index, **result}, ensure_ascii=False)
+    yield "\n]\n"
+
+
+def csv_value(value) -> str:
+    # booleans spelled as in the json api, not as python's True/False
+    if isinstance(value, bool):
+        return json.dumps(value)
+    return value
+
+
+def stream_csv_results(rows: list, results: list):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["index", *BATCH_FIELDS, "estimation", "low_support", "errors"])
+    for index, (row, result) in enumerate(zip(rows, results)):
+        writer.writerow([index, *[row.get(field) for field in BATCH_FIELDS], result.get("estimation", ""),
+                         csv_value(result.get("low_support", "")),
+                         json.dumps(result.get("errors", ""), ensure_ascii=False) if "errors" in result else ""])
+        # flush every few hundred lines so the body is sent while it is produced
+        if index % 500 == 499:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
 
 csrf = CSRFProtect()
@@ -40,6 +230,118 @@ try:
 except:
     app.config['SECRET_KEY'] = os.environ["FLASK_KEY"]
 csrf.init_app(app)
+# duration, size and write time of each response, recorded once the body is written
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, REQUEST_SECONDS, RESPONSE_BYTES, IN_FLIGHT, STAGE_SECONDS)
+
+# multi-megabyte generated pages, rendered and compressed by site_build.py
+generated_pages = PrecompressedPages("build/precompressed")
+# every route without form nor live state, frozen by site_build.py
+frozen_site = PrecompressedPages("build/site")
+# commune map tiles, built by src/immobilier/commune_tiles.py
+commune_tiles = PrecompressedPages("build/tiles/communes")
+app.config.setdefault("SERVE_FROZEN_SITE", True)
+
+
+def create_app(preload: bool=False) -> Flask:
+    '''Load the models and lookup tables, return the app.
+    preload: called once in the master of a pre-forking server, before the workers are forked
+    (gunicorn preload_app, see gunicorn.conf.py). The models are read only memory mapped files and
+    the lookup tables read only arrays, the objects made so far are frozen out of the garbage collector
+    so that collections in the workers don't write to their pages: the workers share the master memory'''
+    model_registry.load_all()
+    price_series.load()
+    postal_index.load()
+    comparable_sales.load()
+    # read the manifests now rather than on the first request of each worker
+    generated_pages.manifest, frozen_site.manifest, commune_tiles.manifest
+    app.config["RESOURCES_LOADED"] = True
+    if preload:
+        gc.collect()
+        gc.freeze()
+    return app
+
+
+@app.before_first_request
+def load_resources():
+    '''Served as app:app, without the factory: each worker loads its own copy on its first request'''
+    if not app.config.get("RESOURCES_LOADED"):
+        create_app()
+
+
+@app.before_request
+def count_in_flight():
+    '''Route label of the request for the metrics middleware, registered before the other hooks
+    so that the requests they answer are counted too'''
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    request.environ["metrics.route"] = route
+    request.environ["metrics.in_flight"] = True
+    IN_FLIGHT.inc(route)
+
+
+# seconds between two records of the cache and models state of a worker
+CACHE_STATS_INTERVAL = 1.0
+cache_stats_recorded = [0.0]
+
+
+def record_worker_state() -> None:
+    '''Totals of the prediction cache and models of this worker, summed over the workers by /metrics'''
+    cache_stats_recorded[0] = time.monotonic()
+    for type_bien, status in model_registry.status().items():
+        MODELS_LOADED.set(float(status["loaded"]), type_bien)
+    stats = prediction_cache.stats()
+    for event in ("hits", "misses", "evictions", "expirations", "invalidations"):
+        CACHE_EVENTS.set_total(stats[event], event)
+    CACHE_SIZE.set(stats["size"])
+
+
+@app.teardown_request
+def record_cache_stats(exception=None):
+    '''Worker state recorded at most every CACHE_STATS_INTERVAL seconds'''
+    if time.monotonic() - cache_stats_recorded[0] >= CACHE_STATS_INTERVAL:
+        record_worker_state()
+
+
+@app.before_request
+def serve_frozen_site():
+    '''Answer from the frozen site when the url has been prebuilt, the view (and jinja) is skipped'''
+    # the apis are never frozen (see site_build.DYNAMIC_PREFIXES), their urls are not looked up
+    if request.method in ("GET", "HEAD") and app.config["SERVE_FROZEN_SITE"] and not request.path.startswith("/api/"):
+        key = page_key(request.path, request.args.items(multi=True))
+        if key in frozen_site:
+            return frozen_site.send(key)
+
+
+def show_generated_page(template: str):
+    '''Precompressed version of a generated page when it has been built, jinja rendering otherwise'''
+    if template in generated_pages:
+        return generated_pages.send(template)
+    return render_template(template)
+
+
+# readiness probe, ok only once every estimation model is loaded
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    ready = model_registry.is_ready()
+    return jsonify(ready=ready, models=model_registry.status()), 200 if ready else 503
+
+
+# memory of the worker answering, shared is what it shares with the master (see memory_report.py)
+@app.route('/health/memory', methods=['GET'])
+def health_memory():
+    return jsonify(process_memory())
+
+
+# request, stage, response size and cache metrics of every worker, prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    record_worker_state()
+    return Response(metrics.collect(), mimetype="text/plain; version=0.0.4")
+
+
+# prediction cache counters, used to size the cache
+@app.route('/health/cache', methods=['GET'])
+def health_cache():
+    return jsonify(prediction_cache.stats())
 
 
 @app.route('/', methods=['GET'])
@@ -64,11 +366,175 @@ def immo_estimation():
         nb_pieces = form.nb_pieces.data
         code_postal = form.code_postal.data
         result = round(make_inference(type_bien, surface, nb_pieces, code_postal))
-        return render_template('immobilier/predictions/resultat_estimation.html', result=result)
+        return render_template('immobilier/predictions/resultat_estimation.html', result=result,
+                               low_support=postal_index.is_low_support(type_bien, code_postal))
     else:
         print(form.errors.items())
     return render_template('immobilier/predictions/estimation.html', form=form)
 
+# batch estimation: json or csv rows of (type_bien, surface, nb_pieces, code_postal),
+# results are streamed back in the same format, invalid rows get their errors instead of an estimation
+@app.route('/api/immobilier/estimations', methods=['POST'])
+@csrf.exempt
+def api_immo_estimations():
+    rows = read_batch_rows()
+    if rows is None:
+        return jsonify(error="Le corps doit être une liste json d'objets ou un csv avec en-tête"), 400
+    if len(rows) > BATCH_MAX_ROWS:
+        return jsonify(error=f"Maximum {BATCH_MAX_ROWS} lignes par appel"), 413
+
+    results = []
+    valid_rows = []
+    valid_positions = []
+    for position, row in enumerate(rows):
+        values, errors = validate_estimation_row(row)
+        if errors:
+            results.append({"errors": errors})
+        else:
+            results.append({})
+            valid_rows.append(values)
+            valid_positions.append(position)
+    if valid_rows:
+        predictions = make_batch_inference(valid_rows)
+        for position, prediction, (type_bien, _, _, code_postal) in zip(valid_positions, predictions, valid_rows):
+            results[position]["estimation"] = round(prediction)
+            # few sales of this type in the code postal, the estimation is less reliable
+            results[position]["low_support"] = postal_index.is_low_support(type_bien, code_postal)
+
+    if request.mimetype == "text/csv":
+        return Response(stream_with_context(stream_csv_results(rows, results)), mimetype="text/csv")
+    return Response(stream_with_context(stream_json_results(results)), mimetype="application/json")
+
+# price series of a departement, fetched by the map popups when they are opened
+@app.route('/api/immobilier/departements/<code_departement>/prices', methods=['GET'])
+def api_immo_departement_prices(code_departement):
+    type_bien = request.args.get("type_bien", "appartement")
+    if not price_series.has("departement", type_bien):
+        return jsonify(error="Données source manquantes"), 404
+    series = price_series.get("departement", type_bien, [code_departement], statistics=["median", "decile_1", "decile_9"])
+    if series["unknown"]:
+        return jsonify(error="Données source manquantes"), 404
+    response = jsonify(code_departement=code_departement, type_bien=type_bien, years=series["years"],
+                       **series["series"][code_departement])
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return response
+
+# most areas of a prices api request
+PRICES_MAX_AREAS = 500
+
+
+# yearly price series of one or several areas of a level, ex: the 2016-2020 medians of three departements
+# /api/immobilier/prices?niveau=departement&code=75,92,93&type_bien=appartement&debut=2016&fin=2020&statistiques=median
+@app.route('/api/immobilier/prices', methods=['GET'])
+def api_immo_prices():
+    level = request.args.get("niveau", "departement")
+    type_bien = request.args.get("type_bien", "appartement")
+    if not price_series.has(level, type_bien):
+        return jsonify(error="Données source manquantes"), 404
+    codes = list(dict.fromkeys(code.strip() for value in request.args.getlist("code")
+                               for code in value.split(",") if code.strip()))
+    statistics = [name for name in request.args.get("statistiques", "").split(",") if name] or list(STATISTICS)
+    try:
+        first_year, last_year = read_float_arg("debut"), read_float_arg("fin")
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    if not 0 < len(codes) <= PRICES_MAX_AREAS:
+        return jsonify(error=f"Donnez entre 1 et {PRICES_MAX_AREAS} codes"), 400
+    if any(name not in STATISTICS for name in statistics):
+        return jsonify(error=f"statistiques parmi {', '.join(STATISTICS)}"), 400
+
+    # the answer only depends on the data version and the normalized query, checked before reading anything
+    query = f"{level}|{type_bien}|{','.join(codes)}|{first_year}|{last_year}|{','.join(statistics)}"
+    etag = price_series.version(level)[:16] + "-" + hashlib.sha1(query.encode()).hexdigest()[:16]
+    headers = {"Cache-Control": "public, max-age=3600"}
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=headers)
+    else:
+        series = price_series.get(level, type_bien, codes, first_year, last_year, statistics)
+        # plain json.dumps, the sorted keys of jsonify cost more than reading the series
+        body = json.dumps(dict(niveau=level, type_bien=type_bien, **series), separators=(",", ":"))
+        response = Response(body, mimetype="application/json", headers=headers)
+    response.set_etag(etag)
+    return response
+
+# commune prices and geometry of a map tile, only the tiles in view are fetched by the commune map
+@app.route('/api/immobilier/tiles/communes/<int:z>/<int:x>/<int:y>.json', methods=['GET'])
+def api_immo_commune_tile(z, x, y):
+    key = f"{z}/{x}/{y}"
+    if key in commune_tiles:
+        return commune_tiles.send(key)
+    # tiles without commune are not built, they all share the same empty tile
+    if "empty" in commune_tiles:
+        return commune_tiles.send("empty")
+    return jsonify(error="Tuiles non générées"), 404
+
+# limits of the comparables api
+COMPARABLES_MAX_RADIUS_KM = 20
+COMPARABLES_MAX_COUNT = 100
+COMPARABLES_MAX_YEARS = 30
+
+
+def read_float_arg(name: str, default=None) -> float:
+    '''Optional float query argument, ValueError with a message if it is not a finite number'''
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{name} doit être un nombre")
+    # nan and inf would overflow int() and the date arithmetic, or end up as NaN in the json answer
+    if not math.isfinite(number):
+        raise ValueError(f"{name} doit être un nombre fini")
+    return number
+
+
+# nearest recent sales of a type around a point (longitude and latitude, or the center of a code postal)
+# ex: /api/immobilier/comparables?type_bien=appartement&code_postal=75011&surface=45&rayon=1&n=10&annees=2
+@app.route('/api/immobilier/comparables', methods=['GET'])
+def api_immo_comparables():
+    if not comparable_sales.loaded:
+        return jsonify(error="Données source manquantes"), 503
+    type_bien = request.args.get("type_bien", "appartement")
+    if type_bien not in comparable_sales.types_bien:
+        return jsonify(error="type_bien inconnu"), 400
+    try:
+        longitude, latitude = read_float_arg("longitude"), read_float_arg("latitude")
+        code_postal = read_float_arg("code_postal")
+        surface = read_float_arg("surface")
+        radius_km = read_float_arg("rayon", 2.0)
+        count = int(read_float_arg("n", 10))
+        years = int(read_float_arg("annees", 3))
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    if (not 0 < radius_km <= COMPARABLES_MAX_RADIUS_KM or not 0 < count <= COMPARABLES_MAX_COUNT
+            or not 1 <= years <= COMPARABLES_MAX_YEARS):
+        return jsonify(error=f"rayon entre 0 et {COMPARABLES_MAX_RADIUS_KM} km, n entre 1 et {COMPARABLES_MAX_COUNT}, "
+                             f"annees entre 1 et {COMPARABLES_MAX_YEARS}"), 400
+    if (latitude is not None and not -90 <= latitude <= 90) or (longitude is not None and not -180 <= longitude <= 180):
+        return jsonify(error="latitude entre -90 et 90, longitude entre -180 et 180"), 400
+    low, high = BOUNDS["code_postal"]
+    if code_postal is not None and not low <= code_postal <= high:
+        return jsonify(error=f"code_postal entre {low} et {high}"), 400
+    if longitude is None or latitude is None:
+        if code_postal is None:
+            return jsonify(error="Donnez longitude et latitude ou code_postal"), 400
+        center = comparable_sales.postal_centroid(int(code_postal))
+        if center is None:
+            return jsonify(error="Code postal inconnu"), 404
+        longitude, latitude = center
+    # recent: the last `annees` years of the data
+    since = None if comparable_sales.last_date is None else comparable_sales.last_date - np.timedelta64(365 * years, "D")
+    sales = comparable_sales.nearest(type_bien, longitude, latitude, radius_km, count, since, surface)
+    comparables = [{"date": str(date), "longitude": round(float(lon), 6), "latitude": round(float(lat), 6),
+                    "surface": float(surface_bati), "prix_m2": round(float(prix_m2)),
+                    "valeur_fonciere": round(float(valeur)), "distance_km": round(float(distance), 3)}
+                   for date, lon, lat, surface_bati, prix_m2, valeur, distance in
+                   zip(sales["date"], sales["longitude"], sales["latitude"], sales["surface_reelle_bati"],
+                       sales["prix_m2"], sales["valeur_fonciere"], sales["distance_km"])]
+    return jsonify(type_bien=type_bien, longitude=longitude, latitude=latitude, rayon=radius_km,
+                   depuis=None if since is None else str(since), comparables=comparables)
+
 #page that contain map
 @app.route('/immobilier/map_departement', methods=['GET'])
 def immo_map_departement():
@@ -79,7 +545,7 @@ def immo_map_departement():
 @app.route('/immobilier/show_map', methods=['GET'])
 def immo_show_map():
     map_name = request.args.get("map_name")
-    return render_template(f'immobilier/maps/{map_name}.html')
+    return show_generated_page(f'immobilier/maps/{map_name}.html')
 # @app.route('/show_map/<map_name>', methods=['GET'])
 # def show_map(map_name):
 #     return render_template(f'immobilier/maps/{map_name}.html')
@@ -87,7 +553,8 @@ def immo_show_map():
 # DVF_2019_raport_initial
 @app.route('/immobilier/data_exploration', methods=['GET'])
 def immo_data_exploration():
-    data = {"notebook1_name": "immobilier_EDA_1",
+    # name of the template (and of site_build.GENERATED_PAGES), case included
+    data = {"notebook1_name": "Immobilier_EDA_1",
             "notebook1_height" : 2680,
             "report1_name": "DVF_2019_raport_initial",
             "report1_height" : 17560}
@@ -95,7 +562,7 @@ def immo_data_exploration():
 
 @app.route('/immobilier/show_notebook/<notebook>')
 def immo_show_notebook(notebook):
-    return render_template(f'immobilier/notebooks/{notebook}.html')
+    return show_generated_page(f'immobilier/notebooks/{notebook}.html')
 
 
 @app.route('/immobilier/pandas_profiling')
@@ -109,7 +576,7 @@ def immo_pandas_profiling():
 @app.route('/immobilier/show_pandas_profiling')
 def immo_show_pandas_profiling():
     report_name = request.args.get("report_name")
-    return render_template(f'immobilier/data_exploration/{report_name}.html')
+    return show_generated_page(f'immobilier/data_exploration/{report_name}.html')
 
 
 
@@ -143,7 +610,7 @@ def cl_rapport_power_bi():
 
 @app.route('/climat/show_notebook/<notebook>')
 def cl_show_notebook(notebook):
-    return render_template(f'climat/notebooks/{notebook}.html')
+    return show_generated_page(f'climat/notebooks/{notebook}.html')
 
 
 @app.route('/trading/presentation')
@@ -0,0 +1,304 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    # the benchmarks run from a workspace directory, the modules are imported from the repository
+    sys.path.insert(0, ROOT)
+
+from benchmarks import synthetic
+
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+# sizes of the synthetic inputs, small for a quick check of a change, full for numbers close to production
+SCALES = {
+    "small": {"dvf_rows": 20000, "gsod_stations": 50, "climat_stations": 300, "climat_years": 3,
+              "inference_calls": 2000, "route_requests": 200, "points_per_edge": 100, "repeat": 3},
+    "full": {"dvf_rows": 400000, "gsod_stations": 1500, "climat_stations": 3000, "climat_years": 10,
+             "inference_calls": 20000, "route_requests": 2000, "points_per_edge": 1000, "repeat": 5},
+}
+DVF_YEARS = range(2014, 2021)
+GSOD_YEAR = 2019
+
+# name -> function(scale) returning the callable to time and the parameters recorded with the result
+BENCHMARKS = {}
+
+
+def benchmark(name: str) -> callable:
+    def decorator(function: callable) -> callable:
+        BENCHMARKS[name] = function
+        return function
+    return decorator
+
+
+def measure(function: callable, repeat: int) -> dict:
+    '''Wall time of `repeat` calls, then peak memory of one more call traced by tracemalloc
+    (kept out of the timed calls, tracing slows python allocations down)'''
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "median_seconds": statistics.median(seconds), "min_seconds": min(seconds),
+            "peak_memory_bytes": peak}
+
+
+def prepare_workspace(scale: dict, seed: int) -> None:
+    '''Write the synthetic inputs in the data/ layout of the repository, in the current directory.
+    Skipped when the directory already holds the inputs of the same scale and seed'''
+    description = {"scale": scale, "seed": seed}
+    if os.path.isfile("benchmark_data.json"):
+        with open("benchmark_data.json", "r") as file:
+            if json.load(file) == description:
+                return
+    synthetic.write_dvf_years("data/immobilier/transactions_raw", DVF_YEARS, scale["dvf_rows"], seed)
+    synthetic.write_gsod_year("data/climat/daily_raw", GSOD_YEAR, scale["gsod_stations"], seed)
+    synthetic.write_country_list("data/climat/country_list.json")
+    write_models(seed)
+    with open("benchmark_data.json", "w") as file:
+        json.dump(description, file)
+
+
+def write_models(seed: int) -> None:
+    '''Flat trees of the app fitted on synthetic surfaces, pieces and codes postaux (depth of the real ones)'''
+    from sklearn.tree import DecisionTreeRegressor
+    from flat_tree import export_tree
+
+    rng = np.random.default_rng(seed)
+    os.makedirs("ml_models", exist_ok=True)
+    X = np.column_stack([rng.integers(9, 500, 100000), rng.integers(1, 12, 100000), rng.integers(1000, 98000, 100000)])
+    for type_bien in ("appartement", "maison"):
+        y = X[:, 0] * rng.uniform(2000, 5000) * (1 + X[:, 2] / 200000) + rng.normal(0, 20000, len(X))
+        export_tree(DecisionTreeRegressor(random_state=seed).fit(X, y), f"ml_models/tree_{type_bien}.npy")
+
+
+def estimation_rows(count: int, seed: int) -> list:
+    rng = np.random.default_rng(seed)
+    return [(("appartement", "maison")[i % 2], int(surface), int(pieces), int(code))
+            for i, (surface, pieces, code) in enumerate(zip(rng.integers(9, 500, count), rng.integers(1, 12, count),
+                                                            rng.integers(1000, 98000, count)))]
+
+
+def web_app():
+    os.environ.setdefault("FLASK_KEY", "benchmark")
+    import app as web
+    web.create_app()
+    web.app.config["WTF_CSRF_ENABLED"] = False
+    return web
+
+
+@benchmark("make_inference")
+def bench_make_inference(scale: dict, seed: int) -> tuple:
+    '''Cache misses: the cache is emptied before each run of distinct inputs'''
+    web = web_app()
+    rows = estimation_rows(scale["inference_calls"], seed)
+
+    def run():
+        web.prediction_cache.invalidate()
+        for row in rows:
+            web.make_inference(*row)
+    return run, {"calls": len(rows)}
+
+
+@benchmark("make_inference_cached")
+def bench_make_inference_cached(scale: dict, seed: int) -> tuple:
+    web = web_app()
+    rows = estimation_rows(scale["inference_calls"], seed)
+    for row in rows:
+        web.make_inference(*row)
+
+    def run():
+        for row in rows:
+            web.make_inference(*row)
+    return run, {"calls": len(rows)}
+
+
+@benchmark("tree_predict_row")
+def bench_tree_predict_row(scale: dict, seed: int) -> tuple:
+    '''One row per predict of the flat tree, as make_inference on a cache miss'''
+    from flat_tree import FlatTree
+
+    tree = FlatTree.load("ml_models/tree_appartement.npy")
+    features = np.array([row[1:] for row in estimation_rows(scale["inference_calls"], seed)], dtype=np.float64)
+
+    def run():
+        for row in features:
+            tree.predict(row[None, :])
+    return run, {"calls": len(features), "nodes": tree.node_count}
+
+
+@benchmark("tree_predict_batch")
+def bench_tree_predict_batch(scale: dict, seed: int) -> tuple:
+    '''All the rows in one predict of the flat tree, as make_batch_inference'''
+    from flat_tree import FlatTree
+
+    tree = FlatTree.load("ml_models/tree_appartement.npy")
+    features = np.array([row[1:] for row in estimation_rows(scale["inference_calls"] * 10, seed)], dtype=np.float64)
+
+    def run():
+        tree.predict(features)
+    return run, {"rows": len(features), "nodes": tree.node_count}
+
+
+@benchmark("estimation_route")
+def bench_estimation_route(scale: dict, seed: int) -> tuple:
+    '''POST of the estimation form: validation, inference and template rendering'''
+    web = web_app()
+    client = web.app.test_client()
+    rows = estimation_rows(scale["route_requests"], seed + 1)
+
+    def run():
+        web.prediction_cache.invalidate()
+        for type_bien, surface, nb_pieces, code_postal in rows:
+            response = client.post("/immobilier/estimation", data={"type_bien": type_bien, "surface": surface,
+                                                                    "nb_pieces": nb_pieces, "code_postal": code_postal})
+            assert response.status_code == 200
+    return run, {"calls": len(rows)}
+
+
+@benchmark("data_work")
+def bench_data_work(scale: dict, seed: int) -> tuple:
+    from src.immobilier.data_preparation import appartement_preparation, data_work
+
+    def run():
+        data_work(appartement_preparation)
+    return run, {"years": len(DVF_YEARS), "rows_per_year": scale["dvf_rows"]}
+
+
+@benchmark("process_a_year")
+def bench_process_a_year(scale: dict, seed: int) -> tuple:
+    from src.climat.traitement_donnees import process_a_year
+
+    def run():
+        process_a_year("data/climat/daily_raw", GSOD_YEAR)
+    return run, {"stations": scale["gsod_stations"],
+                 "archive_bytes": os.path.getsize(f"data/climat/daily_raw/{GSOD_YEAR}.tar.gz")}
+
+
+@benchmark("get_clusters")
+def bench_get_clusters(scale: dict, seed: int) -> tuple:
+    from src.climat.clusterisation import ClustersHandler
+
+    df, df_stations = synthetic.climat_tables(scale["climat_stations"], range(2020 - scale["climat_years"], 2020), seed)
+    handler = ClustersHandler(df, df_stations)
+
+    def run():
+        # get_clusters prints the clustered columns at each k
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler.get_clusters("temperature", ["TEMP", "MAX", "MIN"], 2, 6)
+    return run, {"stations": scale["climat_stations"], "k": [2, 6]}
+
+
+@benchmark("departement_map")
+def bench_departement_map(scale: dict, seed: int) -> tuple:
+    '''Simplification of the geometry, layers and html rendering of the map (the title image is left out)'''
+    import branca.colormap as cm
+    from src.immobilier import map_generation
+    from src.immobilier.geometry import zoom_tolerance
+
+    geojson = synthetic.departements_geojson(points_per_edge=scale["points_per_edge"], seed=seed)
+    codes = [feature["properties"]["code"] for feature in geojson["features"]]
+    df_appart = synthetic.departement_price_table(codes, DVF_YEARS, seed)
+    df_maison = synthetic.departement_price_table(codes, DVF_YEARS, seed + 1)
+    # the map module takes its colormap from its __main__
+    map_generation.colormap = cm.LinearColormap(colors=['darkgreen', 'green', 'yellow', 'orange', 'red', 'darkred'],
+                                                index=[700, 1300, 2000, 2800, 5000, 10000], vmin=700, vmax=10000)
+    for df in (df_appart, df_maison):
+        df["color"] = df["2019_median"].apply(map_generation.colormap)
+
+    def run():
+        departement_map = map_generation.DepartementMap(45.8566, 2.3522, "benchmark", lazy_popups=True)
+        departement_map.draw_departements(geojson, df_appart, df_maison, tolerance=zoom_tolerance(8))
+        departement_map.build().get_root().render()
+    return run, {"departements": len(codes), "points_per_edge": scale["points_per_edge"]}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names: list, scale_name: str, seed: int, workspace: str) -> dict:
+    scale = SCALES[scale_name]
+    start = os.getcwd()
+    os.makedirs(workspace, exist_ok=True)
+    os.chdir(workspace)
+    try:
+        prepare_workspace(scale, seed)
+        results = {}
+        for name in names:
+            function, parameters = BENCHMARKS[name](scale, seed)
+            result = measure(function, scale["repeat"])
+            result["parameters"] = parameters
+            if "calls" in parameters:
+                result["median_seconds_per_call"] = result["median_seconds"] / parameters["calls"]
+            results[name] = result
+            print(f"{name:<24}{result['median_seconds']:>10.3f} s{result['peak_memory_bytes'] / 2 ** 20:>10.1f} MB peak")
+    finally:
+        os.chdir(start)
+    return {"started": datetime.datetime.now().isoformat(timespec="seconds"), "scale": scale_name, "seed": seed,
+            "git_commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+            "numpy": np.__version__, "pandas": pd.__version__, "benchmarks": results}
+
+
+def compare(run: dict, reference: dict) -> None:
+    '''Ratios of the median times and peak memories against a previous run (below 1: faster or smaller)'''
+    print(f"against {reference['git_commit']} ({reference['started']}, scale {reference['scale']})")
+    for name, result in run["benchmarks"].items():
+        previous = reference["benchmarks"].get(name)
+        if previous is None:
+            continue
+        print(f"{name:<24}time x{result['median_seconds'] / previous['median_seconds']:>6.2f}"
+              f"   memory x{result['peak_memory_bytes'] / max(previous['peak_memory_bytes'], 1):>6.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and peak memory of the hot paths on seeded synthetic data, "
+                                                 "results saved as json in benchmarks/results")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run among {', '.join(BENCHMARKS)}, all by default")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workspace", help="directory of the synthetic data, kept between runs (temporary by default)")
+    parser.add_argument("--compare", help="json of a previous run to compare with")
+    arguments = parser.parse_args()
+
+    names = arguments.names or list(BENCHMARKS)
+    if set(names) - set(BENCHMARKS):
+        parser.error(f"unknown benchmarks: {', '.join(sorted(set(names) - set(BENCHMARKS)))}")
+    if arguments.workspace:
+        run = run_benchmarks(names, arguments.scale, arguments.seed, os.path.abspath(arguments.workspace))
+    else:
+        with tempfile.TemporaryDirectory() as workspace:
+            run = run_benchmarks(names, arguments.scale, arguments.seed, workspace)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{run['started'].replace(':', '-')}_{run['scale']}.json")
+    with open(path, "w") as file:
+        json.dump(run, file, indent=2)
+    print(f"saved to {path}")
+    if arguments.compare:
+        with open(arguments.compare, "r") as file:
+            compare(run, json.load(file))
@@ -0,0 +1,197 @@
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+import pandas as pd
+
+
+# header of the DVF full{year}.csv.gz files (geo-dvf), the columns not used by the preparation stay empty
+DVF_HEADER = ["id_mutation", "date_mutation", "numero_disposition", "nature_mutation", "valeur_fonciere",
+    "adresse_numero", "adresse_suffixe", "adresse_nom_voie", "adresse_code_voie", "code_postal", "code_commune",
+    "nom_commune", "code_departement", "ancien_code_commune", "ancien_nom_commune", "id_parcelle",
+    "ancien_id_parcelle", "numero_volume", "lot1_numero", "lot1_surface_carrez", "lot2_numero",
+    "lot2_surface_carrez", "lot3_numero", "lot3_surface_carrez", "lot4_numero", "lot4_surface_carrez",
+    "lot5_numero", "lot5_surface_carrez", "nombre_lots", "code_type_local", "type_local", "surface_reelle_bati",
+    "nombre_pieces_principales", "code_nature_culture", "nature_culture", "code_nature_culture_speciale",
+    "nature_culture_speciale", "surface_terrain", "longitude", "latitude"]
+DEPARTEMENTS = [f"{code:02d}" for code in range(1, 96) if code != 20] + ["2A", "2B", "971", "972", "974"]
+NATURES = ["Vente", "Vente en l'état futur d'achèvement", "Echange", "Adjudication"]
+TYPES_LOCAL = ["Appartement", "Maison", "Dépendance", "Local industriel. commercial ou assimilé"]
+
+# columns of the GSOD yearly archives: one csv per station in {year}.tar.gz
+GSOD_HEADER = ["STATION", "DATE", "LATITUDE", "LONGITUDE", "ELEVATION", "NAME", "TEMP", "TEMP_ATTRIBUTES", "DEWP",
+    "DEWP_ATTRIBUTES", "SLP", "SLP_ATTRIBUTES", "STP", "STP_ATTRIBUTES", "VISIB", "VISIB_ATTRIBUTES", "WDSP",
+    "WDSP_ATTRIBUTES", "MXSPD", "GUST", "MAX", "MAX_ATTRIBUTES", "MIN", "MIN_ATTRIBUTES", "PRCP",
+    "PRCP_ATTRIBUTES", "SNDP", "FRSHTT"]
+# FIPS country code of the station names -> country, as in data/climat/country_list.json
+COUNTRIES = {"FR": "France", "GM": "Germany", "SP": "Spain", "IT": "Italy", "PO": "Portugal", "UK": "United Kingdom"}
+# stations of other countries, left out by the processing
+OTHER_COUNTRIES = ["US", "CA"]
+
+
+def dvf_year(year: int, rows: int, seed: int=0) -> pd.DataFrame:
+    '''Rows shaped like a DVF yearly file: mutations of 1 to 3 rows (multi lots), sales and other natures,
+    every type of local, missing surfaces, pieces, codes postaux and coordinates'''
+    rng = np.random.default_rng([seed, year])
+    mutation = np.cumsum(rng.random(rows) < 0.75)
+    departements = np.array(DEPARTEMENTS)[rng.integers(0, len(DEPARTEMENTS), rows)]
+    communes = rng.integers(1, 400, rows)
+    types_local = np.array(TYPES_LOCAL + [""])[rng.choice(5, rows, p=[0.35, 0.3, 0.2, 0.05, 0.1])]
+    surfaces = np.where(types_local == "Appartement", rng.lognormal(4, 0.5, rows), rng.lognormal(4.6, 0.4, rows))
+    surfaces = np.round(surfaces)
+    surfaces[(types_local == "") | (types_local == "Dépendance") | (rng.random(rows) < 0.02)] = np.nan
+    prices = np.round(surfaces * rng.lognormal(8, 0.6, rows), 2)
+    prices[np.isnan(prices)] = np.round(rng.uniform(1000, 300000, int(np.isnan(prices).sum())), 2)
+    df = pd.DataFrame({column: "" for column in DVF_HEADER}, index=range(rows))
+    df["id_mutation"] = [f"{year}-{number}" for number in mutation]
+    df["date_mutation"] = (np.datetime64(f"{year}-01-01") + rng.integers(0, 365, rows).astype("timedelta64[D]")).astype(str)
+    df["numero_disposition"] = 1
+    df["nature_mutation"] = np.array(NATURES)[rng.choice(len(NATURES), rows, p=[0.85, 0.1, 0.03, 0.02])]
+    df["valeur_fonciere"] = prices
+    df["adresse_numero"] = rng.integers(1, 200, rows)
+    department_numbers = np.array([int(code[:2]) if code[:2].isdigit() else 20 for code in departements])
+    df["code_postal"] = np.where(rng.random(rows) < 0.01, np.nan, department_numbers * 1000 + rng.integers(0, 10, rows) * 10)
+    df["code_commune"] = [f"{departement}{commune:03d}" for departement, commune in zip(departements, communes)]
+    df["code_departement"] = departements
+    df["type_local"] = types_local
+    df["code_type_local"] = np.where(types_local == "", "", 1)
+    df["surface_reelle_bati"] = surfaces
+    df["nombre_pieces_principales"] = np.where(np.isnan(surfaces), np.nan, np.clip(np.round(surfaces / 20), 1, 12))
+    df["surface_terrain"] = np.where(types_local == "Maison", np.round(rng.lognormal(6, 0.8, rows)), np.nan)
+    df["nombre_lots"] = rng.integers(0, 3, rows)
+    located = rng.random(rows) > 0.02
+    df["longitude"] = np.where(located, np.round(rng.uniform(-4.5, 8, rows), 6), np.nan)
+    df["latitude"] = np.where(located, np.round(rng.uniform(42.5, 51, rows), 6), np.nan)
+    return df
+
+
+def write_dvf_years(directory: str, years: list, rows: int, seed: int=0) -> None:
+    '''full{year}.csv.gz files of `rows` rows each, as read by data_preparation.dvf_path'''
+    os.makedirs(directory, exist_ok=True)
+    for year in years:
+        dvf_year(year, rows, seed).to_csv(os.path.join(directory, f"full{year}.csv.gz"), index=False)
+
+
+def gsod_station(rng: np.random.Generator, year: int, station: int, country: str) -> pd.DataFrame:
+    '''Daily rows of a station for a year, some days missing and sentinel values (9999.9, 999.9, 99.99)
+    for the missing measures'''
+    days = pd.date_range(f"{year}-01-01", f"{year}-12-31")
+    days = days[rng.random(len(days)) < 0.95]
+    n = len(days)
+    seasons = np.cos((days.dayofyear.to_numpy() - 200) / 365 * 2 * np.pi)
+
+    def measure(values, sentinel, missing=0.03):
+        values = np.round(values, 1)
+        values[rng.random(n) < missing] = sentinel
+        return values
+
+    temperature = 50 + 20 * seasons + rng.normal(0, 6, n)
+    return pd.DataFrame({
+        "STATION": station, "DATE": days.strftime("%Y-%m-%d"),
+        "LATITUDE": round(rng.uniform(34, 73), 4), "LONGITUDE": round(rng.uniform(-20, 30), 4),
+        "ELEVATION": round(rng.uniform(0, 2500), 1), "NAME": f"STATION {station % 100000}, {country}",
+        "TEMP": measure(temperature, 9999.9), "TEMP_ATTRIBUTES": 24,
+        "DEWP": measure(temperature - rng.uniform(2, 15, n), 9999.9), "DEWP_ATTRIBUTES": 24,
+        "SLP": measure(rng.normal(1013, 8, n), 9999.9, 0.3), "SLP_ATTRIBUTES": 24,
+        "STP": measure(rng.normal(990, 20, n), 999.9, 0.3), "STP_ATTRIBUTES": 24,
+        "VISIB": measure(rng.uniform(1, 20, n), 999.9, 0.2), "VISIB_ATTRIBUTES": 24,
+        "WDSP": measure(rng.gamma(2, 3, n), 999.9), "WDSP_ATTRIBUTES": 24,
+        "MXSPD": measure(rng.gamma(3, 4, n), 999.9), "GUST": measure(rng.gamma(4, 5, n), 999.9, 0.6),
+        "MAX": measure(temperature + rng.uniform(3, 12, n), 9999.9), "MAX_ATTRIBUTES": np.where(rng.random(n) < 0.1, "*", " "),
+        "MIN": measure(temperature - rng.uniform(3, 12, n), 9999.9), "MIN_ATTRIBUTES": np.where(rng.random(n) < 0.1, "*", " "),
+        "PRCP": measure(rng.exponential(0.1, n), 99.99, 0.1), "PRCP_ATTRIBUTES": np.array(list("ABCDEFGHI"))[rng.integers(0, 9, n)],
+        "SNDP": measure(rng.exponential(2, n), 999.9, 0.8),
+        "FRSHTT": [f"{flags:06d}" for flags in rng.choice([0, 10000, 100000, 110000, 11000, 1010, 10, 1], n)],
+    })[GSOD_HEADER]
+
+
+def write_gsod_year(directory: str, year: int, stations: int, seed: int=0) -> None:
+    '''{year}.tar.gz with one quoted csv per station, as the NOAA GSOD yearly archives read by process_a_year'''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng([seed, year])
+    countries = list(COUNTRIES) + OTHER_COUNTRIES
+    with tarfile.open(os.path.join(directory, f"{year}.tar.gz"), "w:gz") as archive:
+        for number in range(stations):
+            # same station ids every year
+            station = 1000000000 + number * 1009
+            data = gsod_station(rng, year, station, countries[number % len(countries)]).to_csv(index=False, quoting=1)
+            data = data.encode()
+            member = tarfile.TarInfo(f"{station}.csv")
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+
+
+def write_country_list(path: str) -> None:
+    '''data/climat/country_list.json: FIPS code -> country kept by the processing'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(COUNTRIES, file)
+
+
+def climat_tables(stations: int, years: list, seed: int=0) -> tuple:
+    '''(ClimatFACT, StationDIM) as written by process_years: monthly facts of every station, stations with
+    their name, country and position'''
+    rng = np.random.default_rng(seed)
+    station_ids = 1000000000 + np.arange(stations) * 1009
+    countries = np.array(list(COUNTRIES.values()))[np.arange(stations) % len(COUNTRIES)]
+    df_stations = pd.DataFrame({"STATION": station_ids, "NAME": [f"STATION {number}" for number in range(stations)],
+                                "COUNTRY": countries, "LATITUDE": rng.uniform(36, 71, stations).astype(np.float32),
+                                "LONGITUDE": rng.uniform(-10, 30, stations).astype(np.float32),
+                                "ELEVATION": rng.uniform(0, 2500, stations).astype(np.float32)})
+    months = pd.date_range(f"{min(years)}-01-01", f"{max(years)}-12-01", freq="MS")
+    dates = np.tile(months.to_numpy(), stations)
+    df = pd.DataFrame({"DATE": dates, "STATION": np.repeat(station_ids, len(months))})
+    n = len(df)
+    seasons = np.cos((df["DATE"].dt.month.to_numpy() - 7) / 12 * 2 * np.pi)
+    base = np.repeat(rng.normal(10, 5, stations), len(months))
+    df["TEMP"] = (base + 10 * seasons + rng.normal(0, 1.5, n)).astype(np.float32)
+    df["MAX"] = (df["TEMP"] + rng.uniform(5, 15, n)).astype(np.float32)
+    df["MIN"] = (df["TEMP"] - rng.uniform(5, 15, n)).astype(np.float32)
+    df["DEWP"] = (df["TEMP"] - rng.uniform(1, 8, n)).astype(np.float32)
+    df["WDSP"] = rng.gamma(2, 5, n).astype(np.float32)
+    df["MXSPD"] = (df["WDSP"] * rng.uniform(1.5, 3, n)).astype(np.float32)
+    df["SNDP"] = np.where(seasons < -0.5, rng.exponential(20, n), 0).astype(np.float32)
+    df["PRCP"] = rng.exponential(2, n).astype(np.float32)
+    for flag, rate in (("FOG", 0.1), ("RAIN", 0.35), ("SNOW", 0.05), ("HAIL", 0.01), ("THUN", 0.05)):
+        df[flag] = rng.binomial(1, rate, n) * rng.uniform(0.5, 1, n)
+    return df, df_stations
+
+
+def departements_geojson(columns: int=10, rows: int=10, points_per_edge: int=200, seed: int=0) -> dict:
+    '''Grid of departement polygons (codes of DEPARTEMENTS) over France with jagged borders of points_per_edge
+    points, each border shared point for point by its two neighbours like the real geometry'''
+    rng = np.random.default_rng(seed)
+    longitudes = np.linspace(-4.5, 8, columns + 1)
+    latitudes = np.linspace(42.5, 51, rows + 1)
+
+    def border(start, end):
+        steps = np.linspace(0, 1, points_per_edge)[:, None]
+        points = start + (np.asarray(end) - start) * steps
+        points[1:-1] += rng.normal(0, 0.01, (points_per_edge - 2, 2))
+        return [[round(x, 10), round(y, 10)] for x, y in points.tolist()]
+
+    horizontal = {(i, j): border((longitudes[i], latitudes[j]), (longitudes[i + 1], latitudes[j]))
+                  for i in range(columns) for j in range(rows + 1)}
+    vertical = {(i, j): border((longitudes[i], latitudes[j]), (longitudes[i], latitudes[j + 1]))
+                for i in range(columns + 1) for j in range(rows)}
+    features = []
+    for number, (i, j) in enumerate((i, j) for j in range(rows) for i in range(columns)):
+        if number == len(DEPARTEMENTS):
+            break
+        ring = (horizontal[(i, j)] + vertical[(i + 1, j)][1:] + horizontal[(i, j + 1)][::-1][1:]
+                + vertical[(i, j)][::-1][1:])
+        features.append({"type": "Feature", "properties": {"code": DEPARTEMENTS[number], "nom": f"Departement {number}"},
+                         "geometry": {"type": "Polygon", "coordinates": [ring]}})
+    return {"type": "FeatureCollection", "features": features}
+
+
+def departement_price_table(codes: list, years: list, seed: int=0) -> pd.DataFrame:
+    '''m2_{type}_price_per_departement layout: {year}_median, {year}_decile_1, {year}_decile_9 by code_departement'''
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for year in years:
+        median = rng.uniform(1000, 9000, len(codes))
+        columns.update({f"{year}_median": median, f"{year}_decile_1": median * 0.5, f"{year}_decile_9": median * 1.8})
+    return pd.DataFrame(columns, index=pd.Index(codes, name="code_departement"))
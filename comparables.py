@@ -0,0 +1,141 @@
+import json
+import os
+
+import numpy as np
+
+
+# grid of cells of CELL_DEGREES x CELL_DEGREES (about 1.1 x 0.8 km in France), cell key = lat row * GRID_WIDTH + lon column,
+# the sales are sorted by (type, cell) so a row of cells is one contiguous slice of the arrays
+CELL_DEGREES = 0.01
+GRID_WIDTH = int(360 / CELL_DEGREES)
+# keys of different types never overlap
+TYPE_STRIDE = GRID_WIDTH * int(180 / CELL_DEGREES)
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+# columns stored, one .npy each
+COLUMNS = {"longitude": np.float32, "latitude": np.float32, "date": "datetime64[D]",
+           "surface_reelle_bati": np.float32, "prix_m2": np.float32, "valeur_fonciere": np.float64}
+
+
+def _cells(longitude: np.ndarray, latitude: np.ndarray) -> tuple:
+    row = np.floor((np.asarray(latitude, dtype=np.float64) + 90) / CELL_DEGREES).astype(np.int64)
+    column = np.floor((np.asarray(longitude, dtype=np.float64) + 180) / CELL_DEGREES).astype(np.int64)
+    return row, column
+
+
+def _save(directory: str, name: str, array: np.ndarray) -> None:
+    # written then renamed, a worker reloading never maps a partial file
+    path = os.path.join(directory, f"{name}.npy")
+    np.save(path + ".tmp.npy", array)
+    os.replace(path + ".tmp.npy", path)
+
+
+def build_index(directory: str, types_bien: list, sales: dict) -> None:
+    '''Write the spatial index of the sales, sales: {"type_bien": index in types_bien, "code_postal", and COLUMNS}
+    as arrays of the same length. Also writes the centroid of each code postal, used as center when only
+    the code postal is known. meta.json is written last, its number of sales tells the arrays are complete'''
+    os.makedirs(directory, exist_ok=True)
+    located = ~(np.isnan(sales["longitude"]) | np.isnan(sales["latitude"]))
+    sales = {name: np.asarray(values)[located] for name, values in sales.items()}
+    row, column = _cells(sales["longitude"], sales["latitude"])
+    keys = sales["type_bien"].astype(np.int64) * TYPE_STRIDE + row * GRID_WIDTH + column
+    order = np.argsort(keys, kind="stable")
+    _save(directory, "keys", keys[order])
+    for name, dtype in COLUMNS.items():
+        _save(directory, name, np.asarray(sales[name])[order].astype(dtype))
+
+    codes = sales["code_postal"]
+    codes = np.where(np.isnan(codes), -1, codes).astype(np.int64) if codes.dtype.kind == "f" else codes.astype(np.int64)
+    known = codes >= 0
+    postal_codes, inverse = np.unique(codes[known], return_inverse=True)
+    counts = np.bincount(inverse)
+    centroids = np.stack([np.bincount(inverse, weights=sales["longitude"][known]) / counts,
+                          np.bincount(inverse, weights=sales["latitude"][known]) / counts], axis=1)
+    _save(directory, "postal_codes", postal_codes)
+    _save(directory, "postal_centroids", centroids)
+    with open(os.path.join(directory, "meta.json"), "w") as file:
+        json.dump({"types_bien": list(types_bien), "sales": int(len(keys)), "cell_degrees": CELL_DEGREES,
+                   "last_date": str(np.max(sales["date"]).astype("datetime64[D]")) if len(keys) else None}, file)
+
+
+class ComparableSales:
+    '''Nearest sales of a type around a point, read from the arrays written by build_index.
+    The arrays are memory mapped: a query only reads the slices of the cells around the point,
+    the workers share the pages and nothing is loaded per worker'''
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.types_bien = []
+        self.arrays = None
+        # date of the most recent sale
+        self.last_date = None
+
+    def load(self) -> None:
+        meta_path = os.path.join(self.directory, "meta.json")
+        if not os.path.isfile(meta_path):
+            return
+        with open(meta_path, "r") as file:
+            meta = json.load(file)
+        arrays = {name: np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r", allow_pickle=False)
+                  for name in ["keys", "postal_codes", "postal_centroids", *COLUMNS]}
+        if any(len(arrays[name]) != meta["sales"] for name in ["keys", *COLUMNS]) or meta["cell_degrees"] != CELL_DEGREES:
+            raise ValueError(f"incomplete or outdated spatial index in {self.directory}")
+        self.types_bien, self.arrays = meta["types_bien"], arrays
+        self.last_date = np.datetime64(meta["last_date"], "D") if meta["last_date"] else None
+
+    @property
+    def loaded(self) -> bool:
+        return self.arrays is not None
+
+    def postal_centroid(self, code_postal: int) -> tuple:
+        '''(longitude, latitude) mean position of the sales of a code postal, None if unknown'''
+        codes = self.arrays["postal_codes"]
+        position = np.searchsorted(codes, code_postal)
+        if position == len(codes) or codes[position] != code_postal:
+            return None
+        longitude, latitude = self.arrays["postal_centroids"][position]
+        return float(longitude), float(latitude)
+
+    def _candidates(self, type_index: int, longitude: float, latitude: float, radius_km: float) -> np.ndarray:
+        '''Rows of the sales of the type in the cells crossing the bounding box of the circle'''
+        delta_latitude = radius_km / KM_PER_DEGREE
+        delta_longitude = radius_km / (KM_PER_DEGREE * max(np.cos(np.radians(latitude)), 0.01))
+        first_row, first_column = _cells(longitude - delta_longitude, latitude - delta_latitude)
+        last_row, last_column = _cells(longitude + delta_longitude, latitude + delta_latitude)
+        rows = np.arange(first_row, last_row + 1)
+        # one contiguous slice of keys per row of cells
+        base = type_index * TYPE_STRIDE + rows * GRID_WIDTH
+        starts = np.searchsorted(self.arrays["keys"], base + first_column, side="left")
+        ends = np.searchsorted(self.arrays["keys"], base + last_column, side="right")
+        if not (ends - starts).sum():
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    def nearest(self, type_bien: str, longitude: float, latitude: float, radius_km: float=2.0, n: int=10,
+                since: np.datetime64=None, surface: float=None, surface_tolerance: float=0.25) -> dict:
+        '''The n sales nearest to the point within radius_km, sold since `since` (all dates if None),
+        with a surface within surface_tolerance of `surface` when given.
+        Return {column: array} for COLUMNS plus distance_km, nearest first'''
+        rows = self._candidates(self.types_bien.index(type_bien), longitude, latitude, radius_km)
+        keep = np.ones(len(rows), dtype=bool)
+        if since is not None:
+            keep &= self.arrays["date"][rows] >= np.datetime64(since, "D")
+        if surface is not None:
+            surfaces = self.arrays["surface_reelle_bati"][rows]
+            keep &= np.abs(surfaces - surface) <= surface_tolerance * surface
+        rows = rows[keep]
+        # haversine distance
+        lon1, lat1 = np.radians(longitude), np.radians(latitude)
+        lon2 = np.radians(self.arrays["longitude"][rows].astype(np.float64))
+        lat2 = np.radians(self.arrays["latitude"][rows].astype(np.float64))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+        inside = distances <= radius_km
+        rows, distances = rows[inside], distances[inside]
+        if len(rows) > n:
+            closest = np.argpartition(distances, n - 1)[:n]
+            rows, distances = rows[closest], distances[closest]
+        order = np.argsort(distances, kind="stable")
+        rows, distances = rows[order], distances[order]
+        result = {name: self.arrays[name][rows] for name in COLUMNS}
+        result["distance_km"] = distances
+        return result
@@ -0,0 +1,117 @@
+import gzip
+import json
+import os
+from urllib.parse import urlencode
+
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli
+except ImportError:
+    # pages are then only precompressed with gzip
+    brotli = None
+
+
+# encodings produced at build time, by order of preference, with the file suffix used on disk
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+# headers common to every answer of a precompressed page (full or 304)
+CACHE_CONTROL = "public, max-age=3600"
+
+
+def accepted_encodings(header: str) -> dict:
+    '''Parse an Accept-Encoding header into {encoding: q}'''
+    accepted = {}
+    for item in header.split(","):
+        parts = item.strip().split(";")
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def page_key(path: str, query_items) -> str:
+    '''Manifest key of an url: its path and its (name, value) query arguments in sorted order'''
+    query = urlencode(sorted(query_items))
+    return f"{path}?{query}" if query else path
+
+
+def write_compressed(path: str, body: bytes) -> dict:
+    '''Write body to path plus its .gz and .br versions, return the size of each encoding'''
+    with open(path, "wb") as file:
+        file.write(body)
+    sizes = {}
+    # mtime=0 so rebuilding the same page gives the same bytes
+    with open(path + ".gz", "wb") as file:
+        file.write(gzip.compress(body, compresslevel=9, mtime=0))
+    sizes["gzip"] = os.path.getsize(path + ".gz")
+    if brotli is not None:
+        with open(path + ".br", "wb") as file:
+            file.write(brotli.compress(body, quality=11))
+        sizes["br"] = os.path.getsize(path + ".br")
+    return sizes
+
+
+class PrecompressedPages:
+    '''Serve the pages rendered and compressed by site_build.py, described in directory/manifest.json,
+    each entry is read from directory/<entry["file"] or its name>[.br|.gz]'''
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._manifest = None
+
+    @property
+    def manifest(self) -> dict:
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.directory, "manifest.json"), "r") as file:
+                    self._manifest = json.load(file)
+            except FileNotFoundError:
+                self._manifest = {}
+        return self._manifest
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.manifest
+
+    def choose_encoding(self, entry: dict) -> tuple:
+        '''Best (encoding, suffix) the client accepts among those built for this page'''
+        accepted = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        best, best_q = (None, ""), 0.0
+        # highest q wins, on equal q the order of ENCODINGS decides
+        for encoding, suffix in ENCODINGS:
+            q = accepted.get(encoding, accepted.get("*", 0.0))
+            if encoding in entry["encodings"] and q > best_q:
+                best, best_q = (encoding, suffix), q
+        return best
+
+    def send(self, name: str) -> Response:
+        '''name must be in the manifest, never build a path from a name that is not'''
+        entry = self.manifest[name]
+        encoding, suffix = self.choose_encoding(entry)
+        # strong etag per representation: same content hash, suffixed by the encoding
+        etag = entry["sha256"][:32] + (f"-{encoding}" if encoding else "")
+        headers = {"Cache-Control": CACHE_CONTROL, "Vary": "Accept-Encoding"}
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+
+        path = os.path.join(self.directory, entry.get("file", name) + suffix)
+        # stream the file by blocks (or sendfile when the server supports it) instead of loading it
+        file = open(path, "rb")
+        response = Response(wrap_file(request.environ, file), mimetype=entry.get("mimetype", "text/html"),
+                            headers=headers, direct_passthrough=True)
+        response.content_length = os.fstat(file.fileno()).st_size
+        if encoding:
+            response.content_encoding = encoding
+        response.set_etag(etag)
+        return response
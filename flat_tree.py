@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+
+
+# rows of the exported array, one column per node
+FEATURE, THRESHOLD, LEFT, RIGHT, VALUE = range(5)
+# children of a leaf in sklearn trees
+TREE_LEAF = -1
+# below this number of rows each row goes down the tree in a python loop: the vectorized walk costs
+# several numpy calls per depth level, whatever the number of rows
+SCALAR_ROWS = 64
+
+
+def export_tree(regressor, path: str) -> None:
+    '''Write a fitted sklearn DecisionTreeRegressor (single output) as one (5, n_nodes) float64 .npy array:
+    feature, threshold, left child, right child and value of each node, contiguous by row.
+    Indices are exact in float64 and a single array keeps the file memory mappable.
+    Written next to path then renamed, a reader never sees a partial file'''
+    tree = regressor.tree_
+    nodes = np.empty((5, tree.node_count), dtype=np.float64)
+    nodes[FEATURE] = tree.feature
+    nodes[THRESHOLD] = tree.threshold
+    nodes[LEFT] = tree.children_left
+    nodes[RIGHT] = tree.children_right
+    nodes[VALUE] = tree.value[:, 0, 0]
+    temporary = path + ".tmp.npy"
+    np.save(temporary, nodes)
+    os.replace(temporary, path)
+
+
+class FlatTree:
+    '''Decision tree regressor predicting from the arrays written by export_tree, without sklearn.
+    The arrays are memory mapped read only: loading is immediate and the pages are shared
+    between the processes mapping the same file'''
+    def __init__(self, nodes: np.ndarray):
+        if nodes.ndim != 2 or nodes.shape[0] != 5:
+            raise ValueError(f"expected a (5, n_nodes) array, got {nodes.shape}")
+        self.nodes = nodes
+        self.feature, self.threshold, self.left, self.right, self.value = nodes
+        # the same memory read as python floats, indexing a memoryview is several times cheaper than an array
+        self._node_rows = [memoryview(np.ascontiguousarray(row)) for row in nodes[:VALUE]]
+
+    @classmethod
+    def load(cls, path: str, mmap: bool=True) -> "FlatTree":
+        return cls(np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False))
+
+    @property
+    def node_count(self) -> int:
+        return self.nodes.shape[1]
+
+    def apply(self, X) -> np.ndarray:
+        '''Leaf reached by each row, all rows go down the tree together, one step per depth level'''
+        # sklearn compares float32 features to float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2:
+            raise ValueError(f"expected a 2d array of features, got {X.ndim}d")
+        if len(X) < SCALAR_ROWS:
+            return self._apply_rows(X)
+        nodes = np.zeros(len(X), dtype=np.intp)
+        rows = np.arange(len(X))
+        while rows.size:
+            current = nodes[rows]
+            left = self.left[current]
+            inner = left != TREE_LEAF
+            rows, current, left = rows[inner], current[inner], left[inner]
+            go_left = X[rows, self.feature[current].astype(np.intp)] <= self.threshold[current]
+            nodes[rows] = np.where(go_left, left, self.right[current]).astype(np.intp)
+        return nodes
+
+    def _apply_rows(self, X: np.ndarray) -> np.ndarray:
+        '''Leaf of each row of a few rows (float32 features), one node after the other'''
+        feature, threshold, left, right = self._node_rows
+        leaves = np.empty(len(X), dtype=np.intp)
+        # float32 values are exact as python floats, the comparisons are the same as the vectorized walk
+        for i, row in enumerate(X.tolist()):
+            node = 0
+            child = left[0]
+            while child != TREE_LEAF:
+                node = int(child if row[int(feature[node])] <= threshold[node] else right[node])
+                child = left[node]
+            leaves[i] = node
+        return leaves
+
+    def predict(self, X) -> np.ndarray:
+        '''Same values as the predict of the exported DecisionTreeRegressor'''
+        return self.value[self.apply(X)]
@@ -0,0 +1,25 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+
+# gunicorn settings, read from the working directory: `gunicorn` alone serves the app
+wsgi_app = "app:create_app(preload=True)"
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# the app (models, lookup tables) is loaded once in the master, the forked workers share its memory
+# pages instead of each loading a copy, check with: python memory_report.py <master pid> --url http://...
+preload_app = True
+# every worker writes its request metrics to this directory, /metrics sums them (see metrics.py),
+# set before the app is imported
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "portfolio_metrics"))
+
+
+def on_starting(server):
+    # counters start from zero with the server, files of a previous run are removed
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+
+def when_ready(server):
+    server.log.info("master pid %s, workers share the preloaded models", os.getpid())
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import urllib.request
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# /proc/<pid>/smaps_rollup fields, in kB
+SMAPS_FIELDS = {"Rss": "rss", "Pss": "pss", "Shared_Clean": "shared_clean", "Shared_Dirty": "shared_dirty",
+                "Private_Clean": "private_clean", "Private_Dirty": "private_dirty"}
+
+
+def process_memory(pid: int=None) -> dict:
+    '''Memory of a process in bytes: rss (resident), uss (private to the process, what killing it frees),
+    pss (shared pages split between the processes sharing them) and shared (rss - uss).
+    Read from /proc on linux, from psutil elsewhere when installed, None values when unknown'''
+    pid = os.getpid() if pid is None else pid
+    memory = {"pid": pid, "rss": None, "uss": None, "pss": None, "shared": None}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as file:
+            fields = {}
+            for line in file:
+                name, _, value = line.partition(":")
+                if name in SMAPS_FIELDS:
+                    fields[SMAPS_FIELDS[name]] = int(value.split()[0]) * 1024
+        memory.update(rss=fields["rss"], pss=fields["pss"], uss=fields["private_clean"] + fields["private_dirty"])
+    except (OSError, KeyError, ValueError):
+        if psutil is None:
+            return memory
+        info = psutil.Process(pid).memory_full_info()
+        memory.update(rss=info.rss, uss=info.uss, pss=getattr(info, "pss", None))
+    memory["shared"] = memory["rss"] - memory["uss"]
+    return memory
+
+
+def child_pids(pid: int) -> list:
+    '''Direct children of a process (the workers of a gunicorn master)'''
+    if psutil is not None:
+        return [child.pid for child in psutil.Process(pid).children()]
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children", "r") as file:
+            children.extend(int(child) for child in file.read().split())
+    return children
+
+
+def warm_up(url: str, requests: int) -> None:
+    '''Send estimations and departement price requests so every worker touches the models and tables'''
+    rows = [{"type_bien": type_bien, "surface": 20 + i % 200, "nb_pieces": 1 + i % 6, "code_postal": 1000 + 97 * i}
+            for i in range(200) for type_bien in ("appartement", "maison")]
+    body = json.dumps(rows).encode()
+    for i in range(requests):
+        request = urllib.request.Request(f"{url}/api/immobilier/estimations", data=body,
+                                         headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(request).read()
+        code = f"{i % 95 + 1:02d}"
+        try:
+            urllib.request.urlopen(f"{url}/api/immobilier/departements/{code}/prices?type_bien=appartement").read()
+        except urllib.error.HTTPError:
+            pass
+
+
+def report(master_pid: int) -> list:
+    '''Memory of the master and of each of its workers'''
+    return [dict(process_memory(master_pid), role="master")] + \
+           [dict(process_memory(pid), role="worker") for pid in child_pids(master_pid)]
+
+
+def print_report(rows: list) -> None:
+    def mb(value):
+        return "-" if value is None else f"{value / 2 ** 20:.1f}"
+
+    print(f"{'role':<8}{'pid':>8}{'rss MB':>10}{'uss MB':>10}{'pss MB':>10}{'shared MB':>11}")
+    for row in rows:
+        print(f"{row['role']:<8}{row['pid']:>8}{mb(row['rss']):>10}{mb(row['uss']):>10}"
+              f"{mb(row['pss']):>10}{mb(row['shared']):>11}")
+    workers = [row for row in rows if row["role"] == "worker" and row["uss"] is not None]
+    if workers:
+        # memory the workers really cost: what they hold privately, the rest is shared with the master
+        print(f"workers: {len(workers)}, private total {mb(sum(row['uss'] for row in workers))} MB, "
+              f"rss total {mb(sum(row['rss'] for row in workers))} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RSS/USS of a pre-forked server master and its workers")
+    parser.add_argument("master_pid", type=int)
+    parser.add_argument("--url", help="send warm up traffic to this server before the report, ex: http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=200)
+    arguments = parser.parse_args()
+    if arguments.url:
+        print_report(report(arguments.master_pid))
+        warm_up(arguments.url.rstrip("/"), arguments.requests)
+        print("after warm up:")
+    print_report(report(arguments.master_pid))
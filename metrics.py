@@ -0,0 +1,348 @@
+import atexit
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+
+# seconds, from a cached lookup to a cold batch
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# bytes, from a 304 to the generated pages of several MB
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+# metric files shared by the processes of a server, one per process: set METRICS_DIR to the same directory
+# for every worker (gunicorn.conf.py does), by default a directory of the process that imported this module
+# (the workers forked from it use it too), removed when that process exits
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), f"metrics_{os.getpid()}")
+# size of a new metrics file, doubled when full
+INITIAL_SIZE = 1 << 16
+
+
+def _remove_directory(directory: str, pid: int) -> None:
+    # forked workers inherit the handler, only the process that named the directory removes it
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if not os.environ.get("METRICS_DIR"):
+    atexit.register(_remove_directory, METRICS_DIR, os.getpid())
+
+
+class ProcessValues:
+    '''float64 values of a single process by key, in a memory mapped file: a write is one struct.pack_into,
+    the other processes read the file without lock. Layout: used bytes (uint64), then entries
+    [key length uint32][key utf-8 padded to 8 bytes][value float64]. An entry is complete before `used` covers it'''
+    def __init__(self, path: str):
+        self.path = path
+        # threads of a worker update the same values
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(INITIAL_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = struct.unpack_from("<Q", self._map, 0)[0] or 8
+        # key -> offset of its value
+        self._positions = {key: position for key, position, _ in read_entries(self._map)}
+
+    def _position(self, key: str) -> int:
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+        encoded = key.encode("utf-8")
+        padded = len(encoded) + (-(len(encoded) + 4) % 8)
+        size = 4 + padded + 8
+        while self._used + size > len(self._map):
+            self._file.truncate(len(self._map) * 2)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        struct.pack_into(f"<I{padded}sd", self._map, self._used, len(encoded), encoded, 0.0)
+        position = self._used + 4 + padded
+        self._used += size
+        struct.pack_into("<Q", self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def add(self, key: str, amount: float) -> None:
+        with self._lock:
+            position = self._position(key)
+            struct.pack_into("<d", self._map, position, struct.unpack_from("<d", self._map, position)[0] + amount)
+
+    def set(self, key: str, value: float) -> None:
+        with self._lock:
+            struct.pack_into("<d", self._map, self._position(key), value)
+
+
+def read_entries(data) -> list:
+    '''(key, value offset, value) of the entries of a ProcessValues file content'''
+    used = struct.unpack_from("<Q", data, 0)[0] if len(data) >= 8 else 0
+    entries = []
+    offset = 8
+    while offset < used:
+        length = struct.unpack_from("<I", data, offset)[0]
+        padded = length + (-(length + 4) % 8)
+        key = bytes(data[offset + 4:offset + 4 + length]).decode("utf-8")
+        position = offset + 4 + padded
+        entries.append((key, position, struct.unpack_from("<d", data, position)[0]))
+        offset = position + 8
+    return entries
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    def __init__(self, registry: "MetricsRegistry", kind: str, name: str, documentation: str, labelnames: tuple):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values -> keys of their samples, built once
+        self._keys = {}
+
+    def _key(self, suffix: str, labels: tuple) -> str:
+        return json.dumps([self.name, suffix, list(labels)])
+
+
+class Counter(Metric):
+    '''Monotonic value, summed over every process (the ones that exited included)'''
+    def __init__(self, registry, name, documentation, labelnames=()):
+        super().__init__(registry, "counter", name, documentation, labelnames)
+
+    def key(self, labels: tuple) -> str:
+        key = self._keys.get(labels)
+        if key is None:
+            key = self._keys[labels] = self._key("_total", labels)
+        return key
+
+    def inc(self, *labels, amount: float=1.0) -> None:
+        self.registry.values().add(self.key(labels), amount)
+
+    def set_total(self, value: float, *labels) -> None:
+        '''Total of this process, for counts kept elsewhere (ex: cache hits)'''
+        self.registry.values().set(self.key(labels), value)
+
+
+class Gauge(Metric):
+    '''Current value, summed over the running processes'''
+    def __init__(self, registry, name, documentation, labelnames=()):
+        super().__init__(registry, "gauge", name, documentation, labelnames)
+
+    def key(self, labels: tuple) -> str:
+        key = self._keys.get(labels)
+        if key is None:
+            key = self._keys[labels] = self._key("", labels)
+        return key
+
+    def inc(self, *labels, amount: float=1.0) -> None:
+        self.registry.values().add(self.key(labels), amount)
+
+    def dec(self, *labels, amount: float=1.0) -> None:
+        self.registry.values().add(self.key(labels), -amount)
+
+    def set(self, value: float, *labels) -> None:
+        self.registry.values().set(self.key(labels), value)
+
+
+class Histogram(Metric):
+    '''Count of observations by bucket (one counter per bucket, made cumulative when exposed) and their sum,
+    the count is the total of the buckets'''
+    def __init__(self, registry, name, documentation, labelnames=(), buckets: tuple=LATENCY_BUCKETS):
+        super().__init__(registry, "histogram", name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def keys(self, labels: tuple) -> tuple:
+        keys = self._keys.get(labels)
+        if keys is None:
+            buckets = [self._key("_bucket", labels + (repr(float(bound)),)) for bound in self.buckets]
+            buckets.append(self._key("_bucket", labels + ("+Inf",)))
+            keys = self._keys[labels] = (buckets, self._key("_sum", labels))
+        return keys
+
+    def observe(self, value: float, *labels) -> None:
+        buckets, sum_key = self.keys(labels)
+        values = self.registry.values()
+        # upper bounds are inclusive
+        values.add(buckets[bisect.bisect_left(self.buckets, value)], 1)
+        values.add(sum_key, value)
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+class MetricsRegistry:
+    '''Metrics of every process of a server, each process writes its own file of directory,
+    collect() reads them all: the /metrics of any worker exposes the whole server'''
+    def __init__(self, directory: str=METRICS_DIR):
+        self.directory = directory
+        self.metrics = []
+        self._values = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def values(self) -> ProcessValues:
+        '''File of the current process, a forked worker opens its own on its first write'''
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._values = ProcessValues(os.path.join(self.directory, f"{os.getpid()}.db"))
+                    self._pid = os.getpid()
+        return self._values
+
+    def counter(self, name: str, documentation: str, labelnames: tuple=()) -> Counter:
+        self.metrics.append(Counter(self, name, documentation, labelnames))
+        return self.metrics[-1]
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple=()) -> Gauge:
+        self.metrics.append(Gauge(self, name, documentation, labelnames))
+        return self.metrics[-1]
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple=(), buckets: tuple=LATENCY_BUCKETS) -> Histogram:
+        self.metrics.append(Histogram(self, name, documentation, labelnames, buckets))
+        return self.metrics[-1]
+
+    def _totals(self) -> dict:
+        '''(name, suffix, labels) -> value summed over the files, gauges of exited processes left out'''
+        kinds = {metric.name: metric.kind for metric in self.metrics}
+        totals = {}
+        if not os.path.isdir(self.directory):
+            return totals
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".db"):
+                continue
+            alive = _is_alive(int(file_name[:-3]))
+            with open(os.path.join(self.directory, file_name), "rb") as file:
+                data = file.read()
+            for key, _, value in read_entries(data):
+                name, suffix, labels = json.loads(key)
+                if kinds.get(name) == "gauge" and not alive:
+                    continue
+                sample = (name, suffix, tuple(labels))
+                totals[sample] = totals.get(sample, 0.0) + value
+        return totals
+
+    def collect(self) -> str:
+        '''Prometheus text exposition format (version 0.0.4)'''
+        totals = self._totals()
+        lines = []
+        for metric in self.metrics:
+            samples = sorted((labels, suffix, value) for (name, suffix, labels), value in totals.items()
+                             if name == metric.name)
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            names = metric.labelnames
+            if metric.kind == "histogram":
+                bounds = [repr(float(bound)) for bound in metric.buckets] + ["+Inf"]
+                series = {}
+                for labels, suffix, value in samples:
+                    base = labels[:-1] if suffix == "_bucket" else labels
+                    series.setdefault(base, {})[(suffix, labels[-1] if suffix == "_bucket" else None)] = value
+                for base, values in series.items():
+                    label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, base))
+                    # observation counts, printed as exact integers (:g would round them past 6 digits)
+                    cumulated = 0
+                    for bound in bounds:
+                        cumulated += int(values.get(("_bucket", bound), 0.0))
+                        separator = "," if label_text else ""
+                        lines.append(f'{metric.name}_bucket{{{label_text}{separator}le="{bound}"}} {cumulated}')
+                    braces = f"{{{label_text}}}" if label_text else ""
+                    lines.append(f"{metric.name}_sum{braces} {values.get(('_sum', None), 0.0)!r}")
+                    lines.append(f"{metric.name}_count{braces} {cumulated}")
+            else:
+                for labels, suffix, value in samples:
+                    label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, labels))
+                    braces = f"{{{label_text}}}" if label_text else ""
+                    lines.append(f"{metric.name}{suffix}{braces} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    '''WSGI middleware measuring each request until its body is written: duration by route, method and status,
+    response size, and time spent writing the body (stage "response_write"). The route label is read from
+    environ["metrics.route"] (set by the app once the url is matched, "unmatched" otherwise) and the in flight
+    gauge is decremented here when the app marked the request with environ["metrics.in_flight"].
+    Bodies sent by the server file wrapper (sendfile) are not wrapped, their size is their Content-Length'''
+    def __init__(self, wsgi_app, duration: Histogram, size: Histogram, in_flight: Gauge, stages: Histogram):
+        self.wsgi_app = wsgi_app
+        self.duration = duration
+        self.size = size
+        self.in_flight = in_flight
+        self.stages = stages
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        response = {"status": "500", "length": None}
+
+        def recording_start_response(status, headers, exc_info=None):
+            response["status"] = status.split(" ", 1)[0]
+            for name, value in headers:
+                if name.lower() == "content-length":
+                    response["length"] = int(value)
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, recording_start_response)
+        except BaseException:
+            self._record(environ, response, start, None, 0)
+            raise
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            self._record(environ, response, start, None, response["length"] or 0)
+            return body
+        return TimedBody(body, self, environ, response, start)
+
+    def _record(self, environ: dict, response: dict, start: float, write_start: float, size: int) -> None:
+        end = time.perf_counter()
+        route = environ.get("metrics.route", "unmatched")
+        if environ.get("metrics.in_flight"):
+            self.in_flight.dec(route)
+        self.duration.observe(end - start, route, environ.get("REQUEST_METHOD", ""), response["status"])
+        self.size.observe(size, route)
+        if write_start is not None:
+            self.stages.observe(end - write_start, "response_write")
+
+
+class TimedBody:
+    '''Response body counting its bytes, the request is recorded when the server closes it'''
+    def __init__(self, body, middleware: MetricsMiddleware, environ: dict, response: dict, start: float):
+        self.body = body
+        self.middleware = middleware
+        self.environ = environ
+        self.response = response
+        self.start = start
+        self.write_start = None
+        self.size = 0
+
+    def __iter__(self):
+        self.write_start = time.perf_counter()
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.middleware._record(self.environ, self.response, self.start, self.write_start, self.size)
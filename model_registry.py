@@ -0,0 +1,125 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from flat_tree import FlatTree
+
+
+class ModelRegistry:
+    '''Hold the estimation models in memory, keyed by type of property.
+    Models are loaded once at startup then reloaded when their file changes on disk
+    (mtime/size first, content hash to confirm), a reload only replaces the model when
+    the new one is fully unpickled so requests never see a half loaded model.
+    extension: ".pkl" for pickled sklearn models, ".npy" for trees exported by flat_tree.export_tree,
+    memory mapped and predicted without sklearn
+    fallback_extension: file loaded when the one of extension is missing (ex: a .pkl not exported yet)'''
+    def __init__(self, model_dir: str, types_bien: list, check_interval: float=2.0, extension: str=".pkl",
+                 fallback_extension: str=None):
+        self.model_dir = model_dir
+        self.extension = extension
+        self.fallback_extension = fallback_extension
+        self.types_bien = list(types_bien)
+        # minimum number of seconds between two checks of the files on disk
+        self.check_interval = check_interval
+        self._models = {}
+        # (mtime, size, sha256) of the file each model was loaded from
+        self._signatures = {}
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        # callables notified with the list of types reloaded
+        self._listeners = []
+
+    def model_path(self, type_bien: str) -> str:
+        '''File of the model, the fallback one when only it exists'''
+        path = os.path.join(self.model_dir, f"tree_{type_bien}{self.extension}")
+        if self.fallback_extension is not None and not os.path.exists(path):
+            fallback = os.path.join(self.model_dir, f"tree_{type_bien}{self.fallback_extension}")
+            if os.path.exists(fallback):
+                return fallback
+        return path
+
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def _read_model(path: str):
+        if path.endswith(".npy"):
+            return FlatTree.load(path)
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def _load(self, type_bien: str) -> bool:
+        '''(Re)load one model if its file changed, return True if a new model was swapped in'''
+        path = self.model_path(type_bien)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        # a model exported once its fallback is loaded has a new size and hash, it replaces the fallback
+        previous = self._signatures.get(type_bien)
+        if previous is not None and previous[:2] == (stat.st_mtime, stat.st_size):
+            return False
+        file_hash = self._file_hash(path)
+        if previous is not None and previous[2] == file_hash:
+            # file touched but content unchanged, only remember the new mtime
+            self._signatures[type_bien] = (stat.st_mtime, stat.st_size, file_hash)
+            return False
+        try:
+            model = self._read_model(path)
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            # file still being written, keep the current model and retry on next check
+            return False
+        # single assignment, readers get either the old or the new model
+        self._models[type_bien] = model
+        self._signatures[type_bien] = (stat.st_mtime, stat.st_size, file_hash)
+        return True
+
+    def add_reload_listener(self, callback: callable) -> None:
+        self._listeners.append(callback)
+
+    def _notify(self, reloaded: list) -> None:
+        if reloaded:
+            for callback in self._listeners:
+                callback(reloaded)
+
+    def load_all(self) -> list:
+        '''Load every model available on disk, return the list of types (re)loaded'''
+        with self._lock:
+            reloaded = [type_bien for type_bien in self.types_bien if self._load(type_bien)]
+            self._last_check = time.monotonic()
+        self._notify(reloaded)
+        return reloaded
+
+    def refresh(self) -> list:
+        '''Check the files at most once per check_interval, reload those that changed'''
+        if time.monotonic() - self._last_check < self.check_interval:
+            return []
+        if not self._lock.acquire(blocking=False):
+            # another thread is already checking, keep serving the current models
+            return []
+        try:
+            reloaded = [type_bien for type_bien in self.types_bien if self._load(type_bien)]
+            self._last_check = time.monotonic()
+        finally:
+            self._lock.release()
+        self._notify(reloaded)
+        return reloaded
+
+    def get(self, type_bien: str):
+        self.refresh()
+        return self._models[type_bien]
+
+    def is_ready(self) -> bool:
+        return all(type_bien in self._models for type_bien in self.types_bien)
+
+    def status(self) -> dict:
+        return {type_bien: {"loaded": type_bien in self._models,
+                            "sha256": self._signatures[type_bien][2] if type_bien in self._signatures else None}
+                for type_bien in self.types_bien}
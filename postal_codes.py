@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+
+# every code postal fits in 5 digits, the index has one slot per possible code
+CODE_SPACE = 100000
+# fewer sales than this for the type of property: the estimation is flagged as weakly supported
+LOW_SUPPORT = 10
+
+
+def write_index(counts: dict, path: str) -> None:
+    '''counts: {type_bien: {code_postal: number of sales}}, written as one (types, CODE_SPACE) uint32 .npy
+    with the types in the rows order in a .types.txt file next to it. Written then renamed, the app reloading
+    never reads a partial file'''
+    types_bien = list(counts)
+    table = np.zeros((len(types_bien), CODE_SPACE), dtype=np.uint32)
+    for row, type_counts in enumerate(counts.values()):
+        codes = np.fromiter(type_counts.keys(), dtype=np.int64, count=len(type_counts))
+        table[row, codes] = np.fromiter(type_counts.values(), dtype=np.uint32, count=len(type_counts))
+    temporary = path + ".tmp.npy"
+    np.save(temporary, table)
+    with open(path + ".types.txt", "w") as file:
+        file.write("\n".join(types_bien))
+    os.replace(temporary, path)
+
+
+class PostalCodeIndex:
+    '''Known codes postaux (at least one sale in the cleaned DVF data) and their number of sales by type of property,
+    made by data_preparation.py. Checking a code is a single array read, the nearest known code is precomputed
+    for every possible code. Before load (or without index file) every code is accepted'''
+    def __init__(self, path: str):
+        self.path = path
+        self.types_bien = []
+        # (types, CODE_SPACE) sales counts, memory mapped
+        self.counts = None
+        self.known = None
+        self.nearest = None
+
+    def load(self) -> None:
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path + ".types.txt", "r") as file:
+            types_bien = file.read().split("\n")
+        counts = np.load(self.path, mmap_mode="r", allow_pickle=False)
+        known = counts.any(axis=0)
+        codes = np.flatnonzero(known)
+        if not len(codes):
+            return
+        # nearest known code of each code, the lower one on equal distance
+        everything = np.arange(CODE_SPACE)
+        position = np.searchsorted(codes, everything)
+        upper = codes[np.minimum(position, len(codes) - 1)]
+        lower = codes[np.maximum(position - 1, 0)]
+        nearest = np.where(np.abs(everything - lower) <= np.abs(upper - everything), lower, upper).astype(np.int32)
+        known.setflags(write=False)
+        nearest.setflags(write=False)
+        self.types_bien, self.counts, self.known, self.nearest = types_bien, counts, known, nearest
+
+    @property
+    def loaded(self) -> bool:
+        return self.known is not None
+
+    def is_valid(self, code_postal: int) -> bool:
+        if not self.loaded:
+            return True
+        return 0 <= code_postal < CODE_SPACE and bool(self.known[code_postal])
+
+    def suggest(self, code_postal: int) -> int:
+        '''Nearest known code, None before load'''
+        if not self.loaded:
+            return None
+        return int(self.nearest[min(max(code_postal, 0), CODE_SPACE - 1)])
+
+    def sales(self, type_bien: str, code_postal: int) -> int:
+        '''Number of sales of this type in the code postal, None if unknown'''
+        if not self.loaded or type_bien not in self.types_bien or not 0 <= code_postal < CODE_SPACE:
+            return None
+        return int(self.counts[self.types_bien.index(type_bien), code_postal])
+
+    def is_low_support(self, type_bien: str, code_postal: int) -> bool:
+        sales = self.sales(type_bien, code_postal)
+        return sales is not None and sales < LOW_SUPPORT
@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    '''Bounded LRU cache with a time to live for the estimation results,
+    keys are the validated (type_bien, surface, nb_pieces, code_postal) tuples.
+    Each invalidation starts a new generation: read it before getting the model and give it to put,
+    a value computed with a model replaced in between is not cached'''
+    def __init__(self, maxsize: int=10000, ttl: float=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expiry time, value), ordered from least to most recently used
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def get(self, key: tuple):
+        '''Cached value for the key, None if absent or expired'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, value, generation: int=None) -> None:
+        '''generation: the one read before the value was computed, the value is dropped if the cache
+        has been invalidated since'''
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, types_bien: list=None) -> None:
+        '''Drop the entries of the given types of property, every entry if None'''
+        with self._lock:
+            self.generation += 1
+            if types_bien is None:
+                removed = len(self._data)
+                self._data.clear()
+            else:
+                keys = [key for key in self._data if key[0] in types_bien]
+                for key in keys:
+                    del self._data[key]
+                removed = len(keys)
+            self.invalidations += removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else None,
+                    "evictions": self.evictions, "expirations": self.expirations,
+                    "invalidations": self.invalidations}
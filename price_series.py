@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# statistics of the series, in the order of the arrays
+STATISTICS = ("count", "mean", "median", "decile_1", "decile_9")
+
+
+def area_code(code) -> str:
+    '''Area codes as strings: departement "01", "2A", commune "75056", code postal 75001.0 -> "75001"'''
+    if isinstance(code, (int, float, np.integer, np.floating)):
+        return f"{int(code):05d}"
+    return str(code)
+
+
+def write_series(directory: str, level: str, table) -> None:
+    '''Write the yearly prices of a level from its store table prices_{level} (see data_preparation.py),
+    indexed by type_bien and area code with a year column and the STATISTICS columns:
+    {level}.npy, one (types, areas, statistics, years) float64 array (NaN: no sale, count 0), and {level}.json
+    with the types, the sorted area codes, the years and the version (hash of the values) used in the etags.
+    The array is written then renamed and the json last, a reader never sees a partial table'''
+    os.makedirs(directory, exist_ok=True)
+    type_values = table.index.get_level_values(0)
+    code_values = [area_code(code) for code in table.index.get_level_values(1)]
+    year_values = table["year"].astype(int).to_numpy()
+    types_bien = sorted(set(type_values))
+    codes = sorted(set(code_values))
+    years = sorted(set(year_values.tolist()))
+    values = np.full((len(types_bien), len(codes), len(STATISTICS), len(years)), np.nan)
+    rows = {code: i for i, code in enumerate(codes)}
+    values[np.searchsorted(types_bien, type_values), [rows[code] for code in code_values], :,
+           np.searchsorted(years, year_values)] = table[list(STATISTICS)].to_numpy(dtype=np.float64)
+    counts = values[:, :, STATISTICS.index("count")]
+    counts[np.isnan(counts)] = 0
+    values = np.round(values, 2)
+
+    path = os.path.join(directory, level)
+    np.save(path + ".tmp.npy", values)
+    os.replace(path + ".tmp.npy", path + ".npy")
+    with open(path + ".json", "w") as file:
+        json.dump({"types_bien": types_bien, "codes": codes, "years": years, "statistics": list(STATISTICS),
+                   "version": hashlib.sha256(values.tobytes()).hexdigest()}, file)
+
+
+class PriceSeries:
+    '''Yearly m2 price statistics of every area of several levels (departement, commune, code_postal),
+    written by data_preparation.py with write_series. Each level is one read only memory mapped array
+    and a dict from area code to row, loaded before the web workers are forked: the workers share the pages
+    and a query only reads the rows of the areas asked'''
+    def __init__(self, directory: str, levels: list):
+        self.directory = directory
+        self.levels = list(levels)
+        # level -> (meta, {area code: row}, values (types, areas, statistics, years))
+        self.tables = {}
+
+    def load(self) -> None:
+        for level in self.levels:
+            path = os.path.join(self.directory, level)
+            if not os.path.isfile(path + ".json"):
+                continue
+            with open(path + ".json", "r") as file:
+                meta = json.load(file)
+            values = np.load(path + ".npy", mmap_mode="r", allow_pickle=False)
+            if values.shape != (len(meta["types_bien"]), len(meta["codes"]), len(meta["statistics"]), len(meta["years"])):
+                raise ValueError(f"incomplete or outdated price series in {path}.npy")
+            self.tables[level] = (meta, {code: i for i, code in enumerate(meta["codes"])}, values)
+
+    def has(self, level: str, type_bien: str) -> bool:
+        return level in self.tables and type_bien in self.tables[level][0]["types_bien"]
+
+    def version(self, level: str) -> str:
+        '''Hash of the values of a level, changes with every new build of the data'''
+        return self.tables[level][0]["version"]
+
+    def get(self, level: str, type_bien: str, codes: list, first_year: int=None, last_year: int=None,
+            statistics: list=None) -> dict:
+        '''Series of several areas of a level for the years first_year to last_year (every year when None):
+        {"years": [...], "series": {code: {statistic: [value or None, ...]}}, "unknown": [codes without data]},
+        statistics: subset of STATISTICS, all when None. The level and type must be loaded (see has)'''
+        meta, rows, values = self.tables[level]
+        statistics = list(meta["statistics"]) if statistics is None else list(statistics)
+        years = np.asarray(meta["years"])
+        selected_years = (years >= (years[0] if first_year is None else first_year)) & \
+                         (years <= (years[-1] if last_year is None else last_year))
+        known = [code for code in codes if code in rows]
+        # a single gather of the rows asked, then the statistics and years
+        block = values[meta["types_bien"].index(type_bien), [rows[code] for code in known]]
+        block = block[:, [meta["statistics"].index(statistic) for statistic in statistics]][:, :, selected_years]
+        cells = block.astype(object)
+        cells[np.isnan(block)] = None
+        if "count" in statistics:
+            position = statistics.index("count")
+            cells[:, position] = block[:, position].astype(np.int64)
+        cells = cells.tolist()
+        return {"years": years[selected_years].tolist(),
+                "series": {code: dict(zip(statistics, area)) for code, area in zip(known, cells)},
+                "unknown": [code for code in codes if code not in rows]}
@@ -0,0 +1,139 @@
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from urllib.parse import urlencode, urlsplit, parse_qsl
+
+from flask import render_template
+
+from app import app
+from delivery import page_key, write_compressed
+
+
+BUILD_DIR = "build"
+PRECOMPRESSED_DIR = os.path.join(BUILD_DIR, "precompressed")
+FROZEN_DIR = os.path.join(BUILD_DIR, "site")
+
+# generated artefacts (folium maps, exported notebooks, pandas profiling reports),
+# template folder -> names accepted by the show_* routes
+GENERATED_PAGES = {
+    "immobilier/maps": ["map_departement_folium"],
+    "immobilier/notebooks": ["Immobilier_EDA_1"],
+    "immobilier/data_exploration": ["DVF_2019_raport_initial"],
+    "climat/notebooks": ["traitement_donnees", "clusterisation"],
+}
+
+# values to render for the routes that take url or query arguments, endpoint -> list of arguments
+ROUTE_ARGUMENTS = {
+    "immo_show_map": [{"map_name": name} for name in GENERATED_PAGES["immobilier/maps"]],
+    "immo_show_notebook": [{"notebook": name} for name in GENERATED_PAGES["immobilier/notebooks"]],
+    "immo_pandas_profiling": [{"report": "DVF_2019_raport_initial", "height": 17560}],
+    "immo_show_pandas_profiling": [{"report_name": name} for name in GENERATED_PAGES["immobilier/data_exploration"]],
+    "cl_show_notebook": [{"notebook": name} for name in GENERATED_PAGES["climat/notebooks"]],
+}
+# steps run by the command line, in this order
+BUILD_STEPS = ["precompress", "freeze"]
+# urls depending on the request or on live state, never frozen
+DYNAMIC_PREFIXES = ("/api/", "/health/", "/static/", "/metrics")
+# only text is worth compressing, images are already compressed
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+def precompress_generated_pages(destination: str=PRECOMPRESSED_DIR) -> dict:
+    '''Render each generated page once through jinja, as the routes do, and save it compressed'''
+    manifest = {}
+    with app.test_request_context():
+        for folder, names in GENERATED_PAGES.items():
+            os.makedirs(os.path.join(destination, folder), exist_ok=True)
+            for name in names:
+                template = f"{folder}/{name}.html"
+                body = render_template(template).encode("utf-8")
+                sizes = write_compressed(os.path.join(destination, template), body)
+                manifest[template] = {"sha256": hashlib.sha256(body).hexdigest(),
+                                      "size": len(body), "encodings": sizes}
+                print(f"{template}: {len(body)} bytes, " + ", ".join(f"{encoding} {size}" for encoding, size in sizes.items()))
+    with open(os.path.join(destination, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def frozen_urls() -> list:
+    '''Every GET url of the app without form nor live state, with the known values of their arguments'''
+    urls = []
+    for rule in app.url_map.iter_rules():
+        if "GET" not in rule.methods or "POST" in rule.methods or rule.rule.startswith(DYNAMIC_PREFIXES):
+            continue
+        for arguments in ROUTE_ARGUMENTS.get(rule.endpoint, [{}]):
+            path_values = {key: value for key, value in arguments.items() if key in rule.arguments}
+            if set(path_values) != rule.arguments:
+                continue
+            _, path = rule.build(path_values)
+            query = urlencode({key: value for key, value in arguments.items() if key not in rule.arguments})
+            urls.append(f"{path}?{query}" if query else path)
+    return urls
+
+
+def add_to_site(manifest: dict, destination: str, key: str, body: bytes, mimetype: str) -> None:
+    '''Store body under its content hash and register it in the manifest'''
+    sha256 = hashlib.sha256(body).hexdigest()
+    extension = mimetypes.guess_extension(mimetype) or ""
+    file_name = sha256[:16] + extension
+    if mimetype.startswith(COMPRESSIBLE_TYPES):
+        sizes = write_compressed(os.path.join(destination, file_name), body)
+    else:
+        with open(os.path.join(destination, file_name), "wb") as file:
+            file.write(body)
+        sizes = {}
+    manifest[key] = {"file": file_name, "sha256": sha256, "size": len(body),
+                     "mimetype": mimetype, "encodings": sizes}
+
+
+def freeze_site(destination: str=FROZEN_DIR) -> dict:
+    '''Render every static route (and copy the static folder) into destination with hashed file names,
+    the manifest maps each url to its file so the app (or any web server) can serve it without jinja'''
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    os.makedirs(destination)
+    manifest = {}
+    # render through the views, not from a previous build
+    app.config["SERVE_FROZEN_SITE"] = False
+    client = app.test_client()
+    for url in frozen_urls():
+        response = client.get(url)
+        if response.status_code != 200:
+            print(f"skipped {url}: status {response.status_code}")
+            continue
+        split = urlsplit(url)
+        key = page_key(split.path, parse_qsl(split.query))
+        add_to_site(manifest, destination, key, response.get_data(), response.mimetype)
+        response.close()
+        print(f"{url} -> {manifest[key]['file']}")
+
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            url = app.static_url_path + "/" + os.path.relpath(path, app.static_folder).replace(os.sep, "/")
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            with open(path, "rb") as file:
+                add_to_site(manifest, destination, url, file.read(), mimetype)
+
+    with open(os.path.join(destination, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prebuild the static part of the site")
+    # no choices: argparse checks the empty list of a nargs="*" positional against them and rejects it
+    parser.add_argument("steps", nargs="*", metavar="step", help=f"{' and/or '.join(BUILD_STEPS)}, all when none is given")
+    args = parser.parse_args()
+    unknown = [step for step in args.steps if step not in BUILD_STEPS]
+    if unknown:
+        parser.error(f"invalid step: {', '.join(unknown)} (choose from {', '.join(BUILD_STEPS)})")
+    steps = args.steps or BUILD_STEPS
+    if "precompress" in steps:
+        precompress_generated_pages()
+    if "freeze" in steps:
+        freeze_site()
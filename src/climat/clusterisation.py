@@ -4,16 +4,23 @@ from sklearn.cluster import KMeans
 from sklearn.metrics import silhouette_score
 from functools import reduce
 
+from src.common.datastore import read_table
+from src.common.profiling import checkpoint, profiled, stage
+from src.climat.traitement_donnees import STORE_DIR
+
 
 class ClustersHandler:
+    @profiled("ClustersHandler.__init__")
     def __init__(self, df: pd.DataFrame, df_stations: pd.DataFrame, country:str=None, weights:dict=None):
         if country is not None:
             df_stations = df_stations[df_stations["COUNTRY"] == country]
         self.df = pd.merge(left=df, right=df_stations, how="right", left_on="STATION", right_on="STATION")
+        checkpoint("merge_stations", self.df)
 
         self._normalise()
         if weights is not None:
             self._apply_weights(weights)
+        checkpoint("normalise", self.df)
 
         normalised_df_stations = self.df[["STATION", "COUNTRY", "NAME", "LATITUDE", "LONGITUDE", "ELEVATION"]].drop_duplicates("STATION")
         # effacement pour l'aggregation des stats par mois sinon latitude longitude etc seront mensualises
@@ -23,8 +30,10 @@ class ClustersHandler:
         self.df = self.df.groupby([self.df["STATION"], self.df["DATE"].dt.month.rename("MONTH")]).mean()
         self.df = self.df.unstack(level=1)
         self.df = self.df.dropna()
+        checkpoint("monthly_means", self.df)
         # refusion avec les donnes stations dont lat long elevation normalise
         self.df = pd.merge(left=self.df, right=normalised_df_stations, how="inner", left_on="STATION", right_on="STATION")
+        checkpoint("merge_normalised_stations", self.df)
 
         self._k_scores = None
 
@@ -38,6 +47,7 @@ class ClustersHandler:
         for col_name, weight in weights.items():
             self.df[col_name] = self.df[col_name] * weight
 
+    @profiled("get_clusters")
     def get_clusters(self, clusters_name: str, list_columns: list, k_clusters_min: int=2, k_clusters_max: int=10) -> pd.DataFrame:
         '''list_columns: nom des colonnes de niveau 1 dans la hiérarchie, le niveau 2 étant le numéro du mois
         retourne un dataframe contenant les résultats des clusterisations'''
@@ -55,16 +65,20 @@ class ClustersHandler:
         k_range = range(k_clusters_min, k_clusters_max + 1)
         k_scores = {"K": list(k_range), f"{clusters_name}_inertia": [], f"{clusters_name}_silhouette": []}
         # plusieurs clusterisations en variant le K et ajout des résultats dans le df_results
+        df_columns = self.df[list_columns_final]
         for k in k_range:
-            K_means = KMeans(k, random_state=0).fit(self.df[list_columns_final])  
-            print(self.df[list_columns_final])     
+            with stage("kmeans", df_columns) as profile:
+                K_means = KMeans(k, random_state=0).fit(df_columns)
+                profile.output(K_means.labels_)
+            print(df_columns)
             name_colonne = k
             df_results.loc[:,name_colonne] = K_means.labels_ + 1
 
             # Sum of squared distances of samples to their closest cluster center
             k_scores[f"{clusters_name}_inertia"].append(K_means.inertia_)
             # Silhouete_score
-            k_scores[f"{clusters_name}_silhouette"].append(silhouette_score(self.df[list_columns_final], K_means.labels_))
+            with stage("silhouette_score", df_columns):
+                k_scores[f"{clusters_name}_silhouette"].append(silhouette_score(df_columns, K_means.labels_))
         # sauvegarde des scores en tant que membre de la classe et retour des clusterisations en output
         # si des scores sont deja présent (créer durant la même session de clusterisation à partir de la même 
         # instance de la classe ClusterHandler), on les réunit
@@ -79,9 +93,23 @@ class ClustersHandler:
         return self._k_scores
 
 
+# every ClimatFACT column but the YEAR partition
+CLIMAT_FACT_COLUMNS = ["DATE", "STATION", "TEMP", "MAX", "MIN", "DEWP", "WDSP", "MXSPD", "SNDP", "PRCP",
+                       "FOG", "RAIN", "SNOW", "HAIL", "THUN"]
+
+
+def read_country(country: str) -> tuple:
+    '''Stations of a country and their facts only, the country partition and the row groups
+    of the other stations are not read'''
+    df_stations = read_table(f"{STORE_DIR}/StationDIM", filters=[("COUNTRY", "=", country)])
+    df_stations["COUNTRY"] = df_stations["COUNTRY"].astype(str)
+    df = read_table(f"{STORE_DIR}/ClimatFACT", columns=CLIMAT_FACT_COLUMNS,
+                    filters=[("STATION", "in", df_stations["STATION"].tolist())])
+    return df, df_stations
+
+
 def create_clusters():
-    df = pd.read_csv("data/climat/clean_for_bi/ClimatFACT.csv")
-    df_stations = pd.read_csv("data/climat/clean_for_bi/StationDIM.csv")
+    df, df_stations = read_country("France")
 
     clustering = ClustersHandler(df, df_stations, "France")
 
@@ -114,8 +142,7 @@ def create_clusters():
 
 
 def create_optimal_cluster():
-    df = pd.read_csv("data/climat/clean_for_bi/ClimatFACT.csv")
-    df_stations = pd.read_csv("data/climat/clean_for_bi/StationDIM.csv")
+    df, df_stations = read_country("France")
 
     weights = {"TEMP":3, "MIN":2.5, "MAX":2.5, "DEWP":2, "WDSP":1.5, "MXSPD":1.5, 
                 "FOG":1, "RAIN":2, "SNOW":1, "HAIL":1, "THUN":1.5, "ELEVATION":1, "LATITUDE":1, "LONGITUDE":1}
@@ -0,0 +1,280 @@
+import collections
+import gzip
+import io
+import os
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.common.datastore import PartitionWriter
+from src.common.parallel import pack, unpack, workers_for
+from src.common.profiling import profiled
+
+
+# daily GSOD records of every station, one partition per year (YEAR=...), as in the NOAA files:
+# sentinels (9999.9, 999.9, 99.99) and flags kept, decoded by the readers (see traitement_donnees.py)
+DAILY_TABLE = "GSODDaily"
+# columns of the per station csv files of the yearly {year}.tar.gz archives
+GSOD_COLUMNS = ["STATION", "DATE", "LATITUDE", "LONGITUDE", "ELEVATION", "NAME", "TEMP", "TEMP_ATTRIBUTES", "DEWP",
+                "DEWP_ATTRIBUTES", "SLP", "SLP_ATTRIBUTES", "STP", "STP_ATTRIBUTES", "VISIB", "VISIB_ATTRIBUTES", "WDSP",
+                "WDSP_ATTRIBUTES", "MXSPD", "GUST", "MAX", "MAX_ATTRIBUTES", "MIN", "MIN_ATTRIBUTES", "PRCP",
+                "PRCP_ATTRIBUTES", "SNDP", "FRSHTT"]
+MEASURE_COLUMNS = ["TEMP", "DEWP", "SLP", "STP", "VISIB", "WDSP", "MXSPD", "GUST", "MAX", "MIN", "PRCP", "SNDP"]
+# number of observations of the daily means
+COUNT_COLUMNS = ["TEMP_ATTRIBUTES", "DEWP_ATTRIBUTES", "SLP_ATTRIBUTES", "STP_ATTRIBUTES", "VISIB_ATTRIBUTES",
+                 "WDSP_ATTRIBUTES"]
+# flags: "*" for a MAX/MIN taken from the hourly data, letter of the PRCP report, FRSHTT kept as its 6 digits
+FLAG_COLUMNS = ["MAX_ATTRIBUTES", "MIN_ATTRIBUTES", "PRCP_ATTRIBUTES", "FRSHTT"]
+DAILY_SCHEMA = pa.schema(
+    [("STATION", pa.int64()), ("DATE", pa.date32()), ("LATITUDE", pa.float32()), ("LONGITUDE", pa.float32()),
+     ("ELEVATION", pa.float32()), ("NAME", pa.string())]
+    + [(column, pa.float32()) if column in MEASURE_COLUMNS else
+       (column, pa.int8()) if column in COUNT_COLUMNS else (column, pa.string())
+       for column in GSOD_COLUMNS[6:]])
+CSV_DTYPES = {"STATION": np.int64, "DATE": str, "LATITUDE": np.float32, "LONGITUDE": np.float32,
+              "ELEVATION": np.float32, "NAME": str, **{column: np.float32 for column in MEASURE_COLUMNS},
+              **{column: np.int8 for column in COUNT_COLUMNS}, **{column: str for column in FLAG_COLUMNS}}
+
+# fields of the fixed width .op records of the gsod_{year}.tar archives (before 2020), separated by spaces:
+# the value and number of observations of the means, MAX/MIN followed by their "*" flag, PRCP by its letter
+OP_COLUMNS = ["STN", "WBAN", "YEARMODA", "TEMP", "TEMP_ATTRIBUTES", "DEWP", "DEWP_ATTRIBUTES", "SLP", "SLP_ATTRIBUTES",
+              "STP", "STP_ATTRIBUTES", "VISIB", "VISIB_ATTRIBUTES", "WDSP", "WDSP_ATTRIBUTES", "MXSPD", "GUST", "MAX",
+              "MIN", "PRCP", "SNDP", "FRSHTT"]
+OP_DTYPES = {"STN": str, "WBAN": str, "YEARMODA": str, "MAX": str, "MIN": str, "PRCP": str, "FRSHTT": str,
+             **{column: np.float32 for column in MEASURE_COLUMNS if column not in ("MAX", "MIN", "PRCP")},
+             **{column: np.int8 for column in COUNT_COLUMNS}}
+
+# columns of the csv files read by process_a_year and their types: straight to float32, station names and dates
+# as categories (parsed once per distinct value), FRSHTT as the integer of its 6 digits
+DAILY_DTYPES = {"STATION": np.int64, "DATE": "category", "LATITUDE": np.float32, "LONGITUDE": np.float32,
+                "ELEVATION": np.float32, "NAME": "category", "TEMP": np.float32, "MAX": np.float32, "MIN": np.float32,
+                "DEWP": np.float32, "WDSP": np.float32, "MXSPD": np.float32, "PRCP": np.float32, "SNDP": np.float32,
+                "FRSHTT": np.int32}
+# value of the missing measures -> value used instead (missing snow depth and precipitation count as none)
+SENTINELS = {"TEMP": (9999.9, np.nan), "MAX": (9999.9, np.nan), "MIN": (9999.9, np.nan), "DEWP": (9999.9, np.nan),
+             "WDSP": (999.9, np.nan), "MXSPD": (999.9, np.nan), "SNDP": (999.9, 0), "PRCP": (99.99, 0)}
+# digits of FRSHTT, bit 5 to bit 0 of the packed flags
+FRSHTT_FLAGS = ["FOG", "RAIN", "SNOW", "HAIL", "THUN", "TORN"]
+
+# decompressed bytes of members parsed together, memory of a batch: a few times this size
+BATCH_BYTES = 32 * 2 ** 20
+ROW_GROUP_SIZE = 1000000
+
+
+def archive_path(folderPath: str, year: int) -> str:
+    '''{year}.tar.gz (csv members) or the older gsod_{year}.tar (gzipped fixed width .op members)'''
+    for name in (f"{year}.tar.gz", f"gsod_{year}.tar"):
+        if os.path.isfile(os.path.join(folderPath, name)):
+            return os.path.join(folderPath, name)
+    raise FileNotFoundError(f"no GSOD archive of {year} in {folderPath}")
+
+
+def iter_members(path: str) -> tuple:
+    '''(kind "csv" or "op", contents) of the station files of an archive, read as a stream: one pass over the
+    archive, the members are decompressed in memory and nothing is extracted to disk'''
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            name = member.name[:-3] if member.name.endswith(".gz") else member.name
+            if not name.endswith((".csv", ".op")):
+                continue
+            data = archive.extractfile(member).read()
+            if member.name.endswith(".gz"):
+                data = gzip.decompress(data)
+            yield name.rpartition(".")[2], data
+
+
+def iter_batches(path: str, batch_bytes: int=BATCH_BYTES) -> tuple:
+    '''(kind, [contents, ...]) of the members of an archive grouped by batch_bytes'''
+    kind, batch, size = None, [], 0
+    for member_kind, data in iter_members(path):
+        if batch and (size >= batch_bytes or member_kind != kind):
+            yield kind, batch
+            batch, size = [], 0
+        kind = member_kind
+        batch.append(data)
+        size += len(data)
+    if batch:
+        yield kind, batch
+
+
+def _records(members: list) -> io.BytesIO:
+    '''The lines of several station files without their header line, one buffer parsed at once'''
+    buffer = io.BytesIO()
+    for data in members:
+        start = data.find(b"\n") + 1
+        if start == 0:
+            continue
+        buffer.write(data[start:])
+        if not data.endswith(b"\n"):
+            buffer.write(b"\n")
+    buffer.seek(0)
+    return buffer
+
+
+def parse_csv_members(members: list) -> pd.DataFrame:
+    df = pd.read_csv(_records(members), names=GSOD_COLUMNS, dtype=CSV_DTYPES, keep_default_na=False,
+                     na_values={column: [""] for column in ("LATITUDE", "LONGITUDE", "ELEVATION")})
+    df["DATE"] = pd.to_datetime(df["DATE"], format="%Y-%m-%d")
+    return df
+
+
+def parse_op_members(members: list) -> pd.DataFrame:
+    '''Fixed width records in the columns of the csv files, without the station name and position
+    (see ingest_year)'''
+    df = pd.read_csv(_records(members), delim_whitespace=True, names=OP_COLUMNS, dtype=OP_DTYPES)
+    records = pd.DataFrame({"STATION": (df["STN"] + df["WBAN"].str.zfill(5)).astype(np.int64),
+                            "DATE": pd.to_datetime(df["YEARMODA"], format="%Y%m%d"),
+                            "LATITUDE": np.float32(np.nan), "LONGITUDE": np.float32(np.nan),
+                            "ELEVATION": np.float32(np.nan), "NAME": None})
+    for column in GSOD_COLUMNS[6:]:
+        if column in df.columns and column not in ("MAX", "MIN", "PRCP"):
+            records[column] = df[column]
+    for column in ("MAX", "MIN"):
+        records[column] = df[column].str.rstrip("*").astype(np.float32)
+        records[f"{column}_ATTRIBUTES"] = np.where(df[column].str.endswith("*"), "*", " ")
+    values = df["PRCP"].str.rstrip("ABCDEFGHI")
+    records["PRCP"] = values.astype(np.float32)
+    records["PRCP_ATTRIBUTES"] = df["PRCP"].str[-1].where(df["PRCP"].str.len() > values.str.len(), " ")
+    return records[GSOD_COLUMNS]
+
+
+PARSERS = {"csv": parse_csv_members, "op": parse_op_members}
+
+
+def _split_categories(codes: np.ndarray, values: pd.Index) -> pd.Categorical:
+    '''Categorical of values[codes], values possibly repeated or missing'''
+    new_codes, categories = pd.factorize(values)
+    return pd.Categorical.from_codes(np.where(codes >= 0, new_codes[codes], -1), categories)
+
+
+def pack_frshtt(frshtt: np.ndarray) -> np.ndarray:
+    '''FRSHTT read as an integer (010000: rain) -> one byte, FOG on bit 5 to TORN on bit 0'''
+    packed = np.zeros(len(frshtt), dtype=np.uint8)
+    for position in range(len(FRSHTT_FLAGS)):
+        packed |= ((frshtt // 10 ** position % 10 != 0) << position).astype(np.uint8)
+    return packed
+
+
+def frshtt_flag(packed: np.ndarray, flag: str) -> np.ndarray:
+    '''0/1 int8 of one flag of the packed FRSHTT'''
+    return (packed >> (len(FRSHTT_FLAGS) - 1 - FRSHTT_FLAGS.index(flag)) & 1).astype(np.int8)
+
+
+def parse_daily_members(members: list) -> pd.DataFrame:
+    '''Typed daily records of csv station files, the columns of DAILY_DTYPES: rows with a missing field left out,
+    sentinels replaced (SENTINELS), NAME split into NAME and COUNTRY (FIPS code) categories, FRSHTT packed
+    (pack_frshtt). The string work is done on the distinct names and dates only'''
+    df = pd.read_csv(_records(members), names=GSOD_COLUMNS, usecols=list(DAILY_DTYPES), dtype=DAILY_DTYPES)
+    df = df[list(DAILY_DTYPES)].dropna()
+    dates = pd.to_datetime(df["DATE"].cat.categories, format="%Y-%m-%d")
+    df["DATE"] = dates.values[df["DATE"].cat.codes.to_numpy()]
+    codes = df["NAME"].cat.codes.to_numpy()
+    parts = df["NAME"].cat.categories.str.split(", ", n=1)
+    df["NAME"] = _split_categories(codes, pd.Index(parts.str[0]))
+    df.insert(df.columns.get_loc("NAME") + 1, "COUNTRY", _split_categories(codes, pd.Index(parts.str[1])))
+    # every sentinel in one pass over the measures, compared as float32 like the values
+    values = df[list(SENTINELS)].to_numpy()
+    sentinels = np.array([sentinel for sentinel, _ in SENTINELS.values()], dtype=np.float32)
+    replacements = np.array([replacement for _, replacement in SENTINELS.values()], dtype=np.float32)
+    df[list(SENTINELS)] = np.where(values == sentinels, replacements, values)
+    df["FRSHTT"] = pack_frshtt(df["FRSHTT"].to_numpy())
+    return df.reset_index(drop=True)
+
+
+def concat_daily(frames: list) -> pd.DataFrame:
+    '''Batches of parse_daily_members as one frame, categories merged'''
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    for column in ("NAME", "COUNTRY"):
+        categories = pd.api.types.union_categoricals([frame[column] for frame in frames]).categories
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def parse_members(kind: str, members: list, typed: bool=False) -> pd.DataFrame:
+    '''typed: parse_daily_members, for csv members only'''
+    if typed:
+        if kind != "csv":
+            raise ValueError("the .op records have no station name nor position, load them with ingest_year")
+        return parse_daily_members(members)
+    return PARSERS[kind](members)
+
+
+def _packed_parse(kind: str, members: list, typed: bool):
+    return pack(parse_members(kind, members, typed))
+
+
+def read_isd_history(path: str) -> pd.DataFrame:
+    '''Name ("NAME, FIPS country code" as in the csv files), position and elevation of the stations indexed by
+    STATION, from the NOAA isd-history.csv, for the .op records which have none'''
+    df = pd.read_csv(path, dtype={"USAF": str, "WBAN": str, "STATION NAME": str, "CTRY": str})
+    df = df[df["USAF"].str.isdigit()]
+    stations = pd.DataFrame({"STATION": (df["USAF"] + df["WBAN"].str.zfill(5)).astype(np.int64),
+                             "NAME": df["STATION NAME"].fillna("") + ", " + df["CTRY"].fillna(""),
+                             "LATITUDE": df["LAT"].astype(np.float32), "LONGITUDE": df["LON"].astype(np.float32),
+                             "ELEVATION": df["ELEV(M)"].astype(np.float32)})
+    return stations.drop_duplicates("STATION", keep="last").set_index("STATION")
+
+
+def add_stations(df: pd.DataFrame, stations: pd.DataFrame) -> pd.DataFrame:
+    known = df["STATION"].isin(stations.index)
+    for column in ("NAME", "LATITUDE", "LONGITUDE", "ELEVATION"):
+        df.loc[known, column] = stations.loc[df.loc[known, "STATION"], column].to_numpy()
+    return df
+
+
+def parsed_batches(path: str, workers: int=1, batch_bytes: int=BATCH_BYTES, typed: bool=False):
+    '''DataFrames of the batches of members of an archive, in the order of the archive. The archive is read by
+    this process while workers > 1 processes (None for every core) parse the batches, at most two batches
+    per worker are waiting so the memory stays bounded whatever the size of the archive.
+    typed: parse_daily_members instead of the columns of the files'''
+    workers = workers_for(workers, 0)
+    if workers == 1:
+        for kind, members in iter_batches(path, batch_bytes):
+            yield parse_members(kind, members, typed)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for kind, members in iter_batches(path, batch_bytes):
+            pending.append(pool.submit(_packed_parse, kind, members, typed))
+            if len(pending) >= 2 * workers:
+                yield unpack(pending.popleft().result())
+        while pending:
+            yield unpack(pending.popleft().result())
+
+
+def read_daily(folderPath: str, year: int, workers: int=1) -> pd.DataFrame:
+    '''Typed daily records of a yearly archive (parse_daily_members), read as a stream'''
+    return concat_daily(list(parsed_batches(archive_path(folderPath, year), workers, typed=True)))
+
+
+@profiled("ingest_year")
+def ingest_year(folderPath: str, year: int, storePath: str, workers: int=1, stations: pd.DataFrame=None,
+                row_group_size: int=ROW_GROUP_SIZE) -> int:
+    '''Write the daily records of a yearly archive to the YEAR={year} partition of the GSODDaily table of storePath
+    in row groups of row_group_size rows, straight from the compressed archive. stations: read_isd_history,
+    name and position of the stations of the .op records. Return the number of records'''
+    with PartitionWriter(os.path.join(storePath, DAILY_TABLE), "YEAR", year, DAILY_SCHEMA, row_group_size) as writer:
+        for df in parsed_batches(archive_path(folderPath, year), workers):
+            if stations is not None and df["NAME"].isna().any():
+                df = add_stations(df, stations)
+            writer.write(df)
+    return writer.written
+
+
+def ingest_years(folderPath: str, begin_year: int, end_year: int, storePath: str, workers: int=None,
+                 stations_path: str=None) -> dict:
+    '''ingest_year for each year in turn, the members of a year are parsed by workers processes.
+    Return {year: number of records}'''
+    stations = read_isd_history(stations_path) if stations_path is not None else None
+    return {year: ingest_year(folderPath, year, storePath, workers, stations) for year in range(begin_year, end_year + 1)}
+
+
+if __name__ == "__main__":
+    from src.climat.traitement_donnees import STORE_DIR
+
+    print(ingest_years("data/climat/daily_raw", 2000, 2020, STORE_DIR))
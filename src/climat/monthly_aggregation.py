@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+
+# monthly statistics of the daily measures, in the order of the columns of the monthly table
+MEANS = ["TEMP", "DEWP", "WDSP"]
+MAXIMUMS = ["MAX", "MXSPD"]
+MINIMUMS = ["MIN"]
+SUMS = ["SNDP", "PRCP"]
+FLAGS = ["FOG", "RAIN", "SNOW", "HAIL", "THUN"]
+# station description, the last value of the month is kept
+LAST_VALUES = ["NAME", "COUNTRY", "LATITUDE", "LONGITUDE", "ELEVATION"]
+MONTHLY_COLUMNS = ["DATE", "STATION", "NAME", "COUNTRY", "LATITUDE", "LONGITUDE", "ELEVATION", "DAYS_WITH_MEASURES",
+                   "TEMP", "MAX", "MIN", "DEWP", "WDSP", "MXSPD", "SNDP", "PRCP"] + FLAGS
+
+
+class StationMonthAccumulator:
+    '''Monthly statistics of each station of one year, fed with the daily rows chunk by chunk: running count and
+    sum (float64) of the means, max, min, sums and flag counts, and the last description of the station, in arrays
+    of one row per station and one column per month. Memory grows with the number of stations, not with the
+    number of daily rows. monthly() gives the table of
+        df.groupby([df["DATE"].dt.to_period("m"), df["STATION"]]).agg(NAME=("NAME", "last"), ...,
+            DAYS_WITH_MEASURES=("TEMP", "count"), TEMP=("TEMP", "mean"), MAX=("MAX", "max"), ...)
+    over every row added, the means summed in float64 instead of float32'''
+    def __init__(self, year: int, capacity: int=1024):
+        self.year = year
+        self.stations = pd.Index([], dtype=np.int64)
+        self.capacity = 0
+        self.arrays = {}
+        self._grow(capacity)
+
+    def _grow(self, capacity: int) -> None:
+        '''Arrays of capacity stations x 12 months, the values of the stations already seen kept'''
+        initial = {"rows": 0, **{f"count_{column}": 0 for column in MEANS}, **{f"sum_{column}": 0.0 for column in MEANS},
+                   **{column: np.nan for column in MAXIMUMS + MINIMUMS}, **{column: 0.0 for column in SUMS},
+                   **{column: 0 for column in FLAGS}, **{column: np.nan for column in LAST_VALUES[2:]}}
+        dtypes = {"rows": np.int64, **{f"count_{column}": np.int64 for column in MEANS},
+                  **{column: np.int64 for column in FLAGS}, **{column: np.float32 for column in MAXIMUMS + MINIMUMS},
+                  **{column: np.float32 for column in LAST_VALUES[2:]}}
+        arrays = {name: np.full((capacity, 12), value, dtype=dtypes.get(name, np.float64))
+                  for name, value in initial.items()}
+        arrays.update({column: np.full((capacity, 12), None, dtype=object) for column in LAST_VALUES[:2]})
+        for name, array in self.arrays.items():
+            arrays[name][:self.capacity] = array
+        self.arrays, self.capacity = arrays, capacity
+
+    def _station_rows(self, stations: np.ndarray) -> np.ndarray:
+        '''Row of each station, the new stations appended'''
+        rows = self.stations.get_indexer(stations)
+        if (rows < 0).any():
+            self.stations = self.stations.append(pd.Index(pd.unique(stations[rows < 0])))
+            if len(self.stations) > self.capacity:
+                self._grow(max(2 * self.capacity, len(self.stations)))
+            rows = self.stations.get_indexer(stations)
+        return rows
+
+    def add(self, df: pd.DataFrame) -> None:
+        '''Add daily rows: DATE, STATION, the LAST_VALUES and the measures, flags as 0/1 columns.
+        The rows of a station must come in the order of the daily file for the last values'''
+        if not len(df):
+            return
+        dates = pd.DatetimeIndex(df["DATE"])
+        if (dates.year != self.year).any():
+            raise ValueError(f"rows of another year than {self.year}")
+        cells = self._station_rows(df["STATION"].to_numpy()) * 12 + (dates.month.to_numpy() - 1)
+        # rows sorted by cell, file order kept inside a cell: one slice per station month of the chunk
+        order = np.argsort(cells, kind="stable")
+        sorted_cells = cells[order]
+        starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        chunk_cells = sorted_cells[starts]
+        codes = np.repeat(np.arange(len(starts)), ends - starts)
+
+        def total(values: np.ndarray) -> np.ndarray:
+            return np.bincount(codes, weights=values, minlength=len(starts))
+
+        arrays = {name: array.reshape(-1) for name, array in self.arrays.items()}
+        arrays["rows"][chunk_cells] += ends - starts
+        for column in MEANS:
+            values = df[column].to_numpy(dtype=np.float64)[order]
+            present = ~np.isnan(values)
+            arrays[f"count_{column}"][chunk_cells] += total(present).astype(np.int64)
+            arrays[f"sum_{column}"][chunk_cells] += total(np.where(present, values, 0))
+        for columns, reduce in ((MAXIMUMS, np.fmax), (MINIMUMS, np.fmin)):
+            for column in columns:
+                # fmax/fmin skip NaN, a month without any value stays NaN
+                arrays[column][chunk_cells] = reduce(arrays[column][chunk_cells],
+                                                     reduce.reduceat(df[column].to_numpy()[order], starts))
+        for column in SUMS + FLAGS:
+            sums = total(df[column].to_numpy(dtype=np.float64)[order])
+            arrays[column][chunk_cells] += sums.astype(arrays[column].dtype)
+        last_rows = order[ends - 1]
+        for column in LAST_VALUES:
+            arrays[column][chunk_cells] = np.asarray(df[column].to_numpy()[last_rows], dtype=arrays[column].dtype)
+
+    def monthly(self) -> pd.DataFrame:
+        '''One row per station and month with rows, sorted by month and station (MONTHLY_COLUMNS)'''
+        arrays = {name: array[:len(self.stations)] for name, array in self.arrays.items()}
+        station_rows, months = np.nonzero(arrays["rows"] > 0)
+        stations = self.stations.to_numpy()[station_rows]
+        order = np.lexsort((stations, months))
+        station_rows, months, stations = station_rows[order], months[order], stations[order]
+        table = {"DATE": pd.period_range(f"{self.year}-01", periods=12, freq="M")[months], "STATION": stations}
+        for column in LAST_VALUES + MAXIMUMS + MINIMUMS + FLAGS:
+            table[column] = arrays[column][station_rows, months]
+        table["DAYS_WITH_MEASURES"] = arrays["count_TEMP"][station_rows, months]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for column in MEANS:
+                table[column] = (arrays[f"sum_{column}"][station_rows, months]
+                                 / arrays[f"count_{column}"][station_rows, months]).astype(np.float32)
+        for column in SUMS:
+            table[column] = arrays[column][station_rows, months].astype(np.float32)
+        return pd.DataFrame(table, columns=MONTHLY_COLUMNS)
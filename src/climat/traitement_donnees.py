@@ -4,52 +4,37 @@ import json
 import gzip
 import tarfile
 import glob
-import tracemalloc
+import os
 
+from src.climat.gsod_ingest import BATCH_BYTES, archive_path, frshtt_flag, parsed_batches
+from src.climat.monthly_aggregation import StationMonthAccumulator
+from src.common.datastore import write_table
+from src.common.parallel import map_years
+from src.common.profiling import checkpoint, profiled, stage
 
-def process_a_year(folderPath:str, year:int) -> tuple:
-    # tracemalloc.start()
-    # current, peak = tracemalloc.get_traced_memory()
-    # print(f"Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
-
-    df = pd.read_csv(f"{folderPath}/{year}.tar.gz", compression='gzip')
-    df = df.rename({df.columns[0]: 'STATION'}, axis=1)
-    df = df[df["DATE"] != "DATE"]
-    df = df.dropna()
-
-    # current, peak = tracemalloc.get_traced_memory()
-    # print(f"Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
-    # tracemalloc.stop()
-
-    # type conversion
-    float_columns = ["LATITUDE", "LONGITUDE", "ELEVATION", "TEMP", "MAX", "MIN", 
-                    "DEWP", "VISIB", "WDSP", "MXSPD", "PRCP", "SNDP"]
-    df[float_columns] = df[float_columns].astype(np.float32)
-    df["STATION"] = df["STATION"].astype(np.int64)
-    df["DATE"] = pd.to_datetime(df["DATE"])
 
-    country_listPath = "data/climat/country_list.json"
-    with open(country_listPath, 'rb') as file:
-        country_dict = json.load(file)
+# memory used to process a year, used to limit the number of parallel years: it no longer grows with the
+# archive, the parse of a batch of members takes about 3.5 times its size and the monthly arrays about 2 kB
+# per station (a few tens of MB for the 12000 stations of a full year)
+GSOD_YEAR_MEMORY = 4 * BATCH_BYTES + 64 * 2**20
 
-    # df["COUNTRY"] = df["NAME"].str[-2:]
-    df[["NAME", "COUNTRY"]] = df["NAME"].str.split(", ", n=2, expand=True)
+# typed columnar tables read by the clusterisation (see src.common.datastore)
+STORE_DIR = "data/climat/store"
+
+
+def prepare_daily(df: pd.DataFrame, country_dict: dict) -> pd.DataFrame:
+    '''Typed daily rows (see src.climat.gsod_ingest.parse_daily_members) of the stations kept, flags as 0/1
+    columns and measures in metric units'''
     df = df[df["COUNTRY"].isin([key for key in country_dict.keys()])]
-    df["COUNTRY"] = df["COUNTRY"].map(country_dict)
+    df["COUNTRY"] = df["COUNTRY"].cat.remove_unused_categories().map(country_dict)
     df = df[(df["LATITUDE"] > 35) & (df["LATITUDE"] < 72)]
     df = df[~((df["COUNTRY"] == "Portugal") & (df["LONGITUDE"] < -15))]
 
     #STP, SLP, GUST, VISIB missing to much values
     df = df[["DATE", "STATION", "COUNTRY", "LATITUDE", "LONGITUDE", "ELEVATION", "NAME", "TEMP", "MAX", "MIN",
             "DEWP", "WDSP", "MXSPD", "PRCP", "SNDP", "FRSHTT"]]
-            
-    df[["TEMP", "DEWP", "MAX", "MIN"]] = df[["TEMP", "DEWP", "MAX", "MIN"]].replace(9999.9, np.nan)
-    df[["WDSP", "MXSPD"]] = df[["WDSP", "MXSPD"]].replace(999.9, np.nan)
-    df["SNDP"] = df["SNDP"].replace(999.9, 0)
-    df["PRCP"] = df["PRCP"].replace(99.9, 0)
-    df[["FOG", "RAIN", "SNOW", "HAIL", "THUN", "TORN"]] = df["FRSHTT"].str.extract(r"(.)(.)(.)(.)(.)(.)")
-    df[["FOG", "RAIN", "SNOW", "HAIL", "THUN", "TORN"]] = df[["FOG", "RAIN", "SNOW", "HAIL", "THUN", "TORN"]].astype(np.int8)
-    df = df.drop("TORN", axis=1)
+    for flag in ["FOG", "RAIN", "SNOW", "HAIL", "THUN"]:
+        df[flag] = frshtt_flag(df["FRSHTT"].to_numpy(), flag)
 
     # conversion Fahrenheit en Celsius, DWEP = point de rose
     df[["TEMP", "MAX", "MIN", "DEWP"]] = (df[["TEMP", "MAX", "MIN", "DEWP"]] -32) * 5/9
@@ -59,17 +44,31 @@ def process_a_year(folderPath:str, year:int) -> tuple:
     df["SNDP"] = df["SNDP"] * 2.54
     # inche and hundredths en millimetre
     df["PRCP"] = df["PRCP"] * 0.254
+    return df
 
-    # group by month: [df["DATE"].dt.to_period('m')] or pd.Grouper(key="DATE", freq="M")
-    # aggregation
-    df = df.groupby([df["DATE"].dt.to_period('m'), df["STATION"]]).agg(        
-        NAME=("NAME","last"), COUNTRY=("COUNTRY","last"), 
-        LATITUDE=("LATITUDE","last"), LONGITUDE=("LONGITUDE","last"), 
-        ELEVATION=("ELEVATION","last"), DAYS_WITH_MEASURES=('TEMP','count'), TEMP=('TEMP','mean'), 
-        MAX=("MAX",'max'), MIN=("MIN",'min'), DEWP=("DEWP",'mean'), WDSP=("WDSP",'mean'), 
-        MXSPD=("MXSPD",'max'), SNDP=("SNDP",'sum'), PRCP=("PRCP",'sum'), FOG=("FOG",'sum'), 
-        RAIN=("RAIN",'sum'), SNOW=("SNOW",'sum'), HAIL=("HAIL",'sum'), THUN=("THUN",'sum'))
-    df = df.reset_index()
+
+@profiled("process_a_year")
+def process_a_year(folderPath:str, year:int) -> tuple:
+    # stages profiled with ETL_PROFILE set, see src.common.profiling
+    country_listPath = "data/climat/country_list.json"
+    with open(country_listPath, 'rb') as file:
+        country_dict = json.load(file)
+
+    # the archive is read as a stream of batches of typed rows (float32 measures, sentinels replaced, NAME and
+    # COUNTRY categories, FRSHTT packed), each batch is added to the monthly statistics of its stations:
+    # the daily rows of the whole year are never in memory
+    accumulator = StationMonthAccumulator(year)
+    for df in parsed_batches(archive_path(folderPath, year), typed=True):
+        checkpoint("read_batch", df)
+        df = prepare_daily(df, country_dict)
+        checkpoint("prepare_daily", df)
+        accumulator.add(df)
+        checkpoint("accumulate")
+    # group by month
+    df = accumulator.monthly()
+    # back to strings on the monthly rows, grouping by categories would list every combination of them
+    df[["NAME", "COUNTRY"]] = df[["NAME", "COUNTRY"]].astype(object)
+    checkpoint("station_months", df)
     
     df = df.groupby([df["DATE"], df["NAME"], df["COUNTRY"]]).agg(        
         STATION=("STATION","last"), LATITUDE=("LATITUDE","last"), LONGITUDE=("LONGITUDE","last"), 
@@ -78,6 +77,7 @@ def process_a_year(folderPath:str, year:int) -> tuple:
         MXSPD=("MXSPD",'max'), SNDP=("SNDP",'mean'), PRCP=("PRCP",'mean'), FOG=("FOG",'mean'), 
         RAIN=("RAIN",'mean'), SNOW=("SNOW",'mean'), HAIL=("HAIL",'mean'), THUN=("THUN",'mean'))
     df = df.reset_index()
+    checkpoint("group_name_country", df)
     
     df = df.groupby([df["DATE"], df["LATITUDE"], df["LONGITUDE"]]).agg(        
         STATION=("STATION","last"), NAME=("NAME","last"), COUNTRY=("COUNTRY","last"), 
@@ -86,20 +86,28 @@ def process_a_year(folderPath:str, year:int) -> tuple:
         MXSPD=("MXSPD",'max'), SNDP=("SNDP",'mean'), PRCP=("PRCP",'mean'), FOG=("FOG",'mean'), 
         RAIN=("RAIN",'mean'), SNOW=("SNOW",'mean'), HAIL=("HAIL",'mean'), THUN=("THUN",'mean'))
     df = df.reset_index()
+    checkpoint("group_location", df)
 
     df_drop = df[df["DAYS_WITH_MEASURES"] < 25]
     df = df[df["DAYS_WITH_MEASURES"] >= 25]
     df = df.drop("DAYS_WITH_MEASURES", axis=1)
+    checkpoint("days_filter", df)
 
     return df
 
 
-def process_years(folderPath:str, begin_year:int, end_year:int, destinationPath:str):
-    df_list = []
-    for year in range(begin_year, end_year + 1):
-        df = process_a_year(folderPath, year)
-        df_list.append(df)
+@profiled("process_years")
+def process_years(folderPath:str, begin_year:int, end_year:int, destinationPath:str, workers:int=1,
+                  storePath:str=STORE_DIR):
+    '''workers: number of years processed in parallel processes (None for every core), lowered if memory is short.
+    ClimatFACT and StationDIM are exported as csv to destinationPath for the BI and written to storePath,
+    facts partitioned by year and sorted by station, stations partitioned by country'''
+    years = range(begin_year, end_year + 1)
+    with stage("map_years", bytes_in=sum(os.path.getsize(archive_path(folderPath, year)) for year in years)) as profile:
+        df_list = map_years(process_a_year, years, (folderPath,), workers, GSOD_YEAR_MEMORY)
+        profile.output(df_list)
     dfs = pd.concat(df_list, ignore_index=True)
+    checkpoint("concat", dfs)
 
     # on maj les valeurs d'identification sur l'ensemble des annees pour correspondre au données les plus récentes
     dfs[["NAME", "COUNTRY", "LATITUDE", "LONGITUDE", "ELEVATION"]] = dfs[["NAME", "COUNTRY", "STATION", 
@@ -110,6 +118,7 @@ def process_years(folderPath:str, begin_year:int, end_year:int, destinationPath:
     # sert dans le cas ou une station(même emplacement en LAT et LONG) a changé d'id STATION et de NAME
     dfs[["NAME", "COUNTRY", "STATION", "ELEVATION"]] = dfs[["NAME", "COUNTRY", "STATION", 
         "LATITUDE", "LONGITUDE", "ELEVATION"]].groupby(["LATITUDE", "LONGITUDE"]).transform('last')
+    checkpoint("identification", dfs)
 
     # nombre de mois avec des mesures par station
     months_with_measures = dict(dfs["STATION"].value_counts())
@@ -120,9 +129,18 @@ def process_years(folderPath:str, begin_year:int, end_year:int, destinationPath:
     dfs_geo_dim = dfs[["STATION", "NAME", "COUNTRY", "LATITUDE", "LONGITUDE", "ELEVATION"]].drop_duplicates("STATION")
     dfs_fact = dfs.drop(["NAME", "COUNTRY", "LATITUDE", "LONGITUDE", "ELEVATION",
         "MONTHS_WITH_MEASURES"], axis=1)
+    checkpoint("months_filter", [dfs_fact, dfs_geo_dim])
 
     dfs_fact.to_csv(f"{destinationPath}/ClimatFACT.csv", index=False)
     dfs_geo_dim.to_csv(f"{destinationPath}/StationDIM.csv", index=False)
+    checkpoint("export_csv", [dfs_fact, dfs_geo_dim])
+
+    dfs_fact = dfs_fact.assign(DATE=dfs_fact["DATE"].dt.to_timestamp())
+    dfs_fact["YEAR"] = dfs_fact["DATE"].dt.year.astype(np.int16)
+    write_table(dfs_fact.reset_index(drop=True), f"{storePath}/ClimatFACT", partition_cols=["YEAR"],
+                sort_by=["YEAR", "STATION", "DATE"])
+    write_table(dfs_geo_dim.reset_index(drop=True), f"{storePath}/StationDIM", partition_cols=["COUNTRY"])
+    checkpoint("write_store", [dfs_fact, dfs_geo_dim])
 
 
 if __name__ == "__main__":
@@ -132,4 +150,4 @@ if __name__ == "__main__":
     pd.set_option('display.max_rows', 100)
     pd.set_option('display.min_rows', 30)
 
-    process_years("data/climat/daily_raw", 2000, 2020, "data/climat/clean_for_bi")
+    process_years("data/climat/daily_raw", 2000, 2020, "data/climat/clean_for_bi", workers=None)
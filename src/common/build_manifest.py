@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+
+
+class BuildManifest:
+    '''Inputs of an incremental build: for each key (ex: a year), the input file it was built from and its sha256.
+    The build parameters are part of the manifest, when they change every key is out of date'''
+    def __init__(self, path: str, parameters: dict):
+        self.path = path
+        self.parameters = json.loads(json.dumps(parameters, sort_keys=True, default=str))
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                manifest = json.load(file)
+            if manifest.get("parameters") == self.parameters:
+                self.entries = manifest.get("entries", {})
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def is_current(self, key, input_path: str) -> bool:
+        '''True if key was built from the same content of input_path with the same parameters.
+        The file is only hashed when its size or mtime changed'''
+        entry = self.entries.get(str(key))
+        if entry is None or entry["file"] != input_path or not os.path.exists(input_path):
+            return False
+        stat = os.stat(input_path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        if entry["size"] != stat.st_size or entry["sha256"] != self.file_hash(input_path):
+            return False
+        # file touched but content unchanged, only remember the new mtime
+        entry["mtime"] = stat.st_mtime
+        return True
+
+    def record(self, key, input_path: str) -> None:
+        stat = os.stat(input_path)
+        self.entries[str(key)] = {"file": input_path, "size": stat.st_size, "mtime": stat.st_mtime,
+                                  "sha256": self.file_hash(input_path)}
+
+    def save(self) -> None:
+        # written next to the manifest then renamed, an interrupted build never leaves a partial manifest
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"parameters": self.parameters, "entries": self.entries}, file, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
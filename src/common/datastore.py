@@ -0,0 +1,139 @@
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def _keep_index(df: pd.DataFrame) -> bool:
+    # a default range index is not stored, read back tables get a new one
+    return not (isinstance(df.index, pd.RangeIndex) and df.index.name is None)
+
+
+def _select(table: pa.Table, columns: list) -> pa.Table:
+    '''Columns of a table in the given order, the pandas metadata (index, dtypes) is kept'''
+    schema = pa.schema([table.schema.field(name) for name in columns], metadata=table.schema.metadata)
+    return pa.Table.from_arrays([table.column(name) for name in columns], schema=schema)
+
+
+# typed columnar tables shared by the pipelines, instead of csv files re-parsed by every reader:
+# <path>/ is a parquet dataset (partitioned or not), <path>.arrow an optional uncompressed
+# arrow file for the memory mapped loading of the training scripts
+def write_table(df: pd.DataFrame, path: str, partition_cols: list=None, sort_by: list=None,
+                mmap_copy: bool=False, row_group_size: int=500000) -> None:
+    '''Replace the table stored at path by df (its index is kept, unless it is a default range index).
+    sort_by: columns to sort the rows by inside each file, parquet keeps min/max statistics per row group
+    so filters on these columns skip most of the file when reading
+    mmap_copy: also write the table as an arrow file for load_mmap'''
+    if sort_by:
+        df = df.sort_values(sort_by, kind="mergesort")
+    table = pa.Table.from_pandas(df, preserve_index=_keep_index(df))
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    if partition_cols:
+        pq.write_to_dataset(table, path, partition_cols=partition_cols, row_group_size=row_group_size)
+    else:
+        os.makedirs(path)
+        pq.write_table(table, os.path.join(path, "part-0.parquet"), row_group_size=row_group_size)
+    if mmap_copy:
+        _write_arrow(table, path, partition_cols or [], row_group_size)
+
+
+def _write_arrow(table: pa.Table, path: str, partition_cols: list, row_group_size: int=500000) -> None:
+    # same columns as what read_table gives back, partition columns last
+    table = _select(table, [name for name in table.column_names if name not in partition_cols] + partition_cols)
+    with pa.OSFile(path + ".arrow", "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=row_group_size)
+
+
+def write_partition(df: pd.DataFrame, path: str, column: str, value, sort_by: list=None,
+                    row_group_size: int=500000) -> None:
+    '''Replace one partition (column=value) of a partitioned table, the other partitions are left as they are.
+    df holds the rows of the partition without the partition column'''
+    if sort_by:
+        df = df.sort_values(sort_by, kind="mergesort")
+    partition = os.path.join(path, f"{column}={value}")
+    if os.path.isdir(partition):
+        shutil.rmtree(partition)
+    os.makedirs(partition)
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=_keep_index(df)), os.path.join(partition, "part-0.parquet"),
+                   row_group_size=row_group_size)
+
+
+class PartitionWriter:
+    '''Write one partition (column=value) of a partitioned table batch by batch, for the tables too large
+    to hold in memory: the batches are buffered up to row_group_size rows and written as one row group.
+    The partition is written beside the previous one and replaces it on close, readers never see a partial one
+        with PartitionWriter(path, "YEAR", 2019, schema) as writer:
+            for df in batches:
+                writer.write(df)'''
+    def __init__(self, path: str, column: str, value, schema: pa.Schema, row_group_size: int=500000):
+        self.partition = os.path.join(path, f"{column}={value}")
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.batches = []
+        self.rows = 0
+        self.written = 0
+        os.makedirs(path, exist_ok=True)
+        # hidden from the readers of the table (directories starting with "." are skipped)
+        self.temporary = os.path.join(path, f".{column}={value}.tmp")
+        if os.path.isdir(self.temporary):
+            shutil.rmtree(self.temporary)
+        os.makedirs(self.temporary)
+        self.writer = pq.ParquetWriter(os.path.join(self.temporary, "part-0.parquet"), schema)
+
+    def write(self, df: pd.DataFrame) -> None:
+        self.batches.append(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        self.rows += len(df)
+        if self.rows >= self.row_group_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.rows:
+            self.writer.write_table(pa.concat_tables(self.batches), row_group_size=self.row_group_size)
+        self.written += self.rows
+        self.batches, self.rows = [], 0
+
+    def close(self) -> None:
+        self._flush()
+        self.writer.close()
+        if os.path.isdir(self.partition):
+            shutil.rmtree(self.partition)
+        os.replace(self.temporary, self.partition)
+
+    def __enter__(self) -> "PartitionWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.close()
+            shutil.rmtree(self.temporary, ignore_errors=True)
+
+
+def write_mmap_copy(path: str, partition_cols: list=None) -> None:
+    '''(Re)write the memory mappable copy of a table from its parquet files, after partitions were replaced'''
+    _write_arrow(pq.read_table(path), path, partition_cols or [])
+
+
+def read_table(path: str, columns: list=None, filters: list=None) -> pd.DataFrame:
+    '''Read the columns needed only, filters (ex: [("code_departement", "not in", ["971", "972"])])
+    are pushed down to the partitions and row groups before being applied to the rows.
+    The index is read back with the columns'''
+    table = pq.read_table(path, columns=columns, filters=filters, use_pandas_metadata=True)
+    return table.to_pandas()
+
+
+def load_mmap(path: str, columns: list=None) -> pd.DataFrame:
+    '''Load a table written with mmap_copy=True without parsing nor copying it in memory:
+    the file is memory mapped and numeric columns without missing values are views on it,
+    pages are only read from disk when used'''
+    source = pa.memory_map(path + ".arrow", "r")
+    table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+        table = _select(table, columns)
+    # one block per column, no consolidation copy
+    return table.to_pandas(split_blocks=True)
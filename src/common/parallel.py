@@ -0,0 +1,102 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# share of the available memory the workers may use together
+MEMORY_SAFETY = 0.8
+
+
+def available_memory() -> int:
+    '''Available physical memory in bytes, None if it can't be known'''
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def workers_for(workers: int, memory_per_task: int) -> int:
+    '''Number of processes to run: the requested number (all cores if None),
+    lowered so that memory_per_task bytes per process fit in the available memory'''
+    workers = workers or os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None and memory_per_task:
+        workers = min(workers, int(memory * MEMORY_SAFETY // memory_per_task))
+    return max(1, workers)
+
+
+class ColumnarFrame:
+    '''Compact form of a DataFrame to send between processes: one array per column,
+    string (object) columns and index are sent as categorical codes + categories instead of python objects'''
+    def __init__(self, df: pd.DataFrame):
+        self.columns = list(df.columns)
+        self.object_columns = [column for column in df.columns if df[column].dtype == object]
+        self.arrays = [pd.Categorical(df[column]) if column in self.object_columns else df[column].array
+                       for column in self.columns]
+        self.index_name = df.index.name
+        self.index_is_object = df.index.dtype == object
+        if isinstance(df.index, pd.RangeIndex):
+            # (start, stop, step) is enough
+            self.index = None
+            self.range = (df.index.start, df.index.stop, df.index.step)
+        else:
+            self.index = pd.Categorical(df.index) if self.index_is_object else df.index.array
+
+    def to_pandas(self) -> pd.DataFrame:
+        if self.index is None:
+            index = pd.RangeIndex(*self.range)
+        else:
+            index = pd.Index(np.asarray(self.index, dtype=object) if self.index_is_object else self.index)
+        index.name = self.index_name
+        data = {column: (np.asarray(array, dtype=object) if column in self.object_columns else array)
+                for column, array in zip(self.columns, self.arrays)}
+        return pd.DataFrame(data, index=index, columns=self.columns)
+
+
+def pack(result):
+    '''Replace the DataFrames of a result (nested in dict, tuple or list) by ColumnarFrames'''
+    if isinstance(result, pd.DataFrame):
+        return ColumnarFrame(result)
+    if isinstance(result, dict):
+        return {key: pack(value) for key, value in result.items()}
+    if isinstance(result, (tuple, list)):
+        return type(result)(pack(value) for value in result)
+    return result
+
+
+def unpack(result):
+    if isinstance(result, ColumnarFrame):
+        return result.to_pandas()
+    if isinstance(result, dict):
+        return {key: unpack(value) for key, value in result.items()}
+    if isinstance(result, (tuple, list)):
+        return type(result)(unpack(value) for value in result)
+    return result
+
+
+def _packed_call(function: callable, args: tuple):
+    return pack(function(*args))
+
+
+def map_years(function: callable, years: list, args: tuple=(), workers: int=1, memory_per_year: int=None) -> list:
+    '''function(*args, year) for each year, results in the order of years.
+    workers > 1 (or None for every core) runs the years in a process pool limited by memory_per_year,
+    results come back from the workers in columnar form'''
+    years = list(years)
+    if workers == 1 or len(years) < 2:
+        return [function(*args, year) for year in years]
+    workers = min(workers_for(workers, memory_per_year), len(years))
+    if workers == 1:
+        return [function(*args, year) for year in years]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_packed_call, function, (*args, year)) for year in years]
+        return [unpack(future.result()) for future in futures]
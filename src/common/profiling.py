@@ -0,0 +1,347 @@
+import datetime
+import functools
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+# stage profiling of the offline pipelines, off unless ETL_PROFILE names the directory of the profiles:
+#     ETL_PROFILE=profiles python -m src.climat.traitement_donnees
+# each run writes <directory>/<run>/profile.json (wall and cpu time, peak traced memory, rows and bytes in
+# and out of every stage), profile.folded (self wall time of the stacks, for flamegraph.pl or speedscope)
+# and prints the stage tree. Tracing the memory slows the python allocations down, up to ten times on the
+# string columns of the GSOD files: ETL_PROFILE_MEMORY=0 leaves tracemalloc off for times close to a normal run
+PROFILE_DIR = os.environ.get("ETL_PROFILE")
+TRACE_MEMORY = os.environ.get("ETL_PROFILE_MEMORY", "1") != "0"
+# set by the process starting a run, the worker processes it forks or spawns write into the same run
+RUN_VARIABLE = "ETL_PROFILE_RUN"
+BAR_WIDTH = 40
+
+
+def data_size(data) -> tuple:
+    '''(rows, bytes) of a DataFrame, Series, array or a tuple/list/dict of them, (None, None) for anything else.
+    The strings of object columns are counted (deep memory usage), a pass over them when profiling'''
+    if isinstance(data, pd.DataFrame):
+        return len(data), int(data.memory_usage(index=True, deep=True).sum())
+    if isinstance(data, pd.Series):
+        return len(data), int(data.memory_usage(index=True, deep=True))
+    if isinstance(data, np.ndarray):
+        return len(data), int(data.nbytes)
+    if isinstance(data, (tuple, list, dict)):
+        sizes = [data_size(value) for value in (data.values() if isinstance(data, dict) else data)]
+        sizes = [size for size in sizes if size[0] is not None]
+        if sizes:
+            return sum(rows for rows, _ in sizes), sum(size for _, size in sizes)
+    return None, None
+
+
+class _Frame:
+    '''An open stage, and the last checkpoint taken inside it'''
+    def __init__(self, path: str, rows_in: int, bytes_in: int):
+        self.path = path
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.memory = _traced()
+        self.peak = self.memory
+        self.rows_in = rows_in
+        self.bytes_in = bytes_in
+        # checkpoint: start of the current step and its input, the output of the previous step
+        self.step_wall, self.step_cpu, self.step_memory, self.step_peak = self.wall, self.cpu, self.memory, self.memory
+        self.step_rows, self.step_bytes = rows_in, bytes_in
+        # time spent measuring the sizes of the data inside the stage, not counted in its time
+        self.overhead_wall = self.overhead_cpu = 0.0
+
+
+def _traced() -> int:
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+class _Profiler:
+    def __init__(self, prefix: str=""):
+        self.pid = os.getpid()
+        # path of the stage open in the parent process when this worker was forked
+        self.prefix = prefix
+        self.stack = []
+        # path -> record, in the order the stages started
+        self.records = {}
+        self.run = None
+        self.origin = False
+        self.stop_tracing = False
+
+    def _check_fork(self) -> None:
+        if os.getpid() != self.pid:
+            # forked worker: the stages of the parent are not closed here, its own stages go under them
+            self.__init__(self.stack[-1].path if self.stack else self.prefix)
+
+    def _sizes(self, data) -> tuple:
+        '''data_size of data, its time added to the overhead of the open stages'''
+        wall, cpu = time.perf_counter(), time.process_time()
+        sizes = data_size(data)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        for frame in self.stack:
+            frame.overhead_wall += wall
+            frame.overhead_cpu += cpu
+        return sizes
+
+    def _update_peaks(self) -> None:
+        if not tracemalloc.is_tracing():
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in self.stack:
+            frame.peak = max(frame.peak, peak)
+            frame.step_peak = max(frame.step_peak, peak)
+        tracemalloc.reset_peak()
+
+    def _record(self, path: str, started: float) -> dict:
+        if path not in self.records:
+            self.records[path] = {"path": path, "pid": self.pid, "started": started, "calls": 0,
+                                  "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_memory_bytes": 0,
+                                  "rows_in": None, "bytes_in": None, "rows_out": None, "bytes_out": None}
+        return self.records[path]
+
+    @staticmethod
+    def _add(record: dict, wall: float, cpu: float, peak: int, rows_in: int, bytes_in: int, rows_out: int,
+             bytes_out: int) -> None:
+        record["calls"] += 1
+        record["wall_seconds"] += wall
+        record["cpu_seconds"] += cpu
+        record["peak_memory_bytes"] = max(record["peak_memory_bytes"], peak)
+        for key, value in (("rows_in", rows_in), ("bytes_in", bytes_in), ("rows_out", rows_out),
+                           ("bytes_out", bytes_out)):
+            if value is not None:
+                record[key] = (record[key] or 0) + value
+
+    def enter(self, name: str, data_in=None, bytes_in: int=None) -> None:
+        self._check_fork()
+        if not self.stack:
+            self._start_run()
+        self._update_peaks()
+        rows_in, size_in = self._sizes(data_in)
+        parent = self.stack[-1].path if self.stack else self.prefix
+        path = f"{parent};{name}" if parent else name
+        # created at the start: a stage comes before its own stages
+        self._record(path, time.time())
+        self.stack.append(_Frame(path, rows_in, bytes_in if bytes_in is not None else size_in))
+
+    def exit(self, data_out=None) -> None:
+        wall, cpu = time.perf_counter(), time.process_time()
+        self._update_peaks()
+        frame = self.stack.pop()
+        # sizes measured after the clocks, the time of the profiler is left out of the stages
+        rows_out, bytes_out = self._sizes(data_out)
+        self._add(self.records[frame.path], wall - frame.wall - frame.overhead_wall,
+                  cpu - frame.cpu - frame.overhead_cpu, frame.peak - frame.memory, frame.rows_in, frame.bytes_in,
+                  rows_out, bytes_out)
+        if not self.stack:
+            self._end_run()
+            return
+        # the next step of the parent starts after this stage, from its output
+        self._next_step(self.stack[-1], rows_out, bytes_out)
+
+    @staticmethod
+    def _next_step(frame: _Frame, rows: int, size: int) -> None:
+        frame.step_wall, frame.step_cpu = time.perf_counter(), time.process_time()
+        frame.step_memory = frame.step_peak = _traced()
+        frame.step_rows, frame.step_bytes = rows, size
+
+    def checkpoint(self, name: str, data_out=None, bytes_in: int=None) -> None:
+        self._check_fork()
+        if not self.stack:
+            return
+        wall, cpu, now = time.perf_counter(), time.process_time(), time.time()
+        self._update_peaks()
+        frame = self.stack[-1]
+        rows_out, bytes_out = self._sizes(data_out)
+        # input: the file read (bytes_in), else the output of the previous step
+        rows_in, size_in = (None, bytes_in) if bytes_in is not None else (frame.step_rows, frame.step_bytes)
+        record = self._record(f"{frame.path};{name}", now - (wall - frame.step_wall))
+        self._add(record, wall - frame.step_wall, cpu - frame.step_cpu, frame.step_peak - frame.step_memory,
+                  rows_in, size_in, rows_out, bytes_out)
+        self._next_step(frame, rows_out, bytes_out)
+
+    def _start_run(self) -> None:
+        self.origin = RUN_VARIABLE not in os.environ
+        if self.origin:
+            # a worker reused for several tasks keeps adding to its records
+            self.records = {}
+            os.environ[RUN_VARIABLE] = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S-%f")
+        self.run = os.environ[RUN_VARIABLE]
+        self.stop_tracing = TRACE_MEMORY and not tracemalloc.is_tracing()
+        if self.stop_tracing:
+            tracemalloc.start()
+
+    def _end_run(self) -> None:
+        if self.stop_tracing:
+            tracemalloc.stop()
+        directory = os.path.join(PROFILE_DIR, self.run)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{self.pid}.json"), "w") as file:
+            json.dump({"run": self.run, "pid": self.pid, "prefix": self.prefix, "memory_traced": TRACE_MEMORY,
+                       "stages": list(self.records.values())}, file, indent=2)
+        if self.origin:
+            del os.environ[RUN_VARIABLE]
+            write_summary(directory)
+
+
+_profiler = _Profiler()
+
+
+class stage:
+    '''Profile a block as a stage named name, nested in the stage open around it:
+        with stage("merge", (df, df_stations)) as profile:
+            df = pd.merge(df, df_stations)
+            profile.output(df)
+    data_in: data read by the stage (see data_size), or bytes_in for a file. Does nothing without ETL_PROFILE'''
+    def __init__(self, name: str, data_in=None, bytes_in: int=None):
+        self.name = name
+        self.data_in = data_in
+        self.bytes_in = bytes_in
+        self.data_out = None
+
+    def output(self, data_out) -> None:
+        self.data_out = data_out
+
+    def __enter__(self) -> "stage":
+        if PROFILE_DIR:
+            _profiler.enter(self.name, self.data_in, self.bytes_in)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if PROFILE_DIR:
+            _profiler.exit(self.data_out)
+
+
+def profiled(name: str) -> callable:
+    '''Decorator profiling each call of a function as a stage, its DataFrame arguments are its input
+    and its result its output'''
+    def decorator(function: callable) -> callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILE_DIR:
+                return function(*args, **kwargs)
+            _profiler.enter(name, [*args, *kwargs.values()])
+            result = None
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                _profiler.exit(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def checkpoint(name: str, data_out=None, bytes_in: int=None) -> None:
+    '''End a step of the current stage: the step named name runs from the previous checkpoint (or the end
+    of the previous stage inside the current one, or its start) to now, data_out is its output and the input
+    of the next step. bytes_in: size of a file read by the step, its input instead of the previous output.
+    Profiles a linear function step by step without a block per step, does nothing outside of a stage'''
+    if PROFILE_DIR:
+        _profiler.checkpoint(name, data_out, bytes_in)
+
+
+def load_run(directory: str) -> list:
+    '''Stage records of every process of a run, in the order they started'''
+    records = []
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        if os.path.basename(path) == "profile.json":
+            continue
+        with open(path, "r") as file:
+            records.extend(json.load(file)["stages"])
+    return sorted(records, key=lambda record: record["started"])
+
+
+def merge_processes(records: list) -> list:
+    '''One record per stage path, the calls of the worker processes added up (times summed, peak memory
+    of the largest process), in the order the stages first started'''
+    merged = {}
+    for record in records:
+        if record["path"] not in merged:
+            merged[record["path"]] = {**record, "pids": [record["pid"]]}
+            continue
+        total = merged[record["path"]]
+        total["pids"].append(record["pid"])
+        for key in ("calls", "wall_seconds", "cpu_seconds", "rows_in", "bytes_in", "rows_out", "bytes_out"):
+            if record[key] is not None:
+                total[key] = (total[key] or 0) + record[key]
+        total["peak_memory_bytes"] = max(total["peak_memory_bytes"], record["peak_memory_bytes"])
+    return list(merged.values())
+
+
+def folded_stacks(records: list) -> list:
+    '''"stage;stage;... microseconds" lines of the self wall time of each stage (its time minus the time
+    of its stages in the same process, summed over the processes), the folded format of flame graphs'''
+    children = {}
+    for record in records:
+        parent = (record["path"].rpartition(";")[0], record["pid"])
+        children[parent] = children.get(parent, 0) + record["wall_seconds"]
+    self_times = {}
+    for record in records:
+        self_seconds = max(record["wall_seconds"] - children.get((record["path"], record["pid"]), 0), 0)
+        self_times[record["path"]] = self_times.get(record["path"], 0) + self_seconds
+    return [f"{path} {round(seconds * 1e6)}" for path, seconds in self_times.items()]
+
+
+def _megabytes(size: int) -> str:
+    return "-" if size is None else f"{size / 2 ** 20:.1f}"
+
+
+def print_tree(records: list, file=sys.stderr) -> None:
+    '''Stages indented under their parent with a bar of their wall time relative to the run, the stages
+    of the worker processes added up under the stage that started them (their bars can be longer than it)'''
+    records = merge_processes(records)
+    total = max([record["wall_seconds"] for record in records if ";" not in record["path"]] or [1e-9])
+    print(f"{'stage':<48}{'calls':>6}{'wall s':>9}{'cpu s':>9}{'peak MB':>9}{'rows in':>11}{'rows out':>11}"
+          f"{'MB in':>8}{'MB out':>8}", file=file)
+    for record in records:
+        name = "  " * record["path"].count(";") + record["path"].rpartition(";")[2]
+        bar = "#" * max(1, round(record["wall_seconds"] / total * BAR_WIDTH))
+        print(f"{name:<48}{record['calls']:>6}{record['wall_seconds']:>9.3f}{record['cpu_seconds']:>9.3f}"
+              f"{_megabytes(record['peak_memory_bytes']):>9}{record['rows_in'] or '-':>11}"
+              f"{record['rows_out'] or '-':>11}{_megabytes(record['bytes_in']):>8}{_megabytes(record['bytes_out']):>8}"
+              f"  {bar}", file=file)
+
+
+def write_summary(directory: str) -> None:
+    '''profile.json and profile.folded of a run from the files of its processes, and the tree on stderr'''
+    records = load_run(directory)
+    with open(os.path.join(directory, "profile.json"), "w") as file:
+        json.dump({"run": os.path.basename(directory), "memory_traced": TRACE_MEMORY, "stages": records},
+                  file, indent=2)
+    with open(os.path.join(directory, "profile.folded"), "w") as file:
+        file.write("\n".join(folded_stacks(records)) + "\n")
+    print_tree(records)
+    print(f"profile saved to {directory}", file=sys.stderr)
+
+
+def compare(run: str, reference: str) -> None:
+    '''Ratios of the wall time and peak memory of each stage against a previous run (below 1: faster or smaller)'''
+    stages, traced = {}, {}
+    for name, path in (("run", run), ("reference", reference)):
+        with open(path, "r") as file:
+            profile = json.load(file)
+        stages[name] = {record["path"]: record for record in merge_processes(profile["stages"])}
+        traced[name] = profile["memory_traced"]
+    if traced["run"] != traced["reference"]:
+        print("warning: the memory was traced in only one of the runs, their times are not comparable")
+    for path, record in stages["run"].items():
+        previous = stages["reference"].get(path)
+        if previous is None:
+            continue
+        print(f"{path:<72}time x{record['wall_seconds'] / max(previous['wall_seconds'], 1e-9):>6.2f}"
+              f"   memory x{record['peak_memory_bytes'] / max(previous['peak_memory_bytes'], 1):>6.2f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare the stages of two profiled runs")
+    parser.add_argument("run", help="profile.json of the run")
+    parser.add_argument("reference", help="profile.json of a previous run")
+    arguments = parser.parse_args()
+    compare(arguments.run, arguments.reference)
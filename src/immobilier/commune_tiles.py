@@ -0,0 +1,127 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+
+import pandas as pd
+import branca.colormap as cm
+
+from delivery import write_compressed
+from src.common.datastore import read_table
+from src.immobilier.geometry import simplify_features, zoom_tolerance
+
+
+TILES_DIR = "build/tiles/communes"
+# below MIN_ZOOM the departement map is used, above MAX_ZOOM the tiles of MAX_ZOOM are reused
+MIN_ZOOM = 8
+MAX_ZOOM = 12
+# manifest entry served for the tiles without any commune
+EMPTY_TILE = "empty"
+
+
+def tile_x(longitude: float, zoom: int) -> float:
+    '''Web mercator tile column (fractional) of a longitude'''
+    return (longitude + 180) / 360 * 2 ** zoom
+
+
+def tile_y(latitude: float, zoom: int) -> float:
+    '''Web mercator tile row (fractional) of a latitude, row 0 at the north'''
+    latitude = math.radians(max(min(latitude, 85.0511), -85.0511))
+    return (1 - math.log(math.tan(latitude) + 1 / math.cos(latitude)) / math.pi) / 2 * 2 ** zoom
+
+
+def feature_bounds(feature: dict) -> tuple:
+    '''(min longitude, min latitude, max longitude, max latitude) of a Polygon or MultiPolygon feature'''
+    geometry = feature["geometry"]
+    polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+    longitudes = [point[0] for polygon in polygons for point in polygon[0]]
+    latitudes = [point[1] for polygon in polygons for point in polygon[0]]
+    return min(longitudes), min(latitudes), max(longitudes), max(latitudes)
+
+
+def feature_tiles(feature: dict, zoom: int) -> list:
+    '''(x, y) of the tiles of a zoom crossed by the bounding box of the feature'''
+    west, south, east, north = feature_bounds(feature)
+    last = 2 ** zoom - 1
+    columns = range(max(int(tile_x(west, zoom)), 0), min(int(tile_x(east, zoom)), last) + 1)
+    rows = range(max(int(tile_y(north, zoom)), 0), min(int(tile_y(south, zoom)), last) + 1)
+    return [(x, y) for x in columns for y in rows]
+
+
+def commune_properties(prices: pd.DataFrame, types_bien: list, colormap) -> dict:
+    '''{code_commune: properties} for the features: median_{type}, count_{type} and color_{type}
+    of each type of property with sales, prices: one year of the prices_commune store table'''
+    properties = {}
+    for type_bien in types_bien:
+        if type_bien not in prices.index.get_level_values("type_bien"):
+            continue
+        table = prices.xs(type_bien, level="type_bien")
+        for code, count, median in zip(table.index, table["count"], table["median"]):
+            properties.setdefault(code, {}).update({f"median_{type_bien}": round(float(median)),
+                                                    f"count_{type_bien}": int(count),
+                                                    f"color_{type_bien}": colormap(median)})
+    return properties
+
+
+def build_tiles(geojson: dict, prices: pd.DataFrame, colormap, destination: str=TILES_DIR,
+                zooms: range=range(MIN_ZOOM, MAX_ZOOM + 1), types_bien: list=("appartement", "maison"),
+                precision: int=4) -> dict:
+    '''Cut the communes into GeoJSON tiles {z}/{x}/{y}.json for each zoom, written precompressed with
+    a manifest served by delivery.PrecompressedPages (see app.py). The geometry is simplified for each zoom
+    (1 pixel of tolerance, shared borders kept identical) and the prices are embedded in the properties,
+    so a tile is the only request needed for the communes it shows. A commune is written whole in every tile
+    its bounding box crosses: the map keeps the first copy. Empty tiles are not written, they are all
+    served by the "empty" entry. tiles.json describes the zoom levels for the map.
+    prices: prices_commune store table of one year, indexed by type_bien and code_commune'''
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    os.makedirs(destination)
+    properties = commune_properties(prices, list(types_bien), colormap)
+    features = [{"type": "Feature", "geometry": feature["geometry"],
+                 "properties": {"code": feature["properties"]["code"], "nom": feature["properties"]["nom"],
+                                **properties.get(feature["properties"]["code"], {})}}
+                for feature in geojson["features"]]
+    manifest = {}
+
+    def add(name: str, file_name: str, collection: list) -> None:
+        body = json.dumps({"type": "FeatureCollection", "features": collection},
+                          separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        sizes = write_compressed(os.path.join(destination, file_name), body)
+        manifest[name] = {"file": file_name, "sha256": hashlib.sha256(body).hexdigest(), "size": len(body),
+                          "mimetype": "application/json", "encodings": sizes}
+
+    add(EMPTY_TILE, "empty.json", [])
+    for zoom in zooms:
+        tiles = {}
+        for feature in simplify_features(features, zoom_tolerance(zoom), precision):
+            for tile in feature_tiles(feature, zoom):
+                tiles.setdefault(tile, []).append(feature)
+        for (x, y), collection in tiles.items():
+            os.makedirs(os.path.join(destination, str(zoom), str(x)), exist_ok=True)
+            add(f"{zoom}/{x}/{y}", f"{zoom}/{x}/{y}.json", collection)
+        sizes = [manifest[f"{zoom}/{x}/{y}"]["size"] for x, y in tiles]
+        print(f"zoom {zoom}: {len(tiles)} tiles, {sum(sizes)} bytes, largest {max(sizes, default=0)}")
+    with open(os.path.join(destination, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    with open(os.path.join(destination, "tiles.json"), "w") as file:
+        json.dump({"min_zoom": min(zooms), "max_zoom": max(zooms), "types_bien": list(types_bien),
+                   "tiles": len(manifest) - 1}, file)
+    return manifest
+
+
+if __name__ == "__main__":
+    prices = read_table("data/immobilier/store/prices_commune")
+    year = int(prices["year"].astype(int).max())
+    prices = prices[prices["year"].astype(int) == year]
+
+    # same colors as the departement map, normal Colormap class of the branca library from pip
+    colormap = cm.LinearColormap(colors=['darkgreen', 'green', 'yellow', 'orange', 'red', 'darkred'],
+                                 index=[700, 1300, 2000, 2800, 5000, 10000],
+                                 vmin=700, vmax=10000,
+                                 caption=f"Prix médian du m2 par commune en {year}")
+
+    with open("data/immobilier/geo_data/communes.geojson", "r") as file:
+        json_communes = json.load(file)
+
+    build_tiles(json_communes, prices, colormap)
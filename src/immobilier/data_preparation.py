@@ -1,8 +1,19 @@
-import gzip
 import os
 
+import numpy as np
 import pandas as pd
 
+from comparables import build_index
+from postal_codes import write_index
+from price_series import write_series
+from src.common.build_manifest import BuildManifest
+from src.common.datastore import read_table, write_mmap_copy, write_partition, write_table
+from src.common.parallel import map_years
+from src.common.profiling import checkpoint, profiled
+from src.immobilier.price_aggregation import (SKETCH_COMPRESSION, aggregate_levels, group_quantiles,
+    sketch_quantiles, sketch_table, wide_table)
+from src.immobilier.dvf_reader import DVF_DTYPES, read_dvf
+
 
 pd.set_option('display.float_format', lambda x: '%.5f' % x)
 # pd.set_option('display.max_columns', None)
@@ -11,7 +22,34 @@ pd.set_option('display.max_rows', 100)
 pd.set_option('display.min_rows', 30)
 
 
-def appartement_preparation(df: pd.DataFrame) -> pd.DataFrame:
+# columns kept in the clean tables
+APPARTEMENT_COLUMNS = ["date_mutation", "valeur_fonciere", "surface_reelle_bati", "nombre_pieces_principales", 
+    "code_departement", "code_postal" ,"code_commune", "longitude", "latitude", "prix_m2"]
+MAISON_COLUMNS = ["date_mutation", "valeur_fonciere", "surface_reelle_bati", "nombre_pieces_principales", "surface_terrain",
+    "code_departement", "code_postal" ,"code_commune", "longitude", "latitude", "prix_m2"]
+
+# thresholds of common_preparation, part of the build manifest: changing one rebuilds every year
+PREPARATION_PARAMETERS = {
+    "min_prix_m2": 500,
+    "max_prix_m2": 20000,
+    "min_surface": 9,
+}
+
+# property type branches fed by the common preparation: name -> (row filter, output columns)
+PROPERTY_BRANCHES = {}
+
+
+def register_branch(name: str, columns: list) -> callable:
+    '''Decorator registering a row filter as a property type branch, each branch gets its own clean table
+    {name} and departement aggregates m2_{name}_price_per_departement'''
+    def decorator(row_filter: callable) -> callable:
+        PROPERTY_BRANCHES[name] = (row_filter, columns)
+        return row_filter
+    return decorator
+
+
+def common_preparation(df: pd.DataFrame) -> pd.DataFrame:
+    '''Steps shared by every property type, done once whatever the number of branches'''
     # keep only columns for work on
     df = df[["nature_mutation", "id_mutation", "date_mutation", "valeur_fonciere", "type_local", 
     "surface_reelle_bati", "nombre_pieces_principales", "surface_terrain", "code_commune", 
@@ -20,94 +58,245 @@ def appartement_preparation(df: pd.DataFrame) -> pd.DataFrame:
     df = df[df["nature_mutation"] == "Vente"]
     # deleting all sales with multiple lots to keep it simple and more accurate
     df = df.drop_duplicates(subset=["id_mutation"], keep=False)
-    # select only appartments 
-    df = df[df["type_local"] == "Appartement"]
-    # keep only appartements without lands
-    df = df[df["surface_terrain"].isna()]
     # calculate price per square metter and delete the most aberants entries
     df["prix_m2"] = df["valeur_fonciere"] / df["surface_reelle_bati"]
-    df = df.loc[(df["prix_m2"] > 500) & (df["prix_m2"] < 20000),:]
-    # keep only appartements greater than minimum viable
-    df = df[df["surface_reelle_bati"] >= 9]
+    df = df.loc[(df["prix_m2"] > PREPARATION_PARAMETERS["min_prix_m2"])
+                & (df["prix_m2"] < PREPARATION_PARAMETERS["max_prix_m2"]),:]
+    # keep only biens greater than minimum viable
+    df = df[df["surface_reelle_bati"] >= PREPARATION_PARAMETERS["min_surface"]]
     # convert code departement to string mainly because of 2A and 2B departement and for geojson mapping
     df["code_departement"] = df["code_departement"].astype(str)
     # put a "0" in front of first 9 departements for mapping data and joins for later
     df["code_departement"] = df["code_departement"].apply(lambda x: x if len(x)>1 else "0"+x)
-
-    df = df[["date_mutation", "valeur_fonciere", "surface_reelle_bati", "nombre_pieces_principales", 
-    "code_departement", "code_postal" ,"code_commune", "longitude", "latitude", "prix_m2"]]
     return df
 
 
+@register_branch("appartement", APPARTEMENT_COLUMNS)
+def appartement_filter(df: pd.DataFrame) -> pd.DataFrame:
+    # select only appartments, keep only appartements without lands
+    return df[(df["type_local"] == "Appartement") & df["surface_terrain"].isna()]
+
+
+@register_branch("maison", MAISON_COLUMNS)
+def maison_filter(df: pd.DataFrame) -> pd.DataFrame:
+    return df[df["type_local"] == "Maison"]
+
+
+def branch_preparation(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    '''Rows and columns of one branch from a dataframe which went through common_preparation'''
+    row_filter, columns = PROPERTY_BRANCHES[name]
+    return row_filter(df)[columns]
+
+
+def appartement_preparation(df: pd.DataFrame) -> pd.DataFrame:
+    return branch_preparation(common_preparation(df), "appartement")
+
+
 def maison_preparation(df: pd.DataFrame) -> pd.DataFrame:
-    # keep only columns for work on
-    df = df[["nature_mutation", "id_mutation", "date_mutation", "valeur_fonciere", "type_local", 
-    "surface_reelle_bati", "nombre_pieces_principales", "surface_terrain", "code_commune", 
-    "code_departement", "code_postal", "longitude", "latitude"]]
-    # keep only sales
-    df = df[df["nature_mutation"] == "Vente"]
-    # deleting all sales with multiple lots to keep it simple and more accurate
-    df = df.drop_duplicates(subset=["id_mutation"], keep=False)
-    # select only appartments 
-    df = df[df["type_local"] == "Maison"]
+    return branch_preparation(common_preparation(df), "maison")
 
-    # calculate price per square metter and delete the most aberants entries
-    df["prix_m2"] = df["valeur_fonciere"] / df["surface_reelle_bati"]
-    df = df.loc[(df["prix_m2"] > 500) & (df["prix_m2"] < 20000),:]
-    # keep only appartements greater than minimum viable
-    df = df[df["surface_reelle_bati"] >= 9]
-    # convert code departement to string mainly because of 2A and 2B departement and for geojson mapping
-    df["code_departement"] = df["code_departement"].astype(str)
-    # put a "0" in front of first 9 departements for mapping data and joins for later
-    df["code_departement"] = df["code_departement"].apply(lambda x: x if len(x)>1 else "0"+x)
 
-    df = df[["date_mutation", "valeur_fonciere", "surface_reelle_bati", "nombre_pieces_principales", "surface_terrain",
-    "code_departement", "code_postal" ,"code_commune", "longitude", "latitude", "prix_m2"]]
-    return df
+def aggregate_departement_prices(prepared_df: pd.DataFrame, year: int) -> pd.DataFrame:
+    '''Median and deciles of the price per m2 by departement, columns named {year}_median...'''
+    table = group_quantiles(prepared_df, ["code_departement"], stats=())
+    return table.add_prefix(f"{year}_")
 
 
-def data_work(preparation_function:callable) -> tuple:
+# aggregation levels of the price per m2 over every branch: {level name: keys}
+PRICE_LEVELS = {
+    "departement": ["year", "type_bien", "code_departement"],
+    "commune": ["year", "type_bien", "code_commune"],
+    "code_postal": ["year", "type_bien", "code_postal"],
+    "type_bien": ["year", "type_bien"],
+}
+# levels of PRICE_LEVELS served by area code by the prices api of the web app
+AREA_LEVELS = ["departement", "commune", "code_postal"]
+
+
+def price_rows(clean_dfs: dict) -> pd.DataFrame:
+    '''Keys and price per m2 of the clean tables of every branch ({branch name: clean_df}), type_bien being the branch name'''
+    return pd.concat([pd.DataFrame({"year": clean_df.index.year, "type_bien": name,
+                                    "code_departement": clean_df["code_departement"].values,
+                                    "code_commune": clean_df["code_commune"].values,
+                                    "code_postal": clean_df["code_postal"].values,
+                                    "prix_m2": clean_df["prix_m2"].values})
+                      for name, clean_df in clean_dfs.items()], ignore_index=True)
 
-    def custom_agg(x) -> pd.Series:
-        d = {}
-        d[f"{year}_median"] = x["prix_m2"].median()
-        d[f"{year}_decile_1"] = x["prix_m2"].quantile(0.1)
-        d[f"{year}_decile_9"] = x["prix_m2"].quantile(0.9)
-        return pd.Series(d, index=[f"{year}_median", f"{year}_decile_1", f"{year}_decile_9"])
 
+def aggregate_price_levels(results: dict, levels: dict=PRICE_LEVELS) -> dict:
+    '''count, mean, median and deciles of the price per m2 for each level, computed from the clean tables
+    of every branch (results of data_work_branches)'''
+    return aggregate_levels(price_rows({name: clean_df for name, (clean_df, _) in results.items()}), levels)
+
+
+def dvf_path(year: int) -> str:
+    return f'data/immobilier/transactions_raw/full{year}.csv.gz'
+
+
+def finalize_clean_df(clean_df_list: list) -> pd.DataFrame:
+    clean_df = pd.concat(clean_df_list, axis=0)
+    clean_df = clean_df.set_index("date_mutation")
+    clean_df.index = pd.to_datetime(clean_df.index)
+    return clean_df
+
+
+@profiled("data_work")
+def data_work(preparation_function:callable) -> tuple:
     # will contain clean dfs mostly for ml
     clean_df_list = []
     # will contain yearly departement aggregated prices, dfs mostly for map generation
     yearly_departement_prices_df_list = []
 
     for year in range(2014, 2021):
-        with gzip.open(f'data/immobilier/transactions_raw/full{year}.csv.gz', 'rb') as f:
-            df = pd.read_csv(f)
-        # apply the desired preparation function
-        prepared_df = preparation_function(df)
+        # read only the needed columns, chunk by chunk, and apply the desired preparation function to each chunk
+        prepared_df = pd.concat(read_dvf(dvf_path(year), preparation_function))
+        checkpoint("read_dvf", prepared_df, bytes_in=os.path.getsize(dvf_path(year)))
         # append the yearly prepared data to list of prepared dataframes
         clean_df_list.append(prepared_df)
 
         # aggregate data by departements by computing the median and deciles
-        aggregated_departement_price = prepared_df[["code_departement", "prix_m2"]].groupby(["code_departement"]).apply(custom_agg) 
+        aggregated_departement_price = aggregate_departement_prices(prepared_df, year)
+        checkpoint("aggregate_departement_prices", aggregated_departement_price)
         # append the yearly data to list of dataframes
         yearly_departement_prices_df_list.append(aggregated_departement_price)
 
-    clean_df = pd.concat(clean_df_list, axis=0)
+    clean_df = finalize_clean_df(clean_df_list)
     yearly_departement_prices_df = pd.concat(yearly_departement_prices_df_list, axis=1)
-
-    clean_df = clean_df.set_index("date_mutation")
-    clean_df.index = pd.to_datetime(clean_df.index)
+    checkpoint("concat", (clean_df, yearly_departement_prices_df))
 
     return clean_df, yearly_departement_prices_df
 
 
+# memory used to prepare a year, in bytes per byte of compressed file (chunked reading,
+# only the prepared rows of the year are kept), used to limit the number of parallel years
+DVF_MEMORY_FACTOR = 4
+
+
+def prepare_year(branches: list, year: int) -> dict:
+    '''One yearly file read once for every branch, return {branch name: (prepared_df, departement prices)}'''
+    yearly_chunks = {name: [] for name in branches}
+    for chunk in read_dvf(dvf_path(year), common_preparation):
+        for name in branches:
+            yearly_chunks[name].append(branch_preparation(chunk, name))
+    results = {}
+    for name in branches:
+        prepared_df = pd.concat(yearly_chunks[name])
+        results[name] = (prepared_df, aggregate_departement_prices(prepared_df, year))
+    return results
+
+
+def data_work_branches(branches: list=None, workers: int=1) -> dict:
+    '''Same as data_work for several property types in one pass: each yearly file is read and
+    goes through common_preparation once, then every registered branch (or the given ones) takes its rows.
+    workers: number of years prepared in parallel processes (None for every core), lowered if memory is short.
+    Return {branch name: (clean_df, yearly_departement_prices_df)}'''
+    branches = list(PROPERTY_BRANCHES) if branches is None else branches
+    years = range(2014, 2021)
+    memory_per_year = max(os.path.getsize(dvf_path(year)) for year in years) * DVF_MEMORY_FACTOR
+    yearly_results = map_years(prepare_year, years, (branches,), workers, memory_per_year)
+
+    clean_df_lists = {name: [result[name][0] for result in yearly_results] for name in branches}
+    yearly_departement_prices_df_lists = {name: [result[name][1] for result in yearly_results] for name in branches}
+    return {name: (finalize_clean_df(clean_df_lists[name]), pd.concat(yearly_departement_prices_df_lists[name], axis=1))
+            for name in branches}
+
+
+# typed columnar tables read by the training scripts and the map generation (see src.common.datastore)
+STORE_DIR = "data/immobilier/store"
+
+
+def save_year(clean_dfs: dict, year: int, store: str=STORE_DIR) -> None:
+    '''Write the year partition of every store table from the clean tables of the year ({branch name: clean_df}):
+    clean tables (rows sorted by departement so departement filters skip row groups), exact departement
+    aggregates yearly_m2_{name}, exact price levels prices_{level} and quantile sketches sketches_{level}
+    (merged later to get multi year or regional quantiles without the transactions)'''
+    for name, clean_df in clean_dfs.items():
+        write_partition(clean_df, f"{store}/{name}", "year", year, sort_by=["code_departement"])
+        write_partition(group_quantiles(clean_df, ["code_departement"], stats=()), f"{store}/yearly_m2_{name}", "year", year)
+    prices = price_rows(clean_dfs)
+    levels = {level: [key for key in keys if key != "year"] for level, keys in PRICE_LEVELS.items()}
+    for level, table in aggregate_levels(prices, levels).items():
+        write_partition(table, f"{store}/prices_{level}", "year", year)
+    for level, keys in levels.items():
+        write_partition(sketch_table(prices, keys), f"{store}/sketches_{level}", "year", year)
+
+
+def finalize_store(branches: list, store: str=STORE_DIR, destination: str="data/immobilier/data_clean") -> None:
+    '''Tables made of every year: memory mappable copies of the clean tables for the training scripts,
+    departement aggregates in the {year}_median, {year}_decile_1, {year}_decile_9 layout, also exported as csv for the web app,
+    and for the web app: the index of the known codes postaux with their number of sales by type
+    the spatial index of the sales for the comparables and the yearly price series of every area'''
+    sales = read_table(f"{store}/prices_code_postal", columns=["type_bien", "code_postal", "count"])
+    sales = sales.groupby(["type_bien", "code_postal"], observed=True)["count"].sum()
+    write_index({name: {int(code): int(count) for code, count in sales[name].items()} if name in sales.index.levels[0] else {}
+                 for name in branches}, f"{destination}/postal_codes.npy")
+    sales = [read_table(f"{store}/{name}", columns=["longitude", "latitude", "surface_reelle_bati", "prix_m2",
+                                                    "valeur_fonciere", "code_postal"]) for name in branches]
+    build_index(f"{destination}/comparables", branches, {
+        "type_bien": np.concatenate([np.full(len(df), i) for i, df in enumerate(sales)]),
+        "date": np.concatenate([df.index.values.astype("datetime64[D]") for df in sales]),
+        **{column: np.concatenate([df[column].values for df in sales])
+           for column in ["longitude", "latitude", "surface_reelle_bati", "prix_m2", "valeur_fonciere", "code_postal"]}})
+    for level in AREA_LEVELS:
+        write_series(f"{destination}/price_series", level, read_table(f"{store}/prices_{level}"))
+    for name in branches:
+        write_mmap_copy(f"{store}/{name}", partition_cols=["year"])
+        yearly = read_table(f"{store}/yearly_m2_{name}")
+        yearly = yearly.set_index(yearly["year"].astype(int), append=True).drop(columns="year")
+        yearly_departement_prices_df = wide_table(yearly, "year", ["median", "decile_1", "decile_9"])
+        write_table(yearly_departement_prices_df, f"{store}/m2_{name}_price_per_departement")
+        yearly_departement_prices_df.to_csv(f"{destination}/m2_{name}_price_per_departement.csv")
+
+
+def save_branches(results: dict, destination: str="data/immobilier/data_clean", store: str=STORE_DIR) -> None:
+    '''Write the results of data_work_branches to the store (see save_year and finalize_store)'''
+    years = sorted(set().union(*(clean_df.index.year for clean_df, _ in results.values())))
+    for year in years:
+        save_year({name: clean_df[clean_df.index.year == year] for name, (clean_df, _) in results.items()}, year, store)
+    finalize_store(list(results), store, destination)
+
+
+def build_parameters(branches: list) -> dict:
+    '''Everything the store content depends on besides the DVF files'''
+    return {"preparation": PREPARATION_PARAMETERS, "dvf_dtypes": DVF_DTYPES,
+            "branches": {name: PROPERTY_BRANCHES[name][1] for name in branches},
+            "price_levels": PRICE_LEVELS, "sketch_compression": SKETCH_COMPRESSION}
+
+
+def update_store(years: list=range(2014, 2021), branches: list=None, workers: int=1, store: str=STORE_DIR,
+                 destination: str="data/immobilier/data_clean") -> list:
+    '''Incremental build of the store: only the years whose DVF file changed since the last build
+    (or every year if build_parameters changed) are read and prepared again, in parallel processes like
+    data_work_branches, the other years are kept from the store. Return the rebuilt years'''
+    branches = list(PROPERTY_BRANCHES) if branches is None else branches
+    manifest = BuildManifest(f"{store}/manifest.json", build_parameters(branches))
+    stale_years = [year for year in years if not manifest.is_current(year, dvf_path(year))]
+    if stale_years:
+        memory_per_year = max(os.path.getsize(dvf_path(year)) for year in stale_years) * DVF_MEMORY_FACTOR
+        yearly_results = map_years(prepare_year, stale_years, (branches,), workers, memory_per_year)
+        for year, results in zip(stale_years, yearly_results):
+            save_year({name: finalize_clean_df([prepared_df]) for name, (prepared_df, _) in results.items()}, year, store)
+            # recorded year by year, an interrupted build restarts from the first year not saved
+            manifest.record(year, dvf_path(year))
+            manifest.save()
+        finalize_store(branches, store, destination)
+    manifest.save()
+    return stale_years
+
+
+def combined_prices(level: str, keys: list, years: list=None, store: str=STORE_DIR) -> pd.DataFrame:
+    '''Count, mean, median and deciles over several years from the stored sketches of a level
+    (departement, commune, code_postal or type_bien), grouped by keys, ex: the 2018-2020 median by departement:
+    combined_prices("departement", ["type_bien", "code_departement"], years=[2018, 2019, 2020]).
+    For a region, read the sketches, add a region column from the departement and use sketch_quantiles'''
+    filters = None if years is None else [("year", "in", list(years))]
+    return sketch_quantiles(read_table(f"{store}/sketches_{level}", filters=filters), keys)
+
+
 def save_essential_data():
     df_list = []
     for year in range(2014, 2021):
-        with gzip.open(f'data/transactions_raw/full{year}.csv.gz', 'rb') as f:
-            df = pd.read_csv(f)
-        df_app = appartement_preparation(df)
+        df_app = pd.concat(read_dvf(f'data/transactions_raw/full{year}.csv.gz', appartement_preparation))
         print(df_app["code_departement"].unique().tolist())
         df_list.append(df_app)
     dfs = pd.concat(df_list)
@@ -118,10 +307,8 @@ def save_essential_data():
 
 if __name__ == "__main__":
     # for year in range(2019, 2020):
-    #     with gzip.open(f'data/immobilier/transactions_raw/full{year}.csv.gz', 'rb') as f:
-    #         df = pd.read_csv(f)
-    # df = maison_preparation(df)
+    #     df = pd.concat(read_dvf(f'data/immobilier/transactions_raw/full{year}.csv.gz', maison_preparation))
 
-    result1, result2 = data_work(maison_preparation)
-    result1.to_csv("data/immobilier/data_clean/maison.csv")
-    result2.to_csv("data/immobilier/data_clean/m2_maison_price_per_departement.csv")
+    # appartement and maison tables from a single read of the yearly files, one process per year,
+    # only the years changed since the last run
+    update_store(workers=None)
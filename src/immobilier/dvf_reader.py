@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+
+# columns used by the preparation functions, the others are never parsed
+DVF_COLUMNS = ["nature_mutation", "id_mutation", "date_mutation", "valeur_fonciere", "type_local",
+    "surface_reelle_bati", "nombre_pieces_principales", "surface_terrain", "code_commune",
+    "code_departement", "code_postal", "longitude", "latitude"]
+
+# values unknown to these categories are read as NaN, they are filtered out by the preparations anyway
+NATURE_MUTATION = pd.CategoricalDtype(["Vente", "Vente en l'état futur d'achèvement", "Vente terrain à bâtir",
+    "Adjudication", "Echange", "Expropriation"])
+TYPE_LOCAL = pd.CategoricalDtype(["Appartement", "Maison", "Dépendance",
+    "Local industriel. commercial ou assimilé"])
+
+# fixed schema instead of inferred dtypes (inference also mixes int and str in code columns):
+# surfaces, pieces and code postal are whole numbers, exact in float32,
+# valeur_fonciere and coordinates keep float64 so prices and positions are unchanged
+DVF_DTYPES = {
+    "nature_mutation": NATURE_MUTATION,
+    "id_mutation": str,
+    "date_mutation": str,
+    "valeur_fonciere": np.float64,
+    "type_local": TYPE_LOCAL,
+    "surface_reelle_bati": np.float32,
+    "nombre_pieces_principales": np.float32,
+    "surface_terrain": np.float32,
+    "code_commune": str,
+    "code_departement": "category",
+    "code_postal": np.float32,
+    "longitude": np.float64,
+    "latitude": np.float64,
+}
+
+
+def read_dvf(path: str, preparation_function: callable=None, chunksize: int=500000):
+    '''Read a full{year}.csv.gz DVF file by chunks of about chunksize rows, memory stays bounded by the chunk size.
+    The rows of a mutation follow each other in the DVF files, the last mutation of a chunk is carried
+    over to the next one so a mutation is never split (the multi lots deletion needs all its rows).
+    Yield each chunk passed through preparation_function (the raw chunk if None)'''
+    carry = None
+    with pd.read_csv(path, usecols=DVF_COLUMNS, dtype=DVF_DTYPES, chunksize=chunksize) as reader:
+        for chunk in reader:
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+                # categories differ between chunks, concat falls back to object
+                chunk["code_departement"] = chunk["code_departement"].astype("category")
+            id_mutation = chunk["id_mutation"].values
+            is_last_mutation = id_mutation == id_mutation[-1]
+            carry = chunk[is_last_mutation]
+            chunk = chunk[~is_last_mutation]
+            if len(chunk):
+                yield chunk if preparation_function is None else preparation_function(chunk)
+    if carry is not None and len(carry):
+        yield carry if preparation_function is None else preparation_function(carry)
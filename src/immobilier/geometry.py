@@ -0,0 +1,144 @@
+import json
+
+import numpy as np
+
+
+def zoom_tolerance(zoom: int, pixels: float=1.0) -> float:
+    '''Size in degrees of `pixels` web mercator pixels at the equator for a zoom level,
+    details smaller than that are not visible at this zoom'''
+    return pixels * 360 / (256 * 2 ** zoom)
+
+
+def douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+    '''Simplify a line (n, 2), first and last points are always kept'''
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last] - start
+        norm = np.hypot(*segment)
+        if norm == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / norm
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return points[keep]
+
+
+def _rings(geometry: dict) -> list:
+    '''Every ring of a Polygon or MultiPolygon'''
+    if geometry["type"] == "Polygon":
+        return list(geometry["coordinates"])
+    return [ring for polygon in geometry["coordinates"] for ring in polygon]
+
+
+def _find_junctions(rings: list) -> set:
+    '''Points where the neighbouring vertices differ between two rings (or two passes of a ring),
+    which are the ends of the borders shared by several features'''
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        # closed rings: the last point repeats the first one
+        points = ring[:-1]
+        for i, point in enumerate(points):
+            pair = frozenset((points[i - 1], points[(i + 1) % len(points)]))
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+
+def _split_ring(ring: list, junctions: set) -> list:
+    '''Cut a closed ring into arcs going from one junction to the next'''
+    points = ring[:-1]
+    cuts = [i for i, point in enumerate(points) if point in junctions]
+    if not cuts:
+        # ring sharing no border (island), a single arc closed on itself
+        return [points + [points[0]]]
+    start = cuts[0]
+    rotated = points[start:] + points[:start]
+    cuts = [i - start for i in cuts]
+    arcs = []
+    for begin, end in zip(cuts, cuts[1:] + [len(rotated)]):
+        arcs.append(rotated[begin:end] + [rotated[end % len(rotated)]])
+    return arcs
+
+
+def simplify_features(features: list, tolerance: float, precision: int=4) -> list:
+    '''Topology preserving simplification of departement features (Polygon/MultiPolygon):
+    coordinates are quantized to `precision` decimals, rings are cut at the junctions and each
+    shared border is simplified once, so both neighbours keep exactly the same border (no gap nor overlap)'''
+    def quantize(ring):
+        points = [(round(x, precision), round(y, precision)) for x, y in ring]
+        # rounding can merge consecutive vertices
+        return [point for i, point in enumerate(points) if i == 0 or point != points[i - 1]]
+
+    quantized = []
+    for feature in features:
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            coordinates = [quantize(ring) for ring in geometry["coordinates"]]
+        else:
+            coordinates = [[quantize(ring) for ring in polygon] for polygon in geometry["coordinates"]]
+        quantized.append({"type": geometry["type"], "coordinates": coordinates})
+
+    junctions = _find_junctions([ring for geometry in quantized for ring in _rings(geometry)])
+    simplified_arcs = {}
+
+    def simplify_arc(arc: list) -> list:
+        # an arc is simplified in one canonical direction so both neighbours get the same points
+        key = tuple(arc)
+        reverse_key = key[::-1]
+        canonical = min(key, reverse_key)
+        if canonical not in simplified_arcs:
+            simplified_arcs[canonical] = [tuple(point) for point in
+                                          douglas_peucker(np.array(canonical), tolerance).tolist()]
+        result = simplified_arcs[canonical]
+        return result if canonical == key else result[::-1]
+
+    def simplify_ring(ring: list) -> list:
+        arcs = [simplify_arc(arc) for arc in _split_ring(ring, junctions)]
+        simplified = [arcs[0][0]]
+        for arc in arcs:
+            simplified.extend(arc[1:])
+        # a ring needs at least 4 points (closed triangle), too small rings are kept as they are
+        if len(simplified) < 4:
+            return [list(point) for point in ring]
+        return [list(point) for point in simplified]
+
+    simplified_features = []
+    for feature, geometry in zip(features, quantized):
+        if geometry["type"] == "Polygon":
+            coordinates = [simplify_ring(ring) for ring in geometry["coordinates"]]
+        else:
+            coordinates = [[simplify_ring(ring) for ring in polygon] for polygon in geometry["coordinates"]]
+        simplified_features.append({"type": "Feature", "properties": dict(feature["properties"]),
+                                    "geometry": {"type": geometry["type"], "coordinates": coordinates}})
+    return simplified_features
+
+
+def geometry_size_report(features: list, zooms: list, precision: int=4, layers: int=2) -> dict:
+    '''Bytes of geometry embedded in the map for each zoom level target:
+    one full precision FeatureCollection per departement and per layer (former map) against
+    one simplified and quantized FeatureCollection shared by every layer'''
+    original = layers * sum(len(json.dumps({"type": "FeatureCollection", "features": [feature]}))
+                            for feature in features)
+    report = {}
+    for zoom in zooms:
+        simplified = simplify_features(features, zoom_tolerance(zoom), precision)
+        size = len(json.dumps({"type": "FeatureCollection", "features": simplified}, separators=(",", ":")))
+        report[zoom] = {"tolerance": zoom_tolerance(zoom), "original_bytes": original,
+                        "simplified_bytes": size, "saved_bytes": original - size}
+    return report
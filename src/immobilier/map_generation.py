@@ -1,4 +1,5 @@
 import json
+import os
 
 import pandas as pd 
 import numpy as np
@@ -7,9 +8,13 @@ from folium.plugins import FloatImage
 import vincent
 import branca
 import branca.colormap as cm
+from branca.element import MacroElement, Template
 
 from PIL import Image, ImageDraw, ImageFont
 
+from src.common.datastore import read_table
+from src.immobilier.geometry import simplify_features, geometry_size_report, zoom_tolerance
+
 
 def create_title_image(title, image_path):
     W, H = (500,200)
@@ -21,9 +26,185 @@ def create_title_image(title, image_path):
     image.crop((0, 0,2*w,2*h)).save(image_path, "PNG")
 
 
+# json endpoint of the web app serving the yearly prices of a departement (see app.py)
+PRICES_URL = "/api/immobilier/departements/{code}/prices?type_bien={type_bien}"
+
+
+class LazyPopupLoader(MacroElement):
+    '''Fill the lazy popups of the map with a line chart when they are opened,
+    the prices are fetched from the web app instead of being embedded in the html'''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        {{ this._parent.get_name() }}.on('popupopen', function(e) {
+            var div = e.popup.getElement().querySelector('.lazy-popup');
+            if (!div || div.getAttribute('data-loaded')) { return; }
+            div.setAttribute('data-loaded', '1');
+            var url = '{{ this.prices_url }}'
+                .replace('{code}', encodeURIComponent(div.getAttribute('data-code')))
+                .replace('{type_bien}', div.getAttribute('data-type'));
+            fetch(url).then(function(response) {
+                if (!response.ok) { throw new Error(response.status); }
+                return response.json();
+            }).then(function(data) {
+                var series = {'median': '#1f77b4', 'decile_1': '#2ca02c', 'decile_9': '#d62728'};
+                var W = 340, H = 200, left = 50, bottom = 25;
+                var values = [];
+                Object.keys(series).forEach(function(name) {
+                    data[name].forEach(function(v) { if (v !== null) { values.push(v); } });
+                });
+                var vmin = Math.min.apply(null, values), vmax = Math.max.apply(null, values);
+                var x = function(i) { return left + i * (W - left - 10) / Math.max(data.years.length - 1, 1); };
+                var y = function(v) { return 10 + (vmax - v) * (H - bottom - 10) / Math.max(vmax - vmin, 1); };
+                var svg = '<svg width="' + W + '" height="' + H + '" style="font: 10px sans-serif">';
+                svg += '<text x="' + left + '" y="' + (H - 5) + '">' + data.years[0] + '</text>';
+                svg += '<text x="' + (W - 35) + '" y="' + (H - 5) + '">' + data.years[data.years.length - 1] + '</text>';
+                svg += '<text x="0" y="' + y(vmax) + '">' + Math.round(vmax) + '</text>';
+                svg += '<text x="0" y="' + y(vmin) + '">' + Math.round(vmin) + '</text>';
+                Object.keys(series).forEach(function(name) {
+                    var points = [];
+                    data[name].forEach(function(v, i) { if (v !== null) { points.push(x(i) + ',' + y(v)); } });
+                    svg += '<polyline fill="none" stroke-width="2" stroke="' + series[name] + '" points="' + points.join(' ') + '"/>';
+                });
+                svg += '</svg>';
+                var legend = Object.keys(series).map(function(name) {
+                    return '<span style="color:' + series[name] + '">&#9632; ' + name + '</span>';
+                }).join(' ');
+                div.innerHTML = '<b>' + div.getAttribute('data-title') + '</b> (prix m2)<br>' + svg + '<br>' + legend;
+                e.popup.update();
+            }).catch(function() {
+                div.innerHTML = 'Données source manquantes';
+            });
+        });
+        {% endmacro %}
+        """)
+
+    def __init__(self, prices_url: str=PRICES_URL):
+        super().__init__()
+        self._name = "LazyPopupLoader"
+        self.prices_url = prices_url
+
+
+class SharedGeoJsonLayers(MacroElement):
+    '''Write the departements geometry once in the html and draw it in several layers,
+    each layer takes its fill color from the feature property color_{type_bien}
+    and gets a lazy popup (see LazyPopupLoader), features without color are left white'''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = {{ this.data_json }};
+        {% for group_name, type_bien in this.layers %}
+        L.geoJson({{ this.get_name() }}, {
+            style: function(feature) {
+                return {fillColor: feature.properties['color_{{ type_bien }}'] || 'white', fillOpacity: 0.5,
+                        color: 'blue', weight: 1, opacity: 1};
+            },
+            onEachFeature: function(feature, layer) {
+                var properties = feature.properties;
+                if (properties['color_{{ type_bien }}']) {
+                    var div = document.createElement('div');
+                    div.className = 'lazy-popup';
+                    div.setAttribute('data-code', properties.code);
+                    div.setAttribute('data-type', '{{ type_bien }}');
+                    div.setAttribute('data-title', properties.nom);
+                    div.textContent = 'Chargement...';
+                    layer.bindPopup(div, {maxWidth: 400});
+                } else {
+                    layer.bindPopup('Données source manquantes');
+                }
+            }
+        }).addTo({{ group_name }});
+        {% endfor %}
+        {% endmacro %}
+        """)
+
+    def __init__(self, data: dict, layers: list):
+        '''layers: list of (feature group, type_bien)'''
+        super().__init__()
+        self._name = "SharedGeoJsonLayers"
+        self.data_json = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+        self.layers = [(group.get_name(), type_bien) for group, type_bien in layers]
+
+
+# tile endpoint of the web app serving the communes (see app.py and commune_tiles.py)
+COMMUNE_TILES_URL = "/api/immobilier/tiles/communes/{z}/{x}/{y}.json"
+
+
+class CommuneTileLayers(MacroElement):
+    '''Draw the communes in several layers from GeoJSON tiles fetched as the map moves (only the visible ones),
+    each layer takes its fill color from the feature property color_{type_bien}. Nothing is drawn below min_zoom,
+    above max_zoom the tiles of max_zoom are reused. A commune crossing several tiles is drawn once'''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_layers = [
+        {% for group_name, type_bien in this.layers %}
+            L.geoJson(null, {
+                style: function(feature) {
+                    return {fillColor: feature.properties['color_{{ type_bien }}'] || 'white', fillOpacity: 0.6,
+                            color: 'grey', weight: 0.5, opacity: 1};
+                },
+                onEachFeature: function(feature, layer) {
+                    var properties = feature.properties;
+                    if (properties['median_{{ type_bien }}']) {
+                        layer.bindPopup('<b>' + properties.nom + '</b><br>Prix médian du m2 : ' +
+                                        properties['median_{{ type_bien }}'] + ' €<br>' +
+                                        properties['count_{{ type_bien }}'] + ' ventes');
+                    } else {
+                        layer.bindPopup('<b>' + properties.nom + '</b><br>Données source manquantes');
+                    }
+                }
+            }).addTo({{ group_name }}),
+        {% endfor %}
+        ];
+        // features of a single zoom level are drawn, the first tile of another level clears them
+        var {{ this.get_name() }}_state = {zoom: null, drawn: {}};
+        function {{ this.get_name() }}_clear(zoom) {
+            {{ this.get_name() }}_state = {zoom: zoom, drawn: {}};
+            {{ this.get_name() }}_layers.forEach(function(layer) { layer.clearLayers(); });
+        }
+        var {{ this.get_name() }} = new (L.GridLayer.extend({
+            createTile: function(coords, done) {
+                var tile = document.createElement('div');
+                if (coords.z !== {{ this.get_name() }}_state.zoom) { {{ this.get_name() }}_clear(coords.z); }
+                var url = '{{ this.tiles_url }}'.replace('{z}', coords.z).replace('{x}', coords.x).replace('{y}', coords.y);
+                fetch(url).then(function(response) {
+                    if (!response.ok) { throw new Error(response.status); }
+                    return response.json();
+                }).then(function(data) {
+                    var state = {{ this.get_name() }}_state;
+                    // answer of a zoom level left meanwhile
+                    if (coords.z !== state.zoom) { return; }
+                    data.features.forEach(function(feature) {
+                        if (state.drawn[feature.properties.code]) { return; }
+                        state.drawn[feature.properties.code] = true;
+                        {{ this.get_name() }}_layers.forEach(function(layer) { layer.addData(feature); });
+                    });
+                    done(null, tile);
+                }).catch(function(error) { done(error, tile); });
+                return tile;
+            }
+        }))({minZoom: {{ this.min_zoom }}, maxNativeZoom: {{ this.max_zoom }}, maxZoom: 19});
+        {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+        {{ this._parent.get_name() }}.on('zoomend', function() {
+            if ({{ this._parent.get_name() }}.getZoom() < {{ this.min_zoom }}) { {{ this.get_name() }}_clear(null); }
+        });
+        {% endmacro %}
+        """)
+
+    def __init__(self, layers: list, min_zoom: int, max_zoom: int, tiles_url: str=COMMUNE_TILES_URL):
+        '''layers: list of (feature group, type_bien), min_zoom and max_zoom: zoom levels of the built tiles'''
+        super().__init__()
+        self._name = "CommuneTileLayers"
+        self.layers = [(group.get_name(), type_bien) for group, type_bien in layers]
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.tiles_url = tiles_url
+
+
 class DepartementMap:
-    def __init__(self, longitude, latitude, title):
+    def __init__(self, longitude, latitude, title, lazy_popups: bool=False):
+        '''lazy_popups: popups only carry the departement code and load their chart when opened,
+        instead of embedding a vega chart per departement and per layer in the html'''
         self.title = title
+        self.lazy_popups = lazy_popups
         self.map = folium.Map(
             location=[longitude, latitude],
             tiles='openstreetmap',
@@ -32,6 +213,10 @@ class DepartementMap:
         )
         self.fgroup_appart = folium.map.FeatureGroup(name="Appartement", overlay=True, control=True, show=True)
         self.fgroup_maison = folium.map.FeatureGroup(name="Maison", overlay=True, control=True, show=False)
+        # set by draw_departements, geometry shared by both layers
+        self.shared_layers = None
+        # set by draw_communes, communes loaded by tiles over the departements
+        self.commune_layers = None
 
     @staticmethod
     def make_line_chart_popup(data_row:pd.Series, title:str) -> folium.Popup:
@@ -60,6 +245,13 @@ class DepartementMap:
         folium.Vega(line_chart, width = 400, height=250).add_to(popup)
         return popup
 
+    @staticmethod
+    def make_lazy_popup(code: str, type_bien: str, title: str) -> folium.Popup:
+        '''Placeholder popup, filled by LazyPopupLoader when opened'''
+        html = (f'<div class="lazy-popup" data-code="{code}" data-type="{type_bien}" data-title="{title}">'
+                'Chargement...</div>')
+        return folium.Popup(html, max_width=400)
+
     def draw_departement(self, d_geodata, row_appart:pd.Series=None, row_maison:pd.Series=None) -> None:
         '''
         d_geodata: geodata for a departement
@@ -83,7 +275,13 @@ class DepartementMap:
             line_color='blue',
         )
 
-        if row_appart is not None:
+        if row_appart is not None and self.lazy_popups:
+            properties = d_geodata["features"][0]["properties"]
+            popup_appart = DepartementMap.make_lazy_popup(properties["code"], "appartement", properties["nom"])
+            popup_appart.add_to(choro_appart)
+            popup_maison = DepartementMap.make_lazy_popup(properties["code"], "maison", properties["nom"])
+            popup_maison.add_to(choro_maison)
+        elif row_appart is not None:
             popup_appart = DepartementMap.make_line_chart_popup(row_appart, title=d_geodata["features"][0]["properties"]["nom"])
             popup_appart.add_to(choro_appart)
             popup_maison = DepartementMap.make_line_chart_popup(row_maison, title=d_geodata["features"][0]["properties"]["nom"])
@@ -97,16 +295,52 @@ class DepartementMap:
         choro_appart.add_to(self.fgroup_appart)
         choro_maison.add_to(self.fgroup_maison)
 
-    def save(self, file_path):
-        '''Save to html file'''
+    def draw_departements(self, geojson: dict, df_appart: pd.DataFrame, df_maison: pd.DataFrame,
+                          tolerance: float, precision: int=4) -> None:
+        '''Draw every departement at once: geometry simplified with the tolerance (in degrees),
+        coordinates rounded to precision decimals and written a single time for both layers,
+        colors are taken from the "color" column of the dataframes, popups are lazy'''
+        features = simplify_features(geojson["features"], tolerance, precision)
+        for feature in features:
+            code = feature["properties"]["code"]
+            properties = {"code": code, "nom": feature["properties"]["nom"]}
+            if code in df_appart.index:
+                properties["color_appartement"] = df_appart.loc[code, "color"]
+            if code in df_maison.index:
+                properties["color_maison"] = df_maison.loc[code, "color"]
+            feature["properties"] = properties
+        self.lazy_popups = True
+        self.shared_layers = SharedGeoJsonLayers({"type": "FeatureCollection", "features": features},
+                                                 [(self.fgroup_appart, "appartement"), (self.fgroup_maison, "maison")])
+
+    def draw_communes(self, min_zoom: int, max_zoom: int, tiles_url: str=COMMUNE_TILES_URL) -> None:
+        '''Commune mode: from min_zoom the communes are drawn over the departements of both layers,
+        loaded from the tiles built by commune_tiles.py (zoom levels min_zoom to max_zoom)'''
+        self.commune_layers = CommuneTileLayers([(self.fgroup_appart, "appartement"), (self.fgroup_maison, "maison")],
+                                                min_zoom, max_zoom, tiles_url)
+
+    def build(self) -> folium.Map:
+        '''Add the color bar, the layers and their control to the map'''
         # add the color bar to top right of the map
         colormap.add_to(self.map)
 
         self.fgroup_appart.add_to(self.map)
         self.fgroup_maison.add_to(self.map)
+        # after the feature groups, the shared layers are added to them
+        if self.shared_layers is not None:
+            self.shared_layers.add_to(self.map)
+        if self.commune_layers is not None:
+            self.commune_layers.add_to(self.map)
+        if self.lazy_popups:
+            LazyPopupLoader().add_to(self.map)
 
         lcontrol = folium.map.LayerControl(position='topright', collapsed=False)
         lcontrol.add_to(self.map)
+        return self.map
+
+    def save(self, file_path):
+        '''Save to html file'''
+        self.build()
 
         title_image_path = "static/images/title_logo_departement.png"
         # create and save the title image to the path
@@ -119,8 +353,8 @@ class DepartementMap:
 
 if __name__ == "__main__":
 
-    df_appart = pd.read_csv("data/immobilier/data_clean/m2_appartement_price_per_departement.csv", index_col=0)
-    df_maison = pd.read_csv("data/immobilier/data_clean/m2_maison_price_per_departement.csv", index_col=0)
+    df_appart = read_table("data/immobilier/store/m2_appartement_price_per_departement")
+    df_maison = read_table("data/immobilier/store/m2_maison_price_per_departement")
 
     # istance of a LinearColormap for departement coloration
     # LinearColormap class was modified from source, this code will not work with branca library from pip 
@@ -142,17 +376,26 @@ if __name__ == "__main__":
     df_maison["color"] = df_maison["2019_median"].apply(colormap)
 
     longitude, latitude = 45.8566, 2.3522
-    map1 = DepartementMap(longitude, latitude, "Prix médian du m2 d'un bien immobilier en France")
+    # popups load their chart from the app, the map html stays small
+    map1 = DepartementMap(longitude, latitude, "Prix médian du m2 d'un bien immobilier en France", lazy_popups=True)
 
     with open("data/immobilier/geo_data/departements.geojson.txt", "r") as file:
         json_departements = json.load(file)
 
-    for departement in json_departements["features"]:
-        d_geodata = {"type": "FeatureCollection", "features": [departement]}
-        if departement["properties"]["code"] in df_appart.index.tolist():
-            map1.draw_departement(d_geodata, df_appart.loc[departement["properties"]["code"],:],
-                                df_maison.loc[departement["properties"]["code"],:])
-        else:
-            map1.draw_departement(d_geodata)
+    # zoom level the geometry is simplified for (1 pixel of tolerance), the map opens at zoom 6
+    simplify_zoom = 8
+    coordinates_precision = 4
+    for zoom, sizes in geometry_size_report(json_departements["features"], [5, 6, 7, 8, 9], coordinates_precision).items():
+        print(f"zoom {zoom}: {sizes['original_bytes']} -> {sizes['simplified_bytes']} bytes of geometry "
+              f"({sizes['saved_bytes']} saved, tolerance {sizes['tolerance']:.5f} degrees)")
+
+    map1.draw_departements(json_departements, df_appart, df_maison,
+                           tolerance=zoom_tolerance(simplify_zoom), precision=coordinates_precision)
+
+    # communes when zooming in, if their tiles have been built (python -m src.immobilier.commune_tiles)
+    if os.path.isfile("build/tiles/communes/tiles.json"):
+        with open("build/tiles/communes/tiles.json", "r") as file:
+            tiles = json.load(file)
+        map1.draw_communes(tiles["min_zoom"], tiles["max_zoom"])
 
     map1.save(file_path="templates/immobilier/maps/map_departement_folium.html")
@@ -6,6 +6,8 @@ from sklearn import metrics
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler, Normalizer, MinMaxScaler
 
+from src.common.datastore import read_table
+
 
 pd.set_option('display.float_format', lambda x: '%.5f' % x)
 # pd.set_option('display.max_columns', None)
@@ -14,14 +16,13 @@ pd.set_option('display.max_rows', 100)
 pd.set_option('display.min_rows', 30)
 
 
-df = pd.read_csv("data/immobilier/data_clean/appartements.csv", index_col=0, dtype={"code_departement":str, "code_commune":str})
-departement_prices_df = pd.read_csv("data/immobilier/data_clean/m2_appartement_price_per_departement.csv", index_col=0)
+# outre-mer dropped for more metropolitan precision while reading, only the rows of the other departements are decoded
+df = read_table("data/immobilier/store/appartement", columns=["surface_reelle_bati", "nombre_pieces_principales",
+    "code_departement", "valeur_fonciere"], filters=[("code_departement", "not in", ["971", "972", "973", "974"])])
+departement_prices_df = read_table("data/immobilier/store/m2_appartement_price_per_departement", columns=["2019_median"])
 
 df = df.dropna()
 
-# drop outre-mer for more metropolitan precision
-df = df[~df["code_departement"].isin(["971", "972", "973", "974"])]
-
 
 df = df.merge(departement_prices_df["2019_median"], how="inner", left_on="code_departement", right_on="code_departement", validate="many_to_one") 
 
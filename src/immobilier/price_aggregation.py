@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+
+
+# quantiles of the departement tables: {year}_median, {year}_decile_1, {year}_decile_9
+DEFAULT_QUANTILES = (0.5, 0.1, 0.9)
+
+
+def quantile_name(q: float) -> str:
+    '''Column name of a quantile: 0.5 -> median, 0.1 -> decile_1, 0.25 -> quartile_1, 0.95 -> percentile_95'''
+    if q == 0.5:
+        return "median"
+    for name, parts in (("decile", 10), ("quartile", 4)):
+        if round(q * parts, 9) == round(q * parts):
+            return f"{name}_{round(q * parts)}"
+    return f"percentile_{q * 100:g}"
+
+
+def _group_codes(df: pd.DataFrame, keys: list) -> tuple:
+    '''Group number of each row (-1 if a key is missing) and the sorted groups (Index, MultiIndex for several keys)'''
+    key_codes, key_values = zip(*(pd.factorize(df[key], sort=True) for key in keys))
+    missing = np.logical_or.reduce([codes < 0 for codes in key_codes])
+    shape = [max(len(values), 1) for values in key_values]
+    flat = np.ravel_multi_index([np.maximum(codes, 0) for codes in key_codes], shape)
+    codes, flat_groups = pd.factorize(flat, sort=True)
+    codes[missing] = -1
+    if missing.any():
+        # groups made only of rows with a missing key
+        used = np.bincount(codes[~missing], minlength=len(flat_groups)) > 0
+        codes[~missing] = (np.cumsum(used) - 1)[codes[~missing]]
+        flat_groups = flat_groups[used]
+    if len(keys) == 1:
+        return codes, pd.Index(key_values[0].take(flat_groups), name=keys[0])
+    groups = pd.MultiIndex(levels=list(key_values), codes=np.unravel_index(flat_groups, shape), names=keys)
+    return codes, groups
+
+
+def _aggregate(values: np.ndarray, value_order: np.ndarray, codes: np.ndarray, groups: pd.Index,
+               quantiles: tuple, stats: tuple) -> pd.DataFrame:
+    # rows ordered by value, then stable ordered by group: sorted values inside each group slice
+    # (two sorts of a single array are much faster than a lexsort of both)
+    order = value_order[codes[value_order] >= 0]
+    # small integer codes are radix sorted
+    code_type = np.int16 if len(groups) < 2 ** 15 else np.int64
+    order = order[np.argsort(codes[order].astype(code_type), kind="stable")]
+    # NaN sentinel: the positions of empty groups stay inside the array
+    sorted_values = np.append(values[order], np.nan)
+    sorted_codes = codes[order]
+
+    counts = np.bincount(sorted_codes, minlength=len(groups))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    # groups without value get NaN statistics
+    empty = counts == 0
+    result = {}
+    if "count" in stats:
+        result["count"] = counts
+    if "mean" in stats:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result["mean"] = np.bincount(sorted_codes, weights=sorted_values[:-1], minlength=len(groups)) / counts
+    for q in quantiles:
+        position = q * np.maximum(counts - 1, 0)
+        below = np.floor(position).astype(np.int64)
+        above = np.ceil(position).astype(np.int64)
+        low, high = sorted_values[starts + below], sorted_values[starts + above]
+        result[quantile_name(q)] = np.where(empty, np.nan, low + (high - low) * (position - below))
+    return pd.DataFrame(result, index=groups)
+
+
+def _sorted_values(df: pd.DataFrame, value: str) -> tuple:
+    '''Values as float64 and the order of the non missing ones, shared by every grouping of the rows'''
+    values = df[value].to_numpy(dtype=np.float64)
+    # missing values are sorted last
+    value_order = np.argsort(values)
+    return values, value_order[:np.count_nonzero(~np.isnan(values))]
+
+
+def group_quantiles(df: pd.DataFrame, keys: list, value: str="prix_m2", quantiles: tuple=DEFAULT_QUANTILES,
+                    stats: tuple=("count", "mean")) -> pd.DataFrame:
+    '''count, mean and quantiles of value for each group of keys in one pass, no python call per group:
+    rows are sorted by group then value, each quantile is read at its position inside the group slice
+    (linear interpolation, same results as pandas quantile). Missing values and keys are left out like in groupby.
+    Return one row per group indexed by keys, columns stats then quantile names'''
+    values, value_order = _sorted_values(df, value)
+    codes, groups = _group_codes(df, keys)
+    return _aggregate(values, value_order, codes, groups, quantiles, stats)
+
+
+def wide_table(table: pd.DataFrame, column_key: str="year", columns: list=None) -> pd.DataFrame:
+    '''Move one key of a group_quantiles table to the columns, named {key value}_{statistic}
+    and ordered key value first: {year}_median, {year}_decile_1, {year}_decile_9, {year+1}_median...'''
+    columns = list(table.columns) if columns is None else columns
+    wide = table[columns].unstack(column_key)
+    key_values = wide.columns.get_level_values(column_key).unique().sort_values()
+    wide = wide.reindex(columns=pd.MultiIndex.from_product([columns, key_values]))
+    wide = wide[[(column, key) for key in key_values for column in columns]]
+    wide.columns = [f"{key}_{column}" for column, key in wide.columns]
+    return wide
+
+
+def aggregate_levels(df: pd.DataFrame, levels: dict, value: str="prix_m2", quantiles: tuple=DEFAULT_QUANTILES,
+                     stats: tuple=("count", "mean")) -> dict:
+    '''group_quantiles for several groupings of the same rows, levels: {name: keys}
+    (ex: {"departement": ["year", "code_departement"], "commune": ["year", "code_commune"]}),
+    the values are sorted once for every level'''
+    values, value_order = _sorted_values(df, value)
+    return {name: _aggregate(values, value_order, *_group_codes(df, keys), quantiles, stats)
+            for name, keys in levels.items()}
+
+
+# mergeable quantile sketches (merging t-digest): each group of keys is summarized by centroids (mean, weight),
+# small near the extreme quantiles and larger around the median, at most about compression / 2 per group.
+# Sketches of several years (or departements of a region) are merged by concatenating their centroids.
+SKETCH_COMPRESSION = 200
+
+
+def _sort_by_group(codes: np.ndarray, means: np.ndarray) -> np.ndarray:
+    order = np.argsort(means, kind="stable")
+    return order[np.argsort(codes[order], kind="stable")]
+
+
+def _compress(codes: np.ndarray, means: np.ndarray, weights: np.ndarray, n_groups: int, compression: float) -> tuple:
+    '''Centroids of every group merged down to the k1 scale (k = compression / 2pi * asin(2q - 1)):
+    neighbour centroids whose quantiles fall in the same unit of k are merged, return (codes, means, weights)'''
+    order = _sort_by_group(codes, means)
+    codes, means, weights = codes[order], means[order], weights[order]
+    totals = np.bincount(codes, weights=weights, minlength=n_groups)
+    cumulated = np.cumsum(weights)
+    group_starts = np.concatenate(([0.0], np.cumsum(totals)[:-1]))
+    quantiles = (cumulated - weights / 2 - group_starts[codes]) / totals[codes]
+    k = np.floor(compression / (2 * np.pi) * np.arcsin(np.clip(2 * quantiles - 1, -1, 1)))
+    new_centroid = np.ones(len(codes), dtype=bool)
+    new_centroid[1:] = (codes[1:] != codes[:-1]) | (k[1:] != k[:-1])
+    ids = np.cumsum(new_centroid) - 1
+    merged_weights = np.bincount(ids, weights=weights)
+    merged_means = np.bincount(ids, weights=means * weights) / merged_weights
+    return codes[new_centroid], merged_means, merged_weights
+
+
+def sketch_table(df: pd.DataFrame, keys: list, value: str="prix_m2", compression: float=SKETCH_COMPRESSION) -> pd.DataFrame:
+    '''Quantile sketch of value for each group of keys, one row per centroid: keys, mean, weight'''
+    df = df[df[value].notna()]
+    codes, groups = _group_codes(df, keys)
+    kept = codes >= 0
+    means = df[value].to_numpy(dtype=np.float64)[kept]
+    return _centroid_frame(groups, *_compress(codes[kept], means, np.ones(len(means)), len(groups), compression))
+
+
+def merge_sketches(sketches: pd.DataFrame, keys: list, compression: float=SKETCH_COMPRESSION) -> pd.DataFrame:
+    '''Merge the centroids of the sketches sharing the same keys (ex: every year of a departement,
+    or the departements of a region with a region column), keys not listed are merged together'''
+    codes, groups = _group_codes(sketches, keys)
+    kept = codes >= 0
+    return _centroid_frame(groups, *_compress(codes[kept], sketches["mean"].to_numpy(dtype=np.float64)[kept],
+                                              sketches["weight"].to_numpy(dtype=np.float64)[kept],
+                                              len(groups), compression))
+
+
+def _centroid_frame(groups: pd.Index, codes: np.ndarray, means: np.ndarray, weights: np.ndarray) -> pd.DataFrame:
+    centroids = groups.take(codes).to_frame(index=False)
+    centroids["mean"] = means
+    centroids["weight"] = weights
+    return centroids
+
+
+def sketch_quantiles(sketches: pd.DataFrame, keys: list, quantiles: tuple=DEFAULT_QUANTILES,
+                     stats: tuple=("count", "mean"), compression: float=SKETCH_COMPRESSION) -> pd.DataFrame:
+    '''Same table as group_quantiles, estimated from the sketches grouped by keys: the centroids of a group
+    are merged first (overlapping centroids of several sketches would blur the interpolation).
+    Exact count and mean, quantiles interpolated between the centers of the centroids,
+    exact as long as the centroids are single values'''
+    codes, groups = _group_codes(sketches, keys)
+    kept = codes >= 0
+    codes, means, weights = _compress(codes[kept], sketches["mean"].to_numpy(dtype=np.float64)[kept],
+                                      sketches["weight"].to_numpy(dtype=np.float64)[kept], len(groups), compression)
+
+    totals = np.bincount(codes, weights=weights, minlength=len(groups))
+    # centers of the centroids on a single axis: groups follow each other, a group starts at the total before it
+    centers = np.cumsum(weights) - weights / 2
+    group_starts = np.concatenate(([0.0], np.cumsum(totals)[:-1]))
+    counts = np.bincount(codes, minlength=len(groups))
+    first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    last = first + counts - 1
+
+    result = {}
+    if "count" in stats:
+        result["count"] = totals
+    if "mean" in stats:
+        result["mean"] = np.bincount(codes, weights=means * weights, minlength=len(groups)) / totals
+    for q in quantiles:
+        # same position as the linear interpolation of pandas quantile when every weight is 1
+        target = group_starts + q * (totals - 1) + 0.5
+        below = np.clip(np.searchsorted(centers, target, side="right") - 1, first, last)
+        above = np.minimum(below + 1, last)
+        span = centers[above] - centers[below]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(span > 0, np.clip((target - centers[below]) / span, 0, 1), 0)
+        result[quantile_name(q)] = means[below] + (means[above] - means[below]) * fraction
+    return pd.DataFrame(result, index=groups)